@@ -0,0 +1,273 @@
+import os
+import io
+import time
+import gzip
+import lzma
+import zipfile
+import concurrent.futures
+
+# Compression codecs available for backup archives.
+# zip is the original container format; the others compress a single stream
+# (a .sql dump or a .tar of a directory-format dump).
+CODECS = ("zip", "gzip", "zstd", "lz4", "xz")
+
+CODEC_EXTENSIONS = {
+    "zip": ".zip",
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "lz4": ".lz4",
+    "xz": ".xz",
+}
+
+# Extension of chunk-store manifests (see chunk_store), which stand in for an
+# archive when backups are written to a deduplicating repository
+MANIFEST_EXTENSION = ".manifest"
+
+# File extensions of every archive the backup tool can produce
+ARCHIVE_EXTENSIONS = tuple(CODEC_EXTENSIONS.values()) + (MANIFEST_EXTENSION,)
+
+# Leading bytes used to detect the codec of an existing archive
+CODEC_MAGIC = (
+    (b"PK\x03\x04", "zip"),
+    (b"PK\x05\x06", "zip"),
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\x04\x22\x4d\x18", "lz4"),
+    (b"\xfd7zXZ\x00", "xz"),
+)
+
+# Uncompressed block size handed to each worker by the parallel gzip writer
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def archive_extension(codec, dump_format="plain"):
+    """Returns the file extension for an archive, e.g. '.zip', '.sql.zst' or '.tar.gz'."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}'. Expected one of: {', '.join(CODECS)}")
+    if codec == "zip":
+        return ".zip"
+    # Directory-format dumps and physical (pg_basebackup) backups are tar streams
+    inner = ".tar" if dump_format in ("directory", "physical") else ".sql"
+    return inner + CODEC_EXTENSIONS[codec]
+
+
+def is_archive(path):
+    """True if the file name has one of the backup archive extensions."""
+    return path.endswith(ARCHIVE_EXTENSIONS)
+
+
+def strip_codec_extension(path):
+    """Removes the codec extension: 'db_x.sql.zst' -> 'db_x.sql'."""
+    for ext in CODEC_EXTENSIONS.values():
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def detect_codec(path):
+    """Detects the codec of an archive from its header, falling back to the extension.
+
+    Chunk-store manifests are reported as the "chunks" codec.
+    """
+    if path.endswith(MANIFEST_EXTENSION):
+        return "chunks"
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for magic, codec in CODEC_MAGIC:
+        if head.startswith(magic):
+            return codec
+    codec = codec_from_extension(path)
+    if codec is None:
+        raise ValueError(f"Cannot detect the compression codec of '{path}'.")
+    return codec
+
+
+def codec_from_extension(path):
+    """Returns the codec of an archive from its file name alone, or None.
+
+    Used for archives that are not local files, e.g. in object storage.
+    """
+    if path.endswith(MANIFEST_EXTENSION):
+        return "chunks"
+    for codec, ext in CODEC_EXTENSIONS.items():
+        if path.endswith(ext):
+            return codec
+    return None
+
+
+def _require_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise EnvironmentError("The zstd codec requires the 'zstandard' package (pip install zstandard).")
+    return zstandard
+
+
+def _require_lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise EnvironmentError("The lz4 codec requires the 'lz4' package (pip install lz4).")
+    return lz4.frame
+
+
+def check_codec_available(codec):
+    """Raises EnvironmentError early if the codec's optional package is missing."""
+    if codec == "zstd":
+        _require_zstd()
+    elif codec == "lz4":
+        _require_lz4()
+    elif codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}'. Expected one of: {', '.join(CODECS)}")
+
+
+class ZipMemberWriter(io.RawIOBase):
+    """Writable stream for a single member of a new zip archive.
+
+    `path` may also be an open binary file, which is left open.
+    """
+
+    def __init__(self, path, arcname, level=None):
+        self._zipf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=level)
+        self._member = self._zipf.open(arcname, 'w', force_zip64=True)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._member.write(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._member.close()
+            finally:
+                self._zipf.close()
+        super().close()
+
+
+def _compress_block(block, level):
+    """gzip-compresses one block; returns (data, CPU seconds this thread spent on it)."""
+    started = time.thread_time()
+    data = gzip.compress(block, level, mtime=0)
+    return data, time.thread_time() - started
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """gzip writer that compresses fixed-size blocks on a thread pool.
+
+    Each block becomes an independent gzip member; concatenated members form
+    a valid gzip stream that gzip, pigz and Python's gzip module all read.
+    zlib releases the GIL while compressing, so blocks are compressed in
+    parallel. At most two blocks per thread are in flight to bound memory.
+    cpu_seconds is the CPU time the pool threads spent compressing blocks
+    written out so far (see throttling.Throttle.measure).
+    """
+
+    def __init__(self, path, level=None, threads=1, block_size=GZIP_BLOCK_SIZE, fileobj=None):
+        # A caller-supplied fileobj is written to but not closed
+        self._owns_fh = fileobj is None
+        self._fh = open(path, 'wb') if fileobj is None else fileobj
+        self._level = 6 if level is None else level
+        self._threads = max(1, threads)
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pending = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+        self.cpu_seconds = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(_compress_block, block, self._level))
+        while len(self._pending) > self._threads * 2:
+            self._collect(self._pending.pop(0))
+
+    def _collect(self, future):
+        data, cpu = future.result()
+        self.cpu_seconds += cpu
+        self._fh.write(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                    self._buffer.clear()
+                for future in self._pending:
+                    self._collect(future)
+                self._pending = []
+            finally:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                if self._owns_fh:
+                    self._fh.close()
+        super().close()
+
+
+def open_writer(path, codec, level=None, threads=1, arcname=None, fileobj=None):
+    """Opens a writable binary stream that compresses into `path` with `codec`.
+
+    `level` is the codec's compression level (None = codec default) and
+    `threads` the number of compression threads where the codec supports it
+    (gzip and zstd). For zip, `arcname` names the single member written.
+    With `fileobj` the compressed bytes go to that open binary file instead,
+    which is left open when the writer is closed.
+    """
+    check_codec_available(codec)
+    target = path if fileobj is None else fileobj
+    if codec == "zip":
+        return ZipMemberWriter(target, arcname or os.path.basename(strip_codec_extension(path)), level=level)
+    if codec == "gzip":
+        if threads > 1:
+            return ParallelGzipWriter(path, level=level, threads=threads, fileobj=fileobj)
+        return gzip.open(target, 'wb', compresslevel=6 if level is None else level)
+    if codec == "zstd":
+        zstandard = _require_zstd()
+        params = {"level": 3 if level is None else level}
+        if threads > 1:
+            params["threads"] = threads
+        fh = open(path, 'wb') if fileobj is None else fileobj
+        return zstandard.ZstdCompressor(**params).stream_writer(fh, closefd=fileobj is None)
+    if codec == "lz4":
+        lz4_frame = _require_lz4()
+        return lz4_frame.open(target, 'wb', compression_level=0 if level is None else level)
+    if codec == "xz":
+        return lzma.open(target, 'wb', preset=6 if level is None else level)
+
+
+def open_reader(path, codec=None, member=None, fileobj=None):
+    """Opens a readable binary stream of the decompressed archive contents.
+
+    The codec is detected from the file header when not given. For zip
+    archives `member` selects the entry to read. With `fileobj` the
+    compressed bytes are read from that open binary file, which is left open.
+    """
+    codec = codec or detect_codec(path)
+    check_codec_available(codec)
+    source = path if fileobj is None else fileobj
+    if codec == "zip":
+        zipf = zipfile.ZipFile(source, 'r')
+        try:
+            # The member keeps the underlying file open after the ZipFile is closed
+            return zipf.open(member, 'r')
+        finally:
+            zipf.close()
+    if codec == "gzip":
+        return gzip.open(source, 'rb')
+    if codec == "zstd":
+        zstandard = _require_zstd()
+        fh = open(path, 'rb') if fileobj is None else fileobj
+        return zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True, closefd=fileobj is None)
+    if codec == "lz4":
+        return _require_lz4().open(source, 'rb')
+    if codec == "xz":
+        return lzma.open(source, 'rb')
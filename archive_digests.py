@@ -0,0 +1,227 @@
+import io
+import os
+import json
+import time
+import hashlib
+
+# Logging is configured in the main block or by the importing application
+
+# Suffix of the digest file written next to every archive
+DIGEST_EXTENSION = ".digest.json"
+
+DIGEST_FORMAT = "pg_backup_restore-digest"
+DIGEST_VERSION = 1
+
+ALGORITHM = "sha256"
+
+# Size of the blocks read when hashing a file
+CHUNK_SIZE = 1024 * 1024
+
+# Largest stretch a HashingReader reads itself when a read skips ahead (e.g. a
+# zip data descriptor between two members) to keep hashing in order
+MAX_GAP = 1024 * 1024
+
+
+def new_hasher():
+    return hashlib.new(ALGORITHM)
+
+
+class HashingWriter(io.RawIOBase):
+    """Writable stream that hashes everything written through it.
+
+    The bytes are passed on to `raw`, which is closed with this stream only
+    when close_raw is true; with raw=None they are only hashed. The stream
+    is not seekable, so zipfile writes archives through it sequentially
+    (with data descriptors) instead of seeking back to patch headers, and
+    the digest covers the final file.
+    """
+
+    def __init__(self, raw, close_raw=False, hasher=None):
+        self._raw = raw
+        self._close_raw = close_raw
+        # gzip records the file name in its header
+        self.name = getattr(raw, "name", None)
+        self.hasher = hasher or new_hasher()
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        if self._raw is not None:
+            self._raw.write(data)
+        self.hasher.update(data)
+        n = len(data)
+        self.bytes_written += n
+        return n
+
+    def flush(self):
+        if not self.closed and self._raw is not None and not getattr(self._raw, "closed", False):
+            self._raw.flush()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    @property
+    def cpu_seconds(self):
+        # A thread-pool writer underneath reports its threads' CPU time
+        return getattr(self._raw, "cpu_seconds", 0.0)
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                if self._close_raw and self._raw is not None:
+                    self._raw.close()
+
+
+def open_hashed_file(path):
+    """Creates `path` for writing and hashes the bytes written to it."""
+    return HashingWriter(open(path, 'wb'), close_raw=True)
+
+
+class HashingReader(io.RawIOBase):
+    """Seekable file reader that hashes the file in order as it is read.
+
+    Reads that jump ahead (zipfile reads the central directory at the end of
+    the archive first) are hashed only once sequential reading reaches them;
+    small skipped stretches are read and hashed on the spot. finish() hashes
+    whatever was never read in order. Reading a file front to back through
+    it therefore hashes it without a second pass.
+    """
+
+    def __init__(self, path):
+        self._fh = open(path, 'rb')
+        self._pos = 0
+        self._hashed = 0
+        self.hasher = new_hasher()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._pos = self._fh.seek(offset, whence)
+        return self._pos
+
+    def _hash_gap(self):
+        self._fh.seek(self._hashed)
+        while self._hashed < self._pos:
+            chunk = self._fh.read(min(CHUNK_SIZE, self._pos - self._hashed))
+            if not chunk:
+                break
+            self.hasher.update(chunk)
+            self._hashed += len(chunk)
+        self._fh.seek(self._pos)
+
+    def readinto(self, b):
+        if self._hashed < self._pos <= self._hashed + MAX_GAP:
+            self._hash_gap()
+        n = self._fh.readinto(b)
+        end = self._pos + n
+        if self._pos <= self._hashed < end:
+            self.hasher.update(memoryview(b)[self._hashed - self._pos:n])
+            self._hashed = end
+        self._pos = end
+        return n
+
+    def finish(self):
+        """Hashes the rest of the file and returns (hex digest, file size)."""
+        self._fh.seek(self._hashed)
+        while True:
+            chunk = self._fh.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.hasher.update(chunk)
+            self._hashed += len(chunk)
+        self._fh.seek(self._pos)
+        return self.hasher.hexdigest(), self._hashed
+
+    def close(self):
+        if not self.closed:
+            self._fh.close()
+        super().close()
+
+
+def file_digest(path):
+    """Hex digest and size of a file, read in chunks."""
+    with HashingReader(path) as reader:
+        return reader.finish()
+
+
+def digest_path(archive_path):
+    return archive_path + DIGEST_EXTENSION
+
+
+def encode_record(record):
+    return json.dumps(record, indent=1).encode('utf-8')
+
+
+def _write_record(archive_path, record):
+    path = digest_path(archive_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_record(record))
+    os.replace(tmp_path, path)
+    return path
+
+
+def digest_record(archive_name, archive_sha256, archive_size, dump_sha256=None, dump_size=None):
+    """Builds the digest record of an archive.
+
+    The dump digest covers the uncompressed dump as restore reads it (for
+    zip archives, the data of every member except toc.json and
+    incremental.json, in archive order); it is omitted for directory-format
+    archives packaged as zip files.
+    """
+    record = {
+        "format": DIGEST_FORMAT,
+        "version": DIGEST_VERSION,
+        "algorithm": ALGORITHM,
+        "archive": archive_name,
+        "archive_sha256": archive_sha256,
+        "archive_size": archive_size,
+        "created_at": round(time.time(), 3),
+    }
+    if dump_sha256 is not None:
+        record["dump_sha256"] = dump_sha256
+        record["dump_size"] = dump_size
+    return record
+
+
+def write_digests(archive_path, archive_sha256, archive_size, dump_sha256=None, dump_size=None):
+    """Writes the digest file of a local archive and returns its path (see digest_record)."""
+    record = digest_record(os.path.basename(archive_path), archive_sha256, archive_size, dump_sha256, dump_size)
+    return _write_record(archive_path, record)
+
+
+def read_digests(archive_path):
+    """Returns the digest record of an archive, or None if it has none."""
+    path = digest_path(archive_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        record = json.load(f)
+    if record.get("format") != DIGEST_FORMAT:
+        return None
+    return record
+
+
+def mark_verified(archive_path, status):
+    """Records the time and outcome of the latest verification in the digest file."""
+    record = read_digests(archive_path)
+    if record is None:
+        return
+    record["verified_at"] = round(time.time(), 3)
+    record["verify_status"] = status
+    _write_record(archive_path, record)
+
@@ -0,0 +1,289 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import zipfile
+import argparse
+
+import archive_codecs
+import archive_digests
+import backup_catalog
+import storage_backends
+import verify_backups
+
+# Logging is configured in the main block or by the importing application
+
+# Newest backups of each database left as they were written (the fast tier)
+DEFAULT_KEEP_FAST = 3
+
+# Codec older archives are recompressed with: slow to write, but the smallest output
+DEFAULT_COLD_CODEC = "xz"
+
+# Size of the blocks copied from one archive to the next
+CHUNK_SIZE = 1024 * 1024
+
+# Suffix of an archive being written, renamed into place once it is verified
+PARTIAL_SUFFIX = ".tier.tmp"
+
+
+def archive_stem(path):
+    """'<database>_<timestamp>' of an archive name, the part every tier keeps."""
+    m = backup_catalog.ARCHIVE_NAME_RE.match(os.path.basename(path))
+    return f"{m.group('database')}_{m.group('timestamp')}" if m else None
+
+
+def locate_archive(path, catalog_path=None):
+    """Current location of an archive that has moved to another tier, or None.
+
+    The archive's name keeps its database and timestamp when it is
+    recompressed or moved, so it is looked up by those in the catalog of
+    the directory it was written to (or `catalog_path`).
+    """
+    stem = archive_stem(path)
+    catalog_path = catalog_path or backup_catalog.default_catalog_path(os.path.dirname(os.path.abspath(path)))
+    if stem is None or not os.path.exists(catalog_path):
+        return None
+    database = backup_catalog.ARCHIVE_NAME_RE.match(os.path.basename(path)).group("database")
+    catalog = backup_catalog.BackupCatalog(catalog_path)
+    for b in catalog.list_backups(database):
+        if archive_stem(b["path"]) == stem and (storage_backends.is_url(b["path"]) or os.path.exists(b["path"])):
+            return b["path"]
+    return None
+
+
+def single_dump_member(path):
+    """Name of the .sql member of a plain zip archive, or None for any other zip.
+
+    Indexed, incremental and directory-format zips hold several members
+    that only a zip can keep apart.
+    """
+    with zipfile.ZipFile(path, 'r') as zipf:
+        names = zipf.namelist()
+    return names[0] if len(names) == 1 and names[0].endswith(".sql") else None
+
+
+def _expected_digests(entry):
+    expected = archive_digests.read_digests(entry["path"])
+    if expected is None and entry.get("checksum"):
+        expected = {"archive_sha256": entry["checksum"]}
+    return expected
+
+
+def _finish(entry, catalog, partial_path, new_path, archive_sha256, archive_size, dump_sha256=None, dump_size=None):
+    """Renames a verified copy into place, then retires the old archive."""
+    if os.path.exists(new_path):
+        raise FileExistsError(f"{new_path} already exists")
+    os.replace(partial_path, new_path)
+    archive_digests.write_digests(new_path, archive_sha256, archive_size, dump_sha256, dump_size)
+    archive_digests.mark_verified(new_path, "ok")
+    if not catalog.move(entry["path"], new_path, size=archive_size, codec=archive_codecs.detect_codec(new_path), checksum=archive_sha256):
+        # Retention deleted the backup while it was being copied
+        for leftover in (new_path, archive_digests.digest_path(new_path)):
+            os.remove(leftover)
+        raise FileNotFoundError(f"{entry['path']} was removed from the catalog meanwhile")
+    # Only now, with the new copy catalogued, is the old one removed
+    for old in (entry["path"], archive_digests.digest_path(entry["path"])):
+        if os.path.exists(old):
+            os.remove(old)
+
+
+def move_archive(entry, catalog, dest_dir):
+    """Copies an archive to dest_dir unchanged, checks the copy's digest and removes the original."""
+    expected = _expected_digests(entry)
+    if not expected or not expected.get("archive_sha256"):
+        raise ValueError("no recorded checksum to verify the copy against")
+    new_path = os.path.join(dest_dir, os.path.basename(entry["path"]))
+    partial_path = new_path + PARTIAL_SUFFIX
+    try:
+        with open(entry["path"], 'rb') as src, archive_digests.open_hashed_file(partial_path) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            copied = dst.hexdigest()
+        if copied != expected["archive_sha256"]:
+            raise ValueError("archive digest mismatch")
+        # A second read checks what actually reached the disk
+        sha256, size = archive_digests.file_digest(partial_path)
+        if sha256 != expected["archive_sha256"]:
+            raise ValueError("digest mismatch after writing the copy")
+        _finish(entry, catalog, partial_path, new_path, sha256, size, expected.get("dump_sha256"), expected.get("dump_size"))
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return new_path
+
+
+def recompress_archive(entry, catalog, codec, level=None, threads=1, dest_dir=None):
+    """Rewrites an archive with another codec into dest_dir (default: where it is).
+
+    The old archive is read once; its archive and dump digests are checked
+    against the recorded ones while the new archive is written. The new
+    archive is then read back and must decompress to the same dump before
+    it replaces the old one in the catalog.
+    """
+    path = entry["path"]
+    old_codec = archive_codecs.detect_codec(path)
+    member = None
+    if old_codec == "zip":
+        member = single_dump_member(path)
+        if member is None:
+            raise ValueError("only plain zip archives can be recompressed")
+    expected = _expected_digests(entry)
+    if not expected or not expected.get("dump_sha256"):
+        raise ValueError("no recorded dump digest to verify the new archive against")
+    dump_format = entry["dump_format"] or ("directory" if ".tar." in os.path.basename(path) else "plain")
+    new_name = archive_stem(path) + archive_codecs.archive_extension(codec, dump_format)
+    new_path = os.path.join(dest_dir or os.path.dirname(path), new_name)
+    partial_path = new_path + PARTIAL_SUFFIX
+    arcname = archive_stem(path) + ".sql"
+    try:
+        dump_hasher = archive_digests.new_hasher()
+        dump_size = 0
+        with archive_digests.HashingReader(path) as raw:
+            with archive_codecs.open_reader(path, old_codec, member=member, fileobj=raw) as src, archive_digests.open_hashed_file(partial_path) as dst:
+                # gzip records the file name in its header; give it the final one
+                dst.name = new_path
+                with archive_codecs.open_writer(partial_path, codec, level=level, threads=threads, arcname=arcname, fileobj=dst) as writer:
+                    while True:
+                        chunk = src.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dump_hasher.update(chunk)
+                        dump_size += len(chunk)
+                        writer.write(chunk)
+                archive_sha256, archive_size = dst.hexdigest(), dst.bytes_written
+            old_sha256, _old_size = raw.finish()
+        errors = []
+        if expected.get("archive_sha256") and expected["archive_sha256"] != old_sha256:
+            errors.append("archive digest mismatch")
+        if expected["dump_sha256"] != dump_hasher.hexdigest():
+            errors.append("dump digest mismatch")
+        if errors:
+            raise ValueError(", ".join(errors))
+        check = verify_backups.verify_archive(partial_path, {"archive_sha256": archive_sha256, "dump_sha256": expected["dump_sha256"]})
+        if check["status"] != "ok":
+            raise ValueError(f"the recompressed archive did not verify: {check.get('error')}")
+        _finish(entry, catalog, partial_path, new_path, archive_sha256, archive_size, expected["dump_sha256"], dump_size)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return new_path
+
+
+def plan_entry(entry, codec=None, cold_dir=None):
+    """What tiering would do with a catalogued archive: ("recompress" | "move", None) or (None, reason)."""
+    path = entry["path"]
+    if storage_backends.is_url(path):
+        return None, "in object storage"
+    if not os.path.exists(path):
+        return None, "missing"
+    if entry["dump_format"] == "incremental":
+        # Newer incremental archives read tables from it by name, in its directory
+        return None, "incremental archives stay in place"
+    old_codec = archive_codecs.detect_codec(path)
+    if old_codec == "chunks":
+        return None, "chunk-store manifests are already deduplicated"
+    move = cold_dir is not None and os.path.abspath(cold_dir) != os.path.dirname(os.path.abspath(path))
+    if codec and codec != old_codec:
+        if old_codec != "zip" or single_dump_member(path):
+            return "recompress", None
+        if move:
+            return "move", None
+        return None, "only plain zip archives can be recompressed"
+    if move:
+        return "move", None
+    return None, "already tiered"
+
+
+def tier_archives(backup_dir=".", keep_fast=DEFAULT_KEEP_FAST, codec=DEFAULT_COLD_CODEC, level=None, threads=1, cold_dir=None, database=None, catalog_path=None, time_budget=None, dry_run=False):
+    """Moves every database's backups beyond the newest `keep_fast` to the cold tier.
+
+    The cold tier is `codec` (recompressed, see recompress_archive) and/or
+    `cold_dir` (moved, see move_archive). Archives are handled oldest
+    first, one at a time; with `time_budget` (seconds) no new archive is
+    started once it is spent. An archive whose checksums do not match is
+    left alone and reported. Returns one result dict per archive considered.
+    """
+    if not codec and not cold_dir:
+        raise ValueError("Give a codec to recompress with and/or a cold directory to move archives to.")
+    if codec:
+        archive_codecs.check_codec_available(codec)
+    if cold_dir and not dry_run:
+        os.makedirs(cold_dir, exist_ok=True)
+
+    catalog = backup_catalog.BackupCatalog(catalog_path or backup_catalog.default_catalog_path(backup_dir), backup_dir)
+    databases = [database] if database else sorted({b["database"] for b in catalog.list_backups()})
+    candidates = []
+    for db in databases:
+        candidates += catalog.list_backups(db)[keep_fast:]
+    candidates.sort(key=lambda b: b["created_at"])
+
+    deadline = time.monotonic() + time_budget if time_budget else None
+    results = []
+    for entry in candidates:
+        action, reason = plan_entry(entry, codec, cold_dir)
+        result = {"path": entry["path"], "database": entry["database"], "action": action}
+        if action is None:
+            result.update(status="unchanged", reason=reason)
+            results.append(result)
+            continue
+        if deadline is not None and time.monotonic() >= deadline:
+            result["status"] = "skipped"
+            results.append(result)
+            continue
+        if dry_run:
+            print(f"[DRY-RUN] Would {action} {entry['path']}" + (f" to {codec}" if action == "recompress" else "") + (f" into {cold_dir}" if cold_dir else ""))
+            result["status"] = "planned"
+            results.append(result)
+            continue
+
+        started = time.perf_counter()
+        old_size = os.path.getsize(entry["path"])
+        try:
+            if action == "recompress":
+                new_path = recompress_archive(entry, catalog, codec, level=level, threads=threads, dest_dir=cold_dir)
+            else:
+                new_path = move_archive(entry, catalog, cold_dir)
+        except Exception as e:
+            result.update(status="failed", error=f"{type(e).__name__}: {e}")
+            msg = f"Could not {action} {entry['path']}: {result['error']}"
+            print(msg)
+            logging.error(msg)
+        else:
+            result.update(status="done", new_path=new_path, old_size=old_size, new_size=os.path.getsize(new_path), seconds=round(time.perf_counter() - started, 3))
+            msg = f"Tiered {entry['path']} -> {new_path} ({old_size / 1e6:.1f} MB -> {result['new_size'] / 1e6:.1f} MB in {result['seconds']}s)"
+            print(msg)
+            logging.info(msg)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompress older backup archives with a high-ratio codec and/or move them to a cold directory.")
+    parser.add_argument("--backup-dir", default='.', help="Directory the backups were written to (its catalog lists every tier)")
+    parser.add_argument("--catalog", help="Path to the backup catalog (default: <backup-dir>/backup_catalog.db)")
+    parser.add_argument("--keep-fast", type=int, default=DEFAULT_KEEP_FAST, help="Newest backups of each database left as they were written")
+    parser.add_argument("--codec", choices=archive_codecs.CODECS, default=DEFAULT_COLD_CODEC, help="Codec older archives are recompressed with")
+    parser.add_argument("--no-recompress", action="store_true", help="Only move archives to --cold-dir, keeping their codec")
+    parser.add_argument("--compress-level", type=int, help="Compression level for --codec (codec default if omitted)")
+    parser.add_argument("--compress-threads", type=int, default=1, help="Compression threads (gzip and zstd only)")
+    parser.add_argument("--cold-dir", help="Move older archives (with their digest files) into this directory")
+    parser.add_argument("--database", help="Only tier this database's backups")
+    parser.add_argument("--time-budget", type=float, help="Start no new archive after this many seconds; the oldest archives go first")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would be recompressed or moved without changing anything")
+
+    args = parser.parse_args()
+
+    # Configure logging for CLI usage
+    logging.basicConfig(
+        filename='archive_tiers.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    results = tier_archives(args.backup_dir, keep_fast=args.keep_fast, codec=None if args.no_recompress else args.codec, level=args.compress_level, threads=args.compress_threads, cold_dir=args.cold_dir, database=args.database, catalog_path=args.catalog, time_budget=args.time_budget, dry_run=args.dry_run)
+    done = [r for r in results if r["status"] == "done"]
+    failed = [r for r in results if r["status"] == "failed"]
+    skipped = [r for r in results if r["status"] == "skipped"]
+    saved = sum(r["old_size"] - r["new_size"] for r in done)
+    print(f"{len(done)} archive(s) tiered, {saved / 1e6:.1f} MB saved; {len(failed)} failed, {len(skipped)} left for the next run")
+    sys.exit(1 if failed else 0)
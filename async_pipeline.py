@@ -0,0 +1,271 @@
+import io
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+import subprocess
+import tempfile
+
+# Logging is configured in the main block or by the importing application
+
+# Blocks that may wait between two stages. A full queue stops the stage
+# before it, and in the end the process feeding the pipeline, until the
+# slower stage catches up
+DEFAULT_QUEUE_SIZE = 4
+
+# Size of the blocks read from a process's stdout
+CHUNK_SIZE = 1024 * 1024
+
+# Marks the end of the stream on a stage's input queue
+_END = object()
+
+
+async def to_thread(func, *args, **kwargs):
+    """Runs a blocking call on the event loop's default thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+@contextlib.asynccontextmanager
+async def in_thread(cm):
+    """Enters and exits a blocking context manager on the thread pool.
+
+    An error inside the block reaches cm.__exit__ as usual (e.g. so a
+    storage stream discards a half-written object).
+    """
+    value = await to_thread(cm.__enter__)
+    try:
+        yield value
+    except BaseException as e:
+        if not await to_thread(cm.__exit__, type(e), e, e.__traceback__):
+            raise
+    else:
+        await to_thread(cm.__exit__, None, None, None)
+
+
+async def run_command(cmd, env=None):
+    """Runs a command to completion without blocking the event loop.
+
+    Like subprocess.run(cmd, check=True, capture_output=True): returns a
+    CompletedProcess, or raises CalledProcessError carrying stderr. The
+    process is killed if the calling task is cancelled.
+    """
+    proc = await asyncio.create_subprocess_exec(*cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await proc.communicate()
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+async def run_all(coros):
+    """Runs coroutines concurrently and returns their results in order.
+
+    Unlike a bare asyncio.gather, the first failure (or cancelling the
+    caller) cancels the others and waits for them to finish their cleanup
+    before the error is raised, so no process outlives the call.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def process_output(cmd, env=None, chunk_size=CHUNK_SIZE, stats=None):
+    """Async iterator over a command's stdout in blocks of chunk_size bytes.
+
+    stderr goes to a spooled temp file so a chatty process never blocks on
+    a full pipe. Once stdout ends, a non-zero exit status raises
+    CalledProcessError with that stderr. If the iterator is closed early
+    the process is killed. The time spent waiting for output is added to
+    stats["read_seconds"].
+    """
+    read_seconds = 0.0
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = await asyncio.create_subprocess_exec(*cmd, env=env, stdout=subprocess.PIPE, stderr=stderr_file, limit=chunk_size)
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    chunk = await proc.stdout.readexactly(chunk_size)
+                except asyncio.IncompleteReadError as e:
+                    # The last, short block
+                    chunk = e.partial
+                read_seconds += time.perf_counter() - t0
+                if not chunk:
+                    break
+                yield chunk
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+            # Read to the end so the pipe closes and the process can be reaped
+            await proc.stdout.read()
+            raise
+        finally:
+            returncode = await proc.wait()
+            if stats is not None:
+                stats["read_seconds"] = stats.get("read_seconds", 0.0) + read_seconds
+
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr_file.read())
+
+
+async def file_blocks(fileobj, chunk_size=CHUNK_SIZE, stats=None):
+    """Async iterator over a blocking file object's content, read on the thread pool.
+
+    Used for readers that decompress as they are read (archive_codecs),
+    so decompression overlaps with the stages fed by it. The time spent
+    reading is added to stats["read_seconds"].
+    """
+    read_seconds = 0.0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            chunk = await to_thread(fileobj.read, chunk_size)
+            read_seconds += time.perf_counter() - t0
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if stats is not None:
+            stats["read_seconds"] = stats.get("read_seconds", 0.0) + read_seconds
+
+
+class ChunkSink(io.RawIOBase):
+    """Non-seekable file object collecting what a writer produces, handed on by take().
+
+    Lets a writer that compresses into a file (a codec writer, a zip) run
+    as a pipeline stage: after each block its output is taken and queued
+    for the next stage. Like archive_digests.HashingWriter it is not
+    seekable, so zipfile writes through it sequentially.
+    """
+
+    def __init__(self, name=None):
+        # gzip records the file name in its header
+        self.name = name
+        self.bytes_written = 0
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        self._buffer += data
+        n = len(data)
+        self.bytes_written += n
+        return n
+
+    def take(self):
+        """Returns and clears what was written since the last call."""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+class Stage:
+    """One step of a pipeline, run on the thread pool one block at a time.
+
+    `process(chunk)` returns the bytes to pass on to the next stage (None
+    or b"" for nothing yet). `finish()` runs once after the last block and
+    may return final bytes, e.g. a compressor's trailer; `abort(error)`
+    runs instead when the pipeline fails. busy_seconds is the time spent
+    inside the stage, waiting on neither of its neighbours.
+    """
+
+    def __init__(self, name, process, finish=None, abort=None):
+        self.name = name
+        self.process = process
+        self.finish = finish
+        self.abort = abort
+        self.busy_seconds = 0.0
+        self.bytes_in = 0
+        self._running = None
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self._running = loop.run_in_executor(None, func, *args)
+        try:
+            # Shielded so a cancelled pipeline can still wait for the blocking call to return
+            return await asyncio.shield(self._running)
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+
+
+async def run_pipeline(source, stages, queue_size=DEFAULT_QUEUE_SIZE):
+    """Runs an async iterator of byte blocks through stages joined by bounded queues.
+
+    All stages run concurrently, each handling its blocks in order. If the
+    source or any stage fails (or the calling task is cancelled), the rest
+    is cancelled, every stage's abort() is called once its running block
+    has returned, and the error is raised. Returns the number of bytes the
+    source produced.
+    """
+    queues = [asyncio.Queue(queue_size) for _ in stages]
+    total = 0
+
+    async def feed():
+        nonlocal total
+        try:
+            async for chunk in source:
+                total += len(chunk)
+                await queues[0].put(chunk)
+        finally:
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        await queues[0].put(_END)
+
+    async def work(i, stage):
+        out = queues[i + 1] if i + 1 < len(queues) else None
+        while True:
+            chunk = await queues[i].get()
+            if chunk is _END:
+                data = await stage.call(stage.finish) if stage.finish is not None else None
+                if out is not None:
+                    if data:
+                        await out.put(data)
+                    await out.put(_END)
+                return
+            stage.bytes_in += len(chunk)
+            data = await stage.call(stage.process, chunk)
+            if data and out is not None:
+                await out.put(data)
+
+    tasks = [asyncio.ensure_future(feed())] + [asyncio.ensure_future(work(i, stage)) for i, stage in enumerate(stages)]
+    gathered = asyncio.gather(*tasks)
+    try:
+        # Shielded so that cancelling the caller leaves each task to be cancelled
+        # once below; a second cancel would interrupt its cleanup (e.g. reaping pg_dump)
+        await asyncio.shield(gathered)
+    except BaseException as e:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if gathered.done() and not gathered.cancelled():
+            # Already raised as `e` (or superseded by the cancellation)
+            gathered.exception()
+        running = [stage._running for stage in stages if stage._running is not None]
+        await asyncio.gather(*running, return_exceptions=True)
+        for stage in stages:
+            if stage.abort is not None:
+                try:
+                    await to_thread(stage.abort, e)
+                except Exception as abort_error:
+                    logging.warning(f"Pipeline stage '{stage.name}' failed to clean up: {abort_error}")
+        raise
+    return total
@@ -0,0 +1,289 @@
+import argparse
+import os
+import re
+import sqlite3
+import hashlib
+import datetime
+import logging
+import contextlib
+
+import archive_codecs
+import storage_backends
+
+# Logging is configured in the main block or by the importing application
+
+# Default catalog file name, created inside the backup directory
+CATALOG_FILENAME = "backup_catalog.db"
+
+# Archive names written by backup_postgres: <database>_<YYYYmmdd_HHMMSS><extension>
+ARCHIVE_NAME_RE = re.compile(r"^(?P<database>.+)_(?P<timestamp>\d{8}_\d{6})(?P<extension>\.zip|\.manifest|\.(?:sql|tar)\.[a-z0-9]+)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    database TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    size INTEGER,
+    codec TEXT,
+    dump_format TEXT,
+    checksum TEXT,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS backups_database_created ON backups (database, created_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+COLUMNS = ("id", "database", "path", "created_at", "size", "codec", "dump_format", "checksum", "duration")
+
+
+def default_catalog_path(backup_dir="."):
+    """Returns the catalog location used when none is given explicitly."""
+    return os.path.join(backup_dir, CATALOG_FILENAME)
+
+
+def parse_archive_name(filename):
+    """Returns (database, datetime) for a backup archive name, or None if it is not one."""
+    m = ARCHIVE_NAME_RE.match(os.path.basename(filename))
+    if not m or not archive_codecs.is_archive(filename):
+        return None
+    try:
+        created = datetime.datetime.strptime(m.group("timestamp"), "%Y%m%d_%H%M%S")
+    except ValueError:
+        # Looks like an archive name but the timestamp is not a valid date
+        return None
+    return m.group("database"), created
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BackupCatalog:
+    """SQLite index of the archives in a backup directory.
+
+    Paths are stored relative to the catalog's directory when possible so the
+    catalog stays valid if the whole backup directory is moved or mounted
+    elsewhere; archives in object storage are stored by their URL. A
+    catalog created next to existing archives imports them once, using the
+    timestamp in their file name rather than their mtime.
+    `backup_dir` is the directory scanned for that import (default: the
+    catalog's own directory).
+    """
+
+    def __init__(self, catalog_path, backup_dir=None):
+        self.catalog_path = catalog_path
+        self.base_dir = os.path.dirname(os.path.abspath(catalog_path))
+        os.makedirs(self.base_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            imported = conn.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone()
+        if not imported:
+            self.rescan(backup_dir, initial=True)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps the catalog usable from worker threads
+        conn = sqlite3.connect(self.catalog_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _stored_path(self, path):
+        if storage_backends.is_url(path):
+            return path
+        path = os.path.abspath(path)
+        try:
+            rel = os.path.relpath(path, self.base_dir)
+        except ValueError:
+            # Different drive on Windows
+            return path
+        return path if rel.startswith(os.pardir) else rel
+
+    def _resolve_path(self, stored):
+        if storage_backends.is_url(stored) or os.path.isabs(stored):
+            return stored
+        return os.path.join(self.base_dir, stored)
+
+    def _row(self, row):
+        record = dict(zip(COLUMNS, tuple(row)))
+        record["path"] = self._resolve_path(record["path"])
+        return record
+
+    def record_backup(self, database, path, created_at=None, size=None, codec=None, dump_format=None, checksum=None, duration=None):
+        """Adds (or replaces) the catalog entry for an archive."""
+        if created_at is None:
+            created_at = os.path.getmtime(path)
+        if size is None and os.path.exists(path):
+            size = os.path.getsize(path)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO backups (database, path, created_at, size, codec, dump_format, checksum, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (database, self._stored_path(path), created_at, size, codec, dump_format, checksum, duration),
+            )
+        logging.info(f"Catalogued backup {path} for database '{database}'")
+
+    def remove(self, path):
+        """Removes the catalog entry for an archive."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM backups WHERE path = ?", (self._stored_path(path),))
+
+    def move(self, old_path, new_path, size=None, codec=None, checksum=None):
+        """Points an entry at its archive's new location, e.g. after recompressing it.
+
+        The creation time, format and duration are kept, so retention
+        treats the archive as the same backup. Returns False if there is no
+        entry for old_path (e.g. retention removed it meanwhile).
+        """
+        with self._connect() as conn:
+            moved = conn.execute(
+                "UPDATE backups SET path = ?, size = COALESCE(?, size), codec = COALESCE(?, codec), checksum = COALESCE(?, checksum) WHERE path = ?",
+                (self._stored_path(new_path), size, codec, checksum, self._stored_path(old_path)),
+            ).rowcount > 0
+        if moved:
+            logging.info(f"Catalogued move of backup {old_path} to {new_path}")
+        return moved
+
+    def list_backups(self, database=None):
+        """Returns catalog entries, newest first, optionally for one database."""
+        with self._connect() as conn:
+            if database is None:
+                rows = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM backups ORDER BY created_at DESC").fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM backups WHERE database = ? ORDER BY created_at DESC",
+                    (database,),
+                ).fetchall()
+        return [self._row(r) for r in rows]
+
+    def latest_backup(self, database):
+        """Returns the newest entry for a database, or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM backups WHERE database = ? ORDER BY created_at DESC LIMIT 1",
+                (database,),
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def rescan(self, directory=None, storage=None, initial=False):
+        """Imports archives found in a directory that are not catalogued yet.
+
+        With `storage` (a storage_backends backend) its objects are listed
+        instead of the directory. Returns the number of entries added.
+        Several processes may open a new catalog at once: the entries are
+        written under the database's write lock, and with initial=True
+        nothing is imported if another process already did.
+        """
+        storage = storage or storage_backends.LocalBackend(directory or self.base_dir)
+        with self._connect() as conn:
+            known = {r[0] for r in conn.execute("SELECT path FROM backups")}
+        # Listed (and remote headers skipped, local ones read) before taking the lock
+        found = []
+        for obj in storage.list():
+            path = storage.url(obj.name)
+            parsed = parse_archive_name(obj.name)
+            if not parsed or self._stored_path(path) in known:
+                continue
+            database, created = parsed
+            # Remote archives are not downloaded just to read their header
+            codec = archive_codecs.codec_from_extension(obj.name) if storage_backends.is_url(path) else archive_codecs.detect_codec(path)
+            found.append((database, self._stored_path(path), created.timestamp(), obj.size, codec))
+        added = 0
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if initial and conn.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone():
+                return 0
+            for row in found:
+                # An archive catalogued meanwhile (e.g. by a backup that just finished) keeps its entry
+                added += conn.execute(
+                    "INSERT OR IGNORE INTO backups (database, path, created_at, size, codec) VALUES (?, ?, ?, ?, ?)",
+                    row,
+                ).rowcount
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)", (datetime.datetime.now().isoformat(),))
+        if added:
+            logging.info(f"Imported {added} existing archive(s) from {storage.url('')} into the catalog")
+        return added
+
+
+def select_expired(backups, now=None, retention_days=30, keep_daily=0, keep_weekly=0, keep_monthly=0, keep_yearly=0):
+    """Returns the catalog entries that a retention policy would delete.
+
+    With no keep_* count the policy is the flat `retention_days` cutoff.
+    Otherwise a grandfather-father-son policy applies: the newest backup of
+    each of the last `keep_daily` days, `keep_weekly` ISO weeks,
+    `keep_monthly` months and `keep_yearly` years is kept and everything else
+    expires (retention_days is then ignored).
+    """
+    now = now if now is not None else datetime.datetime.now().timestamp()
+    backups = sorted(backups, key=lambda b: b["created_at"], reverse=True)
+
+    if not any((keep_daily, keep_weekly, keep_monthly, keep_yearly)):
+        cutoff = now - (retention_days * 86400)
+        return [b for b in backups if b["created_at"] < cutoff]
+
+    buckets = (
+        (keep_daily, lambda d: d.date()),
+        (keep_weekly, lambda d: d.isocalendar()[:2]),
+        (keep_monthly, lambda d: (d.year, d.month)),
+        (keep_yearly, lambda d: d.year),
+    )
+    keep = set()
+    for count, bucket_of in buckets:
+        seen = set()
+        for b in backups:
+            if len(seen) >= count:
+                break
+            bucket = bucket_of(datetime.datetime.fromtimestamp(b["created_at"]))
+            if bucket not in seen:
+                seen.add(bucket)
+                keep.add(b["path"])
+    return [b for b in backups if b["path"] not in keep]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the backup catalog of a backup directory.")
+    parser.add_argument("--backup-dir", default='.', help="Directory containing the backups")
+    parser.add_argument("--catalog", help="Path to the catalog file (default: <backup-dir>/backup_catalog.db)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = sub.add_parser("list", help="List catalogued backups, newest first")
+    list_parser.add_argument("--database", help="Only list backups of this database")
+
+    latest_parser = sub.add_parser("latest", help="Print the path of the newest backup of a database")
+    latest_parser.add_argument("--database", required=True, help="Database name")
+
+    rescan_parser = sub.add_parser("rescan", help="Import archives in the backup directory that are not catalogued yet")
+    rescan_parser.add_argument("--storage-url", help="Import the archives in this storage location instead, e.g. s3://bucket/prefix")
+    rescan_parser.add_argument("--storage-endpoint", help="Endpoint of an S3-compatible service")
+
+    args = parser.parse_args()
+
+    catalog = BackupCatalog(args.catalog or default_catalog_path(args.backup_dir), backup_dir=args.backup_dir)
+    if args.command == "list":
+        for b in catalog.list_backups(args.database):
+            created = datetime.datetime.fromtimestamp(b["created_at"]).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{created}  {b['database']:<20} {b['size'] or 0:>14}  {b['codec'] or '-':<5} {b['path']}")
+    elif args.command == "latest":
+        latest = catalog.latest_backup(args.database)
+        if not latest:
+            print(f"No backups catalogued for database '{args.database}'.")
+            raise SystemExit(1)
+        print(latest["path"])
+    elif args.command == "rescan":
+        storage = storage_backends.open_backend(args.storage_url, endpoint_url=args.storage_endpoint) if args.storage_url else None
+        print(f"Imported {catalog.rescan(args.backup_dir, storage=storage)} archive(s).")
@@ -0,0 +1,535 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import asyncio
+import inspect
+import logging
+import argparse
+import datetime
+import threading
+import collections
+
+import archive_tiers
+import async_pipeline
+import backup_catalog
+import backup_postgres
+import restore_postgres
+import run_metrics
+
+# Logging is configured in the main block or by the importing application
+
+OPERATIONS = ("backup", "restore", "tier")
+
+# Address of the status endpoint; only local clients by default
+DEFAULT_STATUS_HOST = "127.0.0.1"
+DEFAULT_STATUS_PORT = 8765
+
+# Finished runs of each job kept in memory for the status endpoint
+DEFAULT_HISTORY = 20
+
+# Longest the scheduler sleeps, so a changed system clock is noticed
+MAX_SLEEP = 30.0
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# Keyword arguments the daemon passes itself; a job's options may not set them
+RESERVED_OPTIONS = ("host", "port", "database", "target_database", "username", "password", "zip_file", "auto_confirm", "on_event")
+
+
+class Job:
+    """One scheduled backup or restore of a database on a configured server.
+
+    A job runs every `every_minutes`, or at the local `at` times ("HH:MM")
+    on the given `weekdays` (every day by default). `options` are keyword
+    arguments of backup_postgres / restore_postgres. A restore job loads
+    `archive`, or the newest backup of `from_database` in the catalog of
+    `backup_dir` (or `catalog_path`). A "tier" job has no server or
+    database and runs archive_tiers.tier_archives with its options.
+    """
+
+    def __init__(self, name, operation, server, database, every_minutes=None, at=None, weekdays=None, run_at_start=False, options=None, archive=None, from_database=None, backup_dir=".", catalog_path=None):
+        self.name = name
+        self.operation = operation
+        self.server = server
+        self.database = database
+        self.every_minutes = every_minutes
+        self.at = [datetime.datetime.strptime(t, "%H:%M").time() for t in ([at] if isinstance(at, str) else at or [])]
+        self.weekdays = [WEEKDAYS.index(d.lower()[:3]) for d in weekdays or WEEKDAYS]
+        self.run_at_start = run_at_start
+        self.options = options or {}
+        self.archive = archive
+        self.from_database = from_database
+        self.backup_dir = backup_dir
+        self.catalog_path = catalog_path
+
+    @property
+    def key(self):
+        """The database (or, for a tier job, backup directory) the job works on; two jobs on it never run at once."""
+        if self.server is None:
+            return ("tier", os.path.abspath(self.options.get("backup_dir", ".")))
+        return (self.server["host"], self.server["port"], self.database)
+
+    def next_run(self, after, previous=None):
+        """Unix time of the first run due strictly after `after`.
+
+        Interval jobs keep their cadence from the `previous` due time, so a
+        skipped or late run does not shift the ones after it.
+        """
+        if self.every_minutes:
+            interval = self.every_minutes * 60
+            due = previous + interval if previous is not None else after + interval
+            while due <= after:
+                due += interval
+            return due
+        start = datetime.datetime.fromtimestamp(after)
+        for offset in range(8):
+            day = start.date() + datetime.timedelta(days=offset)
+            if day.weekday() not in self.weekdays:
+                continue
+            for t in sorted(self.at):
+                due = datetime.datetime.combine(day, t).timestamp()
+                if due > after:
+                    return due
+        return None
+
+    def to_dict(self):
+        schedule = {"every_minutes": self.every_minutes} if self.every_minutes else {"at": [t.strftime("%H:%M") for t in self.at], "weekdays": [WEEKDAYS[d] for d in self.weekdays]}
+        server = self.server or {"name": None, "host": None, "port": None}
+        return dict(name=self.name, operation=self.operation, server=server["name"], host=server["host"], port=server["port"], database=self.database, **schedule)
+
+
+def load_schedule(path):
+    """Reads and checks a JSON schedule file; returns (settings, servers, jobs).
+
+    Mistakes (an unknown server or option, a job without a schedule, a
+    missing password variable) raise ValueError naming the job, so the
+    daemon refuses to start rather than failing at 2 a.m.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    settings = {
+        "max_workers": config.get("max_workers", 4),
+        "max_per_host": config.get("max_per_host", 2),
+        "status_host": config.get("status_host", DEFAULT_STATUS_HOST),
+        "status_port": config.get("status_port", DEFAULT_STATUS_PORT),
+        "history": config.get("history", DEFAULT_HISTORY),
+    }
+
+    servers = {}
+    for name, s in config.get("servers", {}).items():
+        if "host" not in s or "username" not in s:
+            raise ValueError(f"Server '{name}' needs a host and a username.")
+        if s.get("password_env"):
+            if s["password_env"] not in os.environ:
+                raise ValueError(f"Server '{name}': environment variable {s['password_env']} is not set.")
+            password = os.environ[s["password_env"]]
+        else:
+            # Empty: libpq falls back to the password file (~/.pgpass)
+            password = s.get("password", "")
+        servers[name] = {
+            "name": name,
+            "host": s["host"],
+            "port": int(s.get("port", 5432)),
+            "username": s["username"],
+            "password": password,
+            "bin_dir": s.get("bin_dir"),
+            "max_concurrent": s.get("max_concurrent", settings["max_per_host"]),
+        }
+
+    defaults = config.get("defaults", {})
+    accepted = {
+        "backup": set(inspect.signature(backup_postgres.backup_postgres_async).parameters) - set(RESERVED_OPTIONS),
+        "restore": set(inspect.signature(restore_postgres.restore_postgres_async).parameters) - set(RESERVED_OPTIONS),
+        "tier": set(inspect.signature(archive_tiers.tier_archives).parameters),
+    }
+    jobs = []
+    for j in config.get("jobs", []):
+        name = j.get("name") or f"{j.get('operation', 'backup')}-{j.get('database', 'archives')}"
+        operation = j.get("operation", "backup")
+        if operation not in OPERATIONS:
+            raise ValueError(f"Job '{name}': operation must be one of {', '.join(OPERATIONS)}.")
+        if operation != "tier" and j.get("server") not in servers:
+            raise ValueError(f"Job '{name}': unknown server '{j.get('server')}'.")
+        if operation != "tier" and not j.get("database"):
+            raise ValueError(f"Job '{name}' needs a database.")
+        if bool(j.get("every_minutes")) == bool(j.get("at")):
+            raise ValueError(f"Job '{name}' needs either every_minutes or at.")
+        if operation == "restore" and bool(j.get("archive")) == bool(j.get("from_database")):
+            raise ValueError(f"Restore job '{name}' needs either archive or from_database.")
+        if any(job.name == name for job in jobs):
+            raise ValueError(f"Job name '{name}' is used twice.")
+        options = dict(defaults.get(operation, {}), **j.get("options", {}))
+        unknown = set(options) - accepted[operation]
+        if unknown:
+            raise ValueError(f"Job '{name}': unknown {operation} option(s) {', '.join(sorted(unknown))}.")
+        server = servers[j["server"]] if operation != "tier" else None
+        if server is not None:
+            options.setdefault("bin_dir", server["bin_dir"])
+        try:
+            job = Job(name, operation, server, j.get("database"), every_minutes=j.get("every_minutes"), at=j.get("at"), weekdays=j.get("weekdays"), run_at_start=j.get("run_at_start", False), options=options, archive=j.get("archive"), from_database=j.get("from_database"), backup_dir=j.get("backup_dir", "."), catalog_path=j.get("catalog_path"))
+        except ValueError as e:
+            raise ValueError(f"Job '{name}': {e}")
+        jobs.append(job)
+    if not jobs:
+        raise ValueError(f"No jobs in schedule file {path}.")
+    return settings, servers, jobs
+
+
+def check_binaries(jobs):
+    """Resolves every client binary the jobs need once, at start-up."""
+    needed = {"backup": ("pg_dump",), "restore": ("psql", "createdb", "dropdb")}
+    for job in jobs:
+        for name in needed.get(job.operation, ()):
+            path = backup_postgres.get_bin(name, job.options.get("bin_dir"))
+            if shutil.which(path) is None:
+                msg = f"Job '{job.name}': '{path}' not found. Please install PostgreSQL tools or check the bin path."
+                logging.error(msg)
+                raise EnvironmentError(msg)
+
+
+class DaemonState:
+    """In-memory state of every job: what is queued or running, recent runs and counters.
+
+    Updated from the event loop and, through progress events, from worker
+    threads, so every access holds a lock. Nothing survives a restart; the
+    backup catalog and run metrics files are the durable record.
+    """
+
+    def __init__(self, jobs, history=DEFAULT_HISTORY):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.jobs = {
+            job.name: {
+                "job": job.to_dict(),
+                "state": "idle",
+                "next_run": None,
+                "current": None,
+                "runs": collections.deque(maxlen=history),
+                "counts": {"success": 0, "failed": 0, "cancelled": 0, "skipped": 0},
+            }
+            for job in jobs
+        }
+
+    def scheduled(self, job, next_run):
+        with self._lock:
+            self.jobs[job.name]["next_run"] = next_run
+
+    def is_idle(self, job):
+        with self._lock:
+            return self.jobs[job.name]["state"] == "idle"
+
+    def is_queued(self, job):
+        with self._lock:
+            return self.jobs[job.name]["state"] == "queued"
+
+    def queued(self, job):
+        with self._lock:
+            entry = self.jobs[job.name]
+            entry["state"] = "queued"
+            entry["current"] = {"queued_at": round(time.time(), 3), "started_at": None, "phases": [], "bytes_done": None, "bytes_expected": None}
+
+    def started(self, job):
+        with self._lock:
+            entry = self.jobs[job.name]
+            entry["state"] = "running"
+            entry["current"]["started_at"] = round(time.time(), 3)
+
+    def event(self, job, event):
+        """Follows a running job's progress events: open phases and bytes so far."""
+        with self._lock:
+            current = self.jobs[job.name]["current"]
+            if current is None:
+                return
+            if event["event"] == "phase_start":
+                current["phases"].append(event["phase"])
+            elif event["event"] == "phase_end" and event["phase"] in current["phases"]:
+                current["phases"].remove(event["phase"])
+            elif event["event"] == "progress":
+                current["bytes_done"] = event["bytes_done"]
+                current["bytes_expected"] = event.get("bytes_expected")
+
+    def finished(self, job, run):
+        with self._lock:
+            entry = self.jobs[job.name]
+            entry["state"] = "idle"
+            entry["current"] = None
+            entry["runs"].appendleft(run)
+            entry["counts"][run["status"]] += 1
+
+    def skipped(self, job, reason):
+        with self._lock:
+            entry = self.jobs[job.name]
+            entry["counts"]["skipped"] += 1
+            entry["runs"].appendleft({"status": "skipped", "started_at": round(time.time(), 3), "reason": reason})
+
+    def snapshot(self):
+        """The whole state as a JSON-serialisable dict, newest runs first."""
+        with self._lock:
+            return {
+                "started_at": round(self.started_at, 3),
+                "running": sum(1 for e in self.jobs.values() if e["state"] == "running"),
+                "queued": sum(1 for e in self.jobs.values() if e["state"] == "queued"),
+                "jobs": [
+                    dict(e["job"], state=e["state"], next_run=e["next_run"], current=dict(e["current"], phases=list(e["current"]["phases"])) if e["current"] else None, runs=list(e["runs"]), counts=dict(e["counts"]))
+                    for e in self.jobs.values()
+                ],
+            }
+
+    def prometheus_text(self):
+        """The state as Prometheus metrics, for the /metrics endpoint."""
+        status = self.snapshot()
+        jobs = status["jobs"]
+        labels = [{k: v for k, v in (("job", j["name"]), ("operation", j["operation"]), ("database", j["database"]), ("host", j["host"]), ("port", j["port"])) if v is not None} for j in jobs]
+        lines = []
+        lines += run_metrics.metric_lines("daemon_start_timestamp_seconds", "Unix time the daemon started", [({}, status["started_at"])])
+        lines += run_metrics.metric_lines("daemon_jobs_running", "Jobs running now", [({}, status["running"])])
+        lines += run_metrics.metric_lines("daemon_jobs_queued", "Jobs waiting for a worker or server slot", [({}, status["queued"])])
+        lines += run_metrics.metric_lines("daemon_job_runs_total", "Runs of each job since the daemon started, by outcome", [(dict(l, status=s), n) for j, l in zip(jobs, labels) for s, n in j["counts"].items()], metric_type="counter")
+        lines += run_metrics.metric_lines("daemon_job_running", "1 while the job is running", [(l, 1 if j["state"] == "running" else 0) for j, l in zip(jobs, labels)])
+        lines += run_metrics.metric_lines("daemon_job_next_run_timestamp_seconds", "Unix time the job is due next", [(l, j["next_run"]) for j, l in zip(jobs, labels) if j["next_run"]])
+        last = [(l, next((r for r in j["runs"] if r["status"] != "skipped"), None)) for j, l in zip(jobs, labels)]
+        last = [(l, r) for l, r in last if r is not None]
+        lines += run_metrics.metric_lines("daemon_job_last_run_success", "1 if the job's last run succeeded, 0 otherwise", [(l, 1 if r["status"] == "success" else 0) for l, r in last])
+        lines += run_metrics.metric_lines("daemon_job_last_run_timestamp_seconds", "Unix time the job's last run finished", [(l, r["finished_at"]) for l, r in last])
+        lines += run_metrics.metric_lines("daemon_job_last_run_duration_seconds", "Wall time of the job's last run", [(l, r["duration_seconds"]) for l, r in last])
+        return "\n".join(lines) + "\n"
+
+
+class BackupDaemon:
+    """Runs scheduled jobs in one event loop until stopped.
+
+    At most `max_workers` jobs run at once, and at most each server's
+    max_concurrent against that server. A job that is due while its
+    previous run, or another job on the same database, is still queued or
+    running is skipped rather than piled up. Status and metrics are served
+    over HTTP on status_host:status_port (see serve_status).
+    """
+
+    def __init__(self, settings, servers, jobs):
+        self.settings = settings
+        self.jobs = jobs
+        self.state = DaemonState(jobs, settings["history"])
+        self.workers = asyncio.Semaphore(settings["max_workers"])
+        self.server_limits = {name: asyncio.Semaphore(s["max_concurrent"]) for name, s in servers.items()}
+        # Tier jobs run one at a time; they read and write the backup disks, not a server
+        self.server_limits[None] = asyncio.Semaphore(1)
+        self.busy = {}
+        self.tasks = {}
+        self._stopping = None
+
+    def stop(self):
+        """Stops scheduling and drops queued jobs; a second call also cancels the running ones."""
+        if self._stopping.is_set():
+            logging.warning("Cancelling running jobs")
+            for task in self.tasks.values():
+                task.cancel()
+            return
+        print("Stopping: no new jobs will start; waiting for the running ones (stop again to cancel them)")
+        logging.info("Daemon stopping; waiting for running jobs")
+        self._stopping.set()
+        for job in self.jobs:
+            if job.name in self.tasks and self.state.is_queued(job):
+                self.tasks[job.name].cancel()
+
+    def dispatch(self, job):
+        """Starts a due job unless it would overlap a queued or running one."""
+        if not self.state.is_idle(job):
+            reason = "previous run still running"
+        elif job.key in self.busy:
+            reason = f"job '{self.busy[job.key]}' is using the database"
+        else:
+            self.busy[job.key] = job.name
+            self.state.queued(job)
+            task = asyncio.ensure_future(self.run_job(job))
+            self.tasks[job.name] = task
+            task.add_done_callback(lambda _task: self.tasks.pop(job.name, None))
+            return True
+        msg = f"Skipping job '{job.name}': {reason}"
+        print(msg)
+        logging.warning(msg)
+        self.state.skipped(job, reason)
+        return False
+
+    async def run_job(self, job):
+        """Runs one job in its server and worker slots and records the outcome."""
+        server = job.server
+        run = {"status": "failed", "started_at": None, "finished_at": None, "duration_seconds": None}
+        open_phases = []
+
+        def on_event(event):
+            if event["event"] == "phase_start":
+                open_phases.append(event["phase"])
+            elif event["event"] == "phase_end" and event["phase"] in open_phases:
+                open_phases.remove(event["phase"])
+            self.state.event(job, event)
+
+        try:
+            # The server slot first, so a job waiting on a busy server holds no worker
+            async with self.server_limits[server["name"] if server else None], self.workers:
+                self.state.started(job)
+                started = time.time()
+                run["started_at"] = round(started, 3)
+                logging.info(f"Starting job '{job.name}'")
+                try:
+                    if job.operation == "tier":
+                        results = await async_pipeline.to_thread(archive_tiers.tier_archives, **job.options)
+                        run["tiered"] = sum(1 for r in results if r["status"] == "done")
+                        failed = sum(1 for r in results if r["status"] == "failed")
+                        if failed:
+                            raise RuntimeError(f"{failed} archive(s) could not be tiered")
+                    elif job.operation == "backup":
+                        run["archive"] = await backup_postgres.backup_postgres_async(server["host"], server["port"], job.database, server["username"], server["password"], on_event=on_event, **job.options)
+                    else:
+                        archive = job.archive or await async_pipeline.to_thread(self.latest_archive, job)
+                        run["archive"] = archive
+                        await restore_postgres.restore_postgres_async(server["host"], server["port"], job.database, server["username"], server["password"], archive, auto_confirm=True, on_event=on_event, **job.options)
+                    run["status"] = "success"
+                except Exception as e:
+                    run["error"] = str(e)
+                    # Overlapping streamed phases fail together; name the first one
+                    run["phase"] = open_phases[0] if open_phases else None
+                finally:
+                    run["finished_at"] = round(time.time(), 3)
+                    run["duration_seconds"] = round(run["finished_at"] - started, 3)
+        except asyncio.CancelledError:
+            run["status"] = "cancelled"
+            raise
+        finally:
+            del self.busy[job.key]
+            self.state.finished(job, run)
+            line = f"Job '{job.name}': {run['status']}"
+            if run["duration_seconds"] is not None:
+                line += f" in {run['duration_seconds']}s"
+            if run.get("error"):
+                line += f" during {run['phase']} ({run['error']})" if run.get("phase") else f" ({run['error']})"
+            print(line)
+            if run["status"] == "success":
+                logging.info(line)
+            else:
+                logging.error(line)
+
+    def latest_archive(self, job):
+        """Newest catalogued backup of a restore job's from_database."""
+        catalog = backup_catalog.BackupCatalog(job.catalog_path or backup_catalog.default_catalog_path(job.backup_dir), job.backup_dir)
+        entry = catalog.latest_backup(job.from_database)
+        if entry is None:
+            raise FileNotFoundError(f"No catalogued backup of database '{job.from_database}' in {job.backup_dir}")
+        return entry["path"]
+
+    async def handle_status(self, reader, writer):
+        """Answers one HTTP request: GET /status (JSON), /metrics (Prometheus) or /health."""
+        try:
+            request = await reader.readline()
+            # Skip the headers; nothing here needs them
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            method, path = (parts[0], parts[1].split("?", 1)[0]) if len(parts) >= 2 else ("", "")
+            if method != "GET":
+                code, content_type, body = "405 Method Not Allowed", "text/plain", "Only GET is supported\n"
+            elif path in ("/", "/status"):
+                code, content_type, body = "200 OK", "application/json", json.dumps(self.state.snapshot(), indent=2) + "\n"
+            elif path == "/metrics":
+                code, content_type, body = "200 OK", "text/plain; version=0.0.4", self.state.prometheus_text()
+            elif path == "/health":
+                code, content_type, body = "200 OK", "text/plain", "ok\n"
+            else:
+                code, content_type, body = "404 Not Found", "text/plain", "Not found\n"
+            data = body.encode("utf-8")
+            writer.write(f"HTTP/1.0 {code}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError) as e:
+            logging.warning(f"Status request failed: {e}")
+        finally:
+            writer.close()
+
+    async def run(self):
+        """Schedules jobs until stop() is called, then waits for the running ones."""
+        self._stopping = asyncio.Event()
+        server = None
+        if self.settings["status_port"]:
+            server = await asyncio.start_server(self.handle_status, self.settings["status_host"], self.settings["status_port"])
+            msg = f"Status endpoint listening on http://{self.settings['status_host']}:{self.settings['status_port']}/status"
+            print(msg)
+            logging.info(msg)
+
+        now = time.time()
+        due = {job.name: now if job.run_at_start else job.next_run(now) for job in self.jobs}
+        logging.info(f"Daemon started with {len(self.jobs)} job(s), {self.settings['max_workers']} worker(s)")
+        try:
+            while not self._stopping.is_set():
+                now = time.time()
+                for job in self.jobs:
+                    if due[job.name] is not None and due[job.name] <= now:
+                        self.dispatch(job)
+                        due[job.name] = job.next_run(now, due[job.name])
+                    self.state.scheduled(job, round(due[job.name], 3) if due[job.name] else None)
+                upcoming = [d for d in due.values() if d is not None]
+                wait = min(upcoming) - time.time() if upcoming else MAX_SLEEP
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), max(0.01, min(wait, MAX_SLEEP)))
+                except asyncio.TimeoutError:
+                    pass
+            while self.tasks:
+                await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        finally:
+            tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            logging.info("Daemon stopped")
+
+
+async def run_daemon(schedule_path, status_port=None):
+    """Loads a schedule file and runs the daemon until SIGINT or SIGTERM."""
+    settings, servers, jobs = load_schedule(schedule_path)
+    if status_port is not None:
+        settings["status_port"] = status_port
+    check_binaries(jobs)
+    daemon = BackupDaemon(settings, servers, jobs)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, daemon.stop)
+        except (NotImplementedError, AttributeError):
+            # Windows: Ctrl+C arrives as KeyboardInterrupt and cancels the running jobs
+            pass
+    await daemon.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run scheduled PostgreSQL backups and restores from a schedule file.")
+    parser.add_argument("--schedule", required=True, help="JSON schedule file with servers and jobs")
+    parser.add_argument("--status-port", type=int, help="Port of the HTTP status endpoint (overrides the schedule file; 0 disables it)")
+    parser.add_argument("--check", action="store_true", help="Check the schedule file, list the jobs with their next run and exit")
+
+    args = parser.parse_args()
+
+    # Configure logging for CLI usage
+    logging.basicConfig(
+        filename='backup_daemon.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    if args.check:
+        settings, servers, jobs = load_schedule(args.schedule)
+        check_binaries(jobs)
+        now = time.time()
+        for job in jobs:
+            next_run = now if job.run_at_start else job.next_run(now)
+            target = f"{job.database}@{job.server['host']}:{job.server['port']}" if job.server else job.options.get("backup_dir", ".")
+            print(f"{job.name}: {job.operation} {target}, next run {datetime.datetime.fromtimestamp(next_run):%Y-%m-%d %H:%M}" if next_run else f"{job.name}: never runs")
+        sys.exit(0)
+
+    try:
+        asyncio.run(run_daemon(args.schedule, args.status_port))
+    except KeyboardInterrupt:
+        pass
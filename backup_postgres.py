@@ -6,133 +6,1134 @@ import zipfile
 import sys
 import logging
 import time
-import glob
 import shutil
+import contextlib
 import getpass
+import tempfile
+import tarfile
+import asyncio
+import functools
+
+import archive_codecs
+import archive_digests
+import async_pipeline
+import backup_catalog
+import capacity_planner
+import chunk_store
+import incremental_backup
+import indexed_archive
+import parallel_export
+import physical_backup
+import progress_events
+import run_metrics
+import storage_backends
+import throttling
 
 # Logging is configured in the main block or by the importing application
 
+# Size of the blocks read from pg_dump's stdout and written to the archive
+CHUNK_SIZE = 1024 * 1024
+
+# pg_dump output formats supported inside the archive
+DUMP_FORMATS = ("plain", "directory", "incremental", "indexed", parallel_export.PARALLEL_FORMAT)
+
+
+def get_bin(name, bin_dir=None):
+    """Returns the path of a PostgreSQL client binary, honouring bin_dir."""
+    if not bin_dir:
+        return name
+    path = os.path.join(bin_dir, name)
+    if sys.platform == "win32" and not path.lower().endswith(".exe"):
+        path += ".exe"
+    return path
+
 
+def open_catalog(backup_dir=".", catalog_path=None):
+    """Opens the backup catalog for backup_dir (creating and populating it on first use)."""
+    return backup_catalog.BackupCatalog(catalog_path or backup_catalog.default_catalog_path(backup_dir), backup_dir=backup_dir)
 
-def cleanup_old_backups(database, retention_days=30, backup_dir="."):
-    """Deletes backup files older than retention_days in backup_dir."""
-    logging.info(f"Starting cleanup of backups older than {retention_days} days for database '{database}' in '{backup_dir}'...")
-    now = time.time()
-    cutoff = now - (retention_days * 86400)
 
-    pattern = os.path.join(backup_dir, f"{database}_*.zip")
-    files = glob.glob(pattern)
+def cleanup_old_backups(database, retention_days=30, backup_dir=".", catalog_path=None, keep_daily=0, keep_weekly=0, keep_monthly=0, keep_yearly=0, storage_options=None):
+    """Deletes expired backups of a database using the backup catalog.
+
+    By default backups older than retention_days are deleted. If any keep_*
+    count is given a grandfather-father-son policy is applied instead (see
+    backup_catalog.select_expired). Archives catalogued under a storage URL
+    are deleted through their storage backend, opened with storage_options
+    (see storage_backends.open_backend).
+    """
+    gfs = any((keep_daily, keep_weekly, keep_monthly, keep_yearly))
+    if gfs:
+        policy = f"daily={keep_daily}, weekly={keep_weekly}, monthly={keep_monthly}, yearly={keep_yearly}"
+        logging.info(f"Starting GFS cleanup ({policy}) for database '{database}' in '{backup_dir}'...")
+    else:
+        logging.info(f"Starting cleanup of backups older than {retention_days} days for database '{database}' in '{backup_dir}'...")
+
+    catalog = open_catalog(backup_dir, catalog_path)
+    stores_to_collect = set()
+    backups = catalog.list_backups(database)
+    expired = backup_catalog.select_expired(
+        backups,
+        retention_days=retention_days,
+        keep_daily=keep_daily,
+        keep_weekly=keep_weekly,
+        keep_monthly=keep_monthly,
+        keep_yearly=keep_yearly,
+    )
 
-    for f in files:
+    # Incremental archives read unchanged tables from older archives; keep those alive
+    expired_paths = {b["path"] for b in expired}
+    still_referenced = set()
+    for b in backups:
+        if b["dump_format"] == "incremental" and b["path"] not in expired_paths and not storage_backends.is_url(b["path"]) and os.path.exists(b["path"]):
+            archive_dir = os.path.dirname(os.path.abspath(b["path"]))
+            still_referenced |= {os.path.join(archive_dir, name) for name in incremental_backup.referenced_archives(b["path"])}
+
+    for b in expired:
+        f = b["path"]
+        if os.path.abspath(f) in still_referenced:
+            logging.info(f"Keeping expired backup still referenced by a newer incremental backup: {f}")
+            continue
         try:
-            mtime = os.path.getmtime(f)
-            if mtime < cutoff:
-                os.remove(f)
+            storage, name = storage_backends.split_location(f, **(storage_options or {}))
+            if storage.exists(name):
+                store = chunk_store.store_for_manifest(f) if chunk_store.is_manifest(f) else None
+                storage.delete(name)
+                if store is not None:
+                    store.unregister(f)
+                    stores_to_collect.add(store.root)
                 logging.info(f"Deleted old backup: {f}")
                 print(f"Deleted old backup: {f}")
+            else:
+                logging.info(f"Old backup already gone, dropping catalog entry: {f}")
+            storage.delete(archive_digests.digest_path(name))
+            catalog.remove(f)
         except Exception as e:
             logging.error(f"Error deleting old backup {f}: {e}")
             print(f"Error deleting old backup {f}: {e}")
 
+    # Retiring manifests may leave chunks that no remaining backup references
+    for root in sorted(stores_to_collect):
+        try:
+            deleted, freed = chunk_store.ChunkStore(root).collect_garbage()
+            print(f"Chunk store {root}: removed {deleted} unreferenced chunk(s), {freed} bytes freed")
+        except Exception as e:
+            logging.error(f"Error collecting garbage in chunk store {root}: {e}")
+            print(f"Error collecting garbage in chunk store {root}: {e}")
+
+
+def expected_dump_size(database, backup_dir=".", catalog_path=None):
+    """Uncompressed size of the newest earlier dump of a database, or None.
+
+    Read from that backup's digest file; used as the expected total when
+    reporting a backup's progress.
+    """
+    for b in open_catalog(backup_dir, catalog_path).list_backups(database):
+        if b["dump_format"] in ("incremental", parallel_export.PARALLEL_FORMAT) or storage_backends.is_url(b["path"]):
+            # Their digests cover one link of a chain, or compressed shards
+            continue
+        record = archive_digests.read_digests(b["path"])
+        if record and record.get("dump_size"):
+            return record["dump_size"]
+    return None
+
+
+def stream_dump_to_archive(pg_dump_cmd, env, writer, chunk_size=CHUNK_SIZE, stats=None, throttle=None, progress=None):
+    """Pipes pg_dump's stdout into an open archive writer in fixed-size chunks.
+
+    No intermediate .sql file is written; dumping and compressing overlap.
+    Returns the number of uncompressed bytes written. If a `stats` dict is
+    given, the time spent waiting on pg_dump ("read_seconds"), inside the
+    writer ("write_seconds") and held back by `throttle`
+    ("throttle_seconds", see throttling.Throttle) is added to it, showing
+    which side is the bottleneck. `progress` is called with every chunk
+    after it was written (see progress_events.StreamProgress).
+    """
+    total = 0
+    read_seconds = 0.0
+    write_seconds = 0.0
+    throttle_seconds = 0.0
+    write = throttle.measure(writer.write, writer) if throttle is not None else writer.write
+    # stderr goes to a spooled temp file so a chatty pg_dump can never block on a full pipe
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(pg_dump_cmd, env=env, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            while True:
+                t0 = time.perf_counter()
+                chunk = proc.stdout.read(chunk_size)
+                t1 = time.perf_counter()
+                read_seconds += t1 - t0
+                if not chunk:
+                    break
+                if throttle is not None:
+                    throttle.consume(len(chunk))
+                    throttle_seconds += time.perf_counter() - t1
+                    t1 = time.perf_counter()
+                write(chunk)
+                write_seconds += time.perf_counter() - t1
+                total += len(chunk)
+                if progress is not None:
+                    progress(chunk)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+            if stats is not None:
+                stats["read_seconds"] = stats.get("read_seconds", 0.0) + read_seconds
+                stats["write_seconds"] = stats.get("write_seconds", 0.0) + write_seconds
+                stats["throttle_seconds"] = stats.get("throttle_seconds", 0.0) + throttle_seconds
+
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(returncode, pg_dump_cmd, stderr=stderr_file.read())
+    return total
+
+
+async def pipe_dump_to_archive(pg_dump_cmd, env, writer, close_writer, sink=None, archive_file=None, raw=None, stats=None, throttle=None, progress=None, queue_size=async_pipeline.DEFAULT_QUEUE_SIZE):
+    """Streams pg_dump's output into an archive through concurrent pipeline stages.
+
+    The stages are dump (pg_dump's stdout), throttle (with a `throttle`),
+    compress (`writer`, compressing into `sink`; close_writer() flushes it),
+    hash (`archive_file`, a hash-only archive_digests.HashingWriter) and
+    write (`raw`, the storage stream). They are joined by bounded queues
+    (see async_pipeline), so each works on its own block while the others
+    do, and a slow stage holds back pg_dump. Without a `sink` the writer
+    stores its output itself (a chunk-store writer) and the hash and write
+    stages are left out. `progress` is called with every block compressed.
+    Returns the number of uncompressed bytes; `stats` gets the same times
+    as stream_dump_to_archive's, plus each stage's busy time under "stages".
+    """
+    stats = stats if stats is not None else {}
+    stages = []
+    if throttle is not None:
+        def hold_back(chunk):
+            throttle.consume(len(chunk))
+            return chunk
+        stages.append(async_pipeline.Stage("throttle", hold_back))
+
+    def compress(chunk):
+        writer.write(chunk)
+        if progress is not None:
+            progress(chunk)
+        return sink.take() if sink is not None else None
+
+    def finish_compress():
+        close_writer()
+        return sink.take() if sink is not None else None
+
+    def digest(chunk):
+        archive_file.write(chunk)
+        return chunk
+
+    write = raw.write if raw is not None else None
+    if throttle is not None:
+        # The CPU cap counts the work done for this backup on the stage threads
+        compress = throttle.measure(compress, writer)
+        finish_compress = throttle.measure(finish_compress, writer)
+        digest = throttle.measure(digest)
+        write = throttle.measure(write) if write is not None else None
+
+    stages.append(async_pipeline.Stage("compress", compress, finish_compress, abort=lambda error: close_writer()))
+    if sink is not None:
+        stages.append(async_pipeline.Stage("hash", digest))
+        stages.append(async_pipeline.Stage("write", write))
+
+    dumped = await async_pipeline.run_pipeline(async_pipeline.process_output(pg_dump_cmd, env, CHUNK_SIZE, stats), stages, queue_size)
+    busy = stats.setdefault("stages", {})
+    for stage in stages:
+        busy[stage.name] = round(busy.get(stage.name, 0.0) + stage.busy_seconds, 3)
+        key = "throttle_seconds" if stage.name == "throttle" else "write_seconds"
+        stats[key] = stats.get(key, 0.0) + stage.busy_seconds
+    return dumped
+
+
+def record_stream_phases(metrics, elapsed, stats, dumped, stored):
+    """Splits the wall time of a streamed dump into its dump and compress phases.
+
+    pg_dump and the compressor run concurrently, so "dump" is the time spent
+    waiting on pg_dump's output, "throttle" the time deliberately held back
+    (if any) and "compress" is the rest (writing, compressing and flushing
+    the archive). `stored` is the number of bytes that reached the backup
+    volume.
+    """
+    read_seconds = stats.get("read_seconds", 0.0)
+    throttle_seconds = stats.get("throttle_seconds", 0.0)
+    metrics.record("dump", read_seconds, bytes_out=dumped)
+    if throttle_seconds:
+        metrics.record("throttle", throttle_seconds)
+    metrics.record("compress", elapsed - read_seconds - throttle_seconds, bytes_in=dumped, bytes_out=stored)
+    metrics.uncompressed_bytes = (metrics.uncompressed_bytes or 0) + dumped
+    metrics.compressed_bytes = (metrics.compressed_bytes or 0) + stored
+
+
+def zip_dump_directory(dump_dir, zip_path, arcname):
+    """Packages a pg_dump directory-format output into a zip archive.
 
-def backup_postgres(host, port, database, username, password, backup_dir=".", retention_days=30, dry_run=False, bin_dir=None):
-    """Backs up a PostgreSQL database to a zipped archive."""
+    pg_dump already compresses the table data files, so members are stored
+    rather than deflated again. Returns the number of bytes packaged.
+    """
+    total = 0
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for name in sorted(os.listdir(dump_dir)):
+            path = os.path.join(dump_dir, name)
+            zipf.write(path, arcname=f"{arcname}/{name}")
+            total += os.path.getsize(path)
+    return total
+
+
+def tar_dump_directory(dump_dir, writer, arcname):
+    """Writes a pg_dump directory-format output as a tar stream into an archive writer."""
+    total = 0
+    with tarfile.open(fileobj=writer, mode='w|') as tar:
+        for name in sorted(os.listdir(dump_dir)):
+            path = os.path.join(dump_dir, name)
+            tar.add(path, arcname=f"{arcname}/{name}")
+            total += os.path.getsize(path)
+    return total
+
+
+async def backup_postgres_async(host, port, database, username, password, backup_dir=".", retention_days=30, dry_run=False, bin_dir=None, stream=True, dump_format="plain", jobs=1, codec="zip", compress_level=None, compress_threads=1, catalog_path=None, keep_daily=0, keep_weekly=0, keep_monthly=0, keep_yearly=0, chunk_store_dir=None, full_backup=False, full_every_days=7, metrics_file=None, prometheus_dir=None, storage_url=None, storage_options=None, max_rate=None, max_compress_cpu=None, adaptive_max_active=None, adaptive_poll_interval=throttling.DEFAULT_POLL_INTERVAL, on_event=None, preflight=False, max_duration=None, shard_bytes=parallel_export.DEFAULT_SHARD_BYTES):
+    """Backs up a PostgreSQL database to a compressed archive and returns its path.
+
+    With stream=True (default) pg_dump's output is compressed as it is produced;
+    stream=False keeps the legacy dump-to-file-then-compress behaviour.
+    dump_format="directory" runs pg_dump -Fd with `jobs` parallel workers and
+    packages the resulting directory into the archive.
+    `codec` selects the compression (see archive_codecs.CODECS), with an
+    optional `compress_level` and `compress_threads` for gzip and zstd.
+    Every archive is recorded in the backup catalog (catalog_path, default
+    <backup_dir>/backup_catalog.db), which also drives retention; keep_*
+    counts select a grandfather-father-son policy instead of retention_days.
+    With chunk_store_dir the dump is deduplicated into that chunk store and
+    only a small .manifest is written to backup_dir.
+    dump_format="incremental" dumps only the tables whose pg_stat_user_tables
+    counters changed since the previous incremental backup (see
+    incremental_backup); full_backup forces a new base, as does a base older
+    than full_every_days.
+    dump_format="indexed" splits the plain dump into one zip member per
+    object and stores a table of contents, so single tables or schemas can
+    be restored without reading the rest (see indexed_archive).
+    dump_format="parallel" exports the tables with `jobs` concurrent COPY
+    commands sharing one snapshot, splitting tables larger than
+    shard_bytes into ctid ranges, next to a schema-only pg_dump; each
+    shard is compressed with `codec` (gzip when it is zip) and stored in
+    a zip container (see parallel_export).
+    SHA-256 digests of the archive and of the dump are computed while they
+    are written and stored next to the archive (see archive_digests).
+    With storage_url (e.g. s3://bucket/prefix) the archive is streamed to
+    that storage backend instead of backup_dir, as a concurrent multipart
+    upload for S3; storage_options are passed to
+    storage_backends.open_backend. backup_dir still holds the catalog and
+    any scratch files.
+    max_rate (bytes per second of uncompressed dump) and max_compress_cpu
+    (percent of one CPU) throttle the pipeline; adaptive_max_active slows
+    it down further while more than that many other sessions are active in
+    pg_stat_activity, polled every adaptive_poll_interval seconds (see
+    throttling). Pauses and the effective throughput are logged and
+    added to the run metrics.
+    `on_event` is called with a dict for every phase start and end, the
+    bytes dumped so far, each COPY block's row count and any error (see
+    progress_events); while a streamed dump is written, bytes_expected is
+    the size of the previous dump of the database, or None if unknown.
+    Per-phase timings and byte counts are logged as one JSON record per run,
+    appended to `metrics_file` (JSON lines) and written as a Prometheus
+    textfile into `prometheus_dir` when given (see run_metrics).
+    With preflight the database and table sizes are read first and, with
+    the history of earlier runs, give the expected archive size, disk
+    space and duration (see capacity_planner); the backup is refused early
+    if it would not fit into the free space or into max_duration seconds.
+    jobs="auto" and compress_level="auto" let the pre-flight check pick
+    them, and imply it, as does max_duration.
+    Streamed dumps run as concurrent dump, compress, hash and write stages
+    (see pipe_dump_to_archive); every other blocking step runs on the
+    event loop's thread pool, so many backups can share one event loop.
+    backup_postgres is the synchronous wrapper.
+    """
     logging.info(f"Starting backup for database '{database}' on {host}:{port}")
 
-    # Resolve pg_dump path
-    pg_dump_path = "pg_dump"
-    if bin_dir:
-        pg_dump_path = os.path.join(bin_dir, "pg_dump")
-        if sys.platform == "win32" and not pg_dump_path.lower().endswith(".exe"):
-            pg_dump_path += ".exe"
+    if dump_format not in DUMP_FORMATS:
+        raise ValueError(f"Unknown dump format '{dump_format}'. Expected one of: {', '.join(DUMP_FORMATS)}")
+    if jobs != 1 and dump_format not in ("directory", parallel_export.PARALLEL_FORMAT):
+        raise ValueError("Parallel jobs require the directory or parallel dump format.")
+    if chunk_store_dir:
+        if dump_format != "plain":
+            raise ValueError("The chunk store only supports the plain dump format.")
+        # Deduplication works on the raw dump stream
+        stream = True
+        codec = "chunks"
+    else:
+        archive_codecs.check_codec_available(codec)
+    shard_codec = None
+    if dump_format == parallel_export.PARALLEL_FORMAT:
+        # The shards are compressed on their own and stored in a zip container
+        shard_codec = parallel_export.DEFAULT_SHARD_CODEC if codec == "zip" else codec
+        codec = "zip"
+    if dump_format in ("incremental", "indexed"):
+        # Incremental and indexed archives are zip containers with one member per table or object
+        codec = "zip"
+    if (max_rate or max_compress_cpu or adaptive_max_active is not None) and (dump_format in ("directory", parallel_export.PARALLEL_FORMAT) or (dump_format == "plain" and not stream)):
+        # Throttling holds back pg_dump by not reading its output; a dump written to disk runs at full speed
+        raise ValueError("Throttling needs a streamed dump; it cannot be combined with the directory or parallel format or --no-stream.")
+    if storage_url and (chunk_store_dir or dump_format == "incremental"):
+        # Both read earlier archives or chunks back while writing a new one
+        raise ValueError("Chunk-store and incremental backups can only be written to a local backup directory.")
+    storage = storage_backends.open_backend(storage_url, **(storage_options or {})) if storage_url else storage_backends.LocalBackend(backup_dir)
 
-    if shutil.which(pg_dump_path) is None:
-        msg = f"'{pg_dump_path}' not found. Please install PostgreSQL tools or check the bin path."
-        print(msg)
-        logging.error(msg)
-        raise EnvironmentError(msg)
+    # For parallel archives the shard codec does the compressing, so it is what the pre-flight history compares
+    metrics = run_metrics.RunMetrics("backup", database, on_event=on_event, host=host, port=port, codec=shard_codec or codec, dump_format=dump_format)
+    with metrics.recording(metrics_file, prometheus_dir, enabled=not dry_run):
+        # Resolve pg_dump path
+        with metrics.phase("resolve_binaries"):
+            pg_dump_path = get_bin("pg_dump", bin_dir)
+
+            if shutil.which(pg_dump_path) is None:
+                msg = f"'{pg_dump_path}' not found. Please install PostgreSQL tools or check the bin path."
+                print(msg)
+                logging.error(msg)
+                raise EnvironmentError(msg)
+
+        # Ensure backup dir exists
+        os.makedirs(backup_dir, exist_ok=True)
+
+        started = datetime.datetime.now()
+        timestamp = started.strftime("%Y%m%d_%H%M%S")
+        dump_filename = f"{database}_{timestamp}.sql"
+        if chunk_store_dir:
+            archive_filename = f"{database}_{timestamp}{chunk_store.MANIFEST_EXTENSION}"
+        else:
+            archive_filename = f"{database}_{timestamp}{archive_codecs.archive_extension(codec, dump_format)}"
+        dump_path = os.path.join(backup_dir, dump_filename)
+        archive_path = storage.url(archive_filename)
+        metrics.archive = archive_path
+
+        env = os.environ.copy()
+        env['PGPASSWORD'] = password
+
+        if preflight or max_duration is not None or "auto" in (jobs, compress_level):
+            psql_path = get_bin("psql", bin_dir)
+            if shutil.which(psql_path) is None:
+                raise EnvironmentError(f"'{psql_path}' not found. The pre-flight check needs psql to read the database size.")
+            with metrics.phase("preflight"):
+                estimate = await async_pipeline.to_thread(
+                    capacity_planner.preflight,
+                    database,
+                    [psql_path, '-h', host, '-p', str(port), '-U', username, '-d', database],
+                    env,
+                    shard_codec or codec,
+                    dump_format=dump_format,
+                    stream=stream,
+                    compress_level=compress_level,
+                    jobs=jobs,
+                    backup_dir=backup_dir,
+                    storage_url=storage_url,
+                    chunk_store_dir=chunk_store_dir,
+                    catalog_path=catalog_path,
+                    metrics_file=metrics_file,
+                    max_seconds=max_duration,
+                )
+            msg = estimate.summary()
+            print(msg)
+            logging.info(msg)
+            for note in estimate.notes:
+                logging.info(f"Pre-flight: {note}")
+            metrics.labels["preflight"] = estimate.to_dict()
+            metrics.labels["database_size"] = estimate.database_size
+            jobs = estimate.jobs
+            if compress_level == "auto":
+                compress_level = estimate.compress_level
+            if estimate.refusal:
+                msg = f"Backup of '{database}' refused by the pre-flight check: {estimate.refusal}"
+                if dry_run:
+                    print(f"[DRY-RUN] {msg}")
+                    logging.info(f"[DRY-RUN] {msg}")
+                else:
+                    print(msg)
+                    logging.error(msg)
+                    raise EnvironmentError(msg)
+        # Kept in the run record so later pre-flight checks can tell levels apart
+        metrics.labels.update(compress_level=compress_level, jobs=jobs)
+
+        pg_dump_cmd = [
+            pg_dump_path,
+            '-h', host,
+            '-p', str(port),
+            '-U', username,
+            '-d', database,
+        ]
+        temp_dir_obj = None
+        if dump_format in ("directory", parallel_export.PARALLEL_FORMAT):
+            # pg_dump -Fd and the COPY shards must be written to disk; keep the scratch dir on the backup volume
+            if not dry_run:
+                temp_dir_obj = tempfile.TemporaryDirectory(dir=backup_dir, prefix=f".{database}_{timestamp}_")
+                dump_path = os.path.join(temp_dir_obj.name, f"{database}_{timestamp}")
+            else:
+                dump_path = os.path.join(backup_dir, f"{database}_{timestamp}")
+            if dump_format == "directory":
+                pg_dump_cmd += ['-Fd', '-j', str(jobs), '-f', dump_path]
+        elif not stream and dump_format == "plain":
+            pg_dump_cmd += ['-f', dump_path]
+
+        throttle = None
+        if max_rate or max_compress_cpu or adaptive_max_active is not None:
+            monitor = None
+            if adaptive_max_active is not None:
+                psql_path = get_bin("psql", bin_dir)
+                if shutil.which(psql_path) is None:
+                    raise EnvironmentError(f"'{psql_path}' not found. Adaptive throttling needs psql to read pg_stat_activity.")
+                monitor = throttling.LoadMonitor([psql_path, '-h', host, '-p', str(port), '-U', username, '-d', database], env, adaptive_max_active, adaptive_poll_interval)
+            throttle = throttling.Throttle(max_rate, max_compress_cpu, monitor)
+
+        def open_archive(fileobj=None):
+            return archive_codecs.open_writer(archive_path, codec, level=compress_level, threads=compress_threads, arcname=dump_filename, fileobj=fileobj)
+
+        @contextlib.contextmanager
+        def open_archive_file():
+            # An error inside the block reaches the storage stream, which then
+            # discards the object (e.g. aborts the multipart upload)
+            with storage.open_write(archive_filename) as raw, archive_digests.HashingWriter(raw) as hashed:
+                yield hashed
+
+        # Digests are taken in-stream: archive_file hashes the bytes that reach
+        # the archive, dump_file (or dump_hasher) the uncompressed dump
+        archive_file = None
+        dump_file = None
+        dump_hasher = None
+
+        async def stream_archive(open_writer, stats):
+            # dump -> [throttle] -> compress -> hash -> write, joined by bounded queues
+            nonlocal archive_file, dump_file
+            async with async_pipeline.in_thread(storage.open_write(archive_filename)) as raw:
+                sink = async_pipeline.ChunkSink(getattr(raw, "name", None))
+                writer = open_writer(sink)
+                dump_file = archive_digests.HashingWriter(writer)
+                archive_file = archive_digests.HashingWriter(None)
+                dumped = await pipe_dump_to_archive(pg_dump_cmd, env, dump_file, writer.close, sink=sink, archive_file=archive_file, raw=raw, stats=stats, throttle=throttle, progress=report)
+            metrics.labels["pipeline_busy_seconds"] = stats["stages"]
+            return dumped
+
+        def discard_archive():
+            try:
+                if storage.exists(archive_filename):
+                    storage.delete(archive_filename)
+                    logging.info(f"Cleaned up incomplete archive: {archive_path}")
+                storage.delete(archive_digests.digest_path(archive_filename))
+            except Exception as e:
+                logging.error(f"Could not clean up incomplete archive {archive_path}: {e}")
+
+        def dry_run_note(msg):
+            # Logged as well, so applications that show the log see the plan
+            print(msg)
+            logging.info(msg)
+
+        print(f"Starting backup for database '{database}' on {host}:{port}...")
+        try:
+            if dry_run:
+                dry_run_note(f"[DRY-RUN] Would run: {' '.join(pg_dump_cmd)}")
+                dry_run_note("[DRY-RUN] Skipping actual dump due to dry-run")
+                if dump_format == "directory":
+                    dry_run_note(f"[DRY-RUN] Would dump directory format with {jobs} job(s) and package it into: {archive_path}")
+                elif dump_format == "incremental":
+                    dry_run_note(f"[DRY-RUN] Would dump changed tables {'(full base)' if full_backup else ''} into incremental archive: {archive_path}")
+                elif dump_format == "indexed":
+                    dry_run_note(f"[DRY-RUN] Would stream dump into indexed archive: {archive_path}")
+                elif dump_format == parallel_export.PARALLEL_FORMAT:
+                    dry_run_note(f"[DRY-RUN] Would export tables with {jobs} parallel COPY worker(s) ({shard_codec} shards of up to {shard_bytes // (1024 * 1024)} MB) into: {archive_path}")
+                elif chunk_store_dir:
+                    dry_run_note(f"[DRY-RUN] Would deduplicate dump into chunk store {chunk_store_dir} with manifest: {archive_path}")
+                elif stream:
+                    dry_run_note(f"[DRY-RUN] Would stream dump into {codec} archive at: {archive_path}")
+                else:
+                    dry_run_note(f"[DRY-RUN] Would create dump at: {dump_path}")
+                    dry_run_note(f"[DRY-RUN] Would create {codec} archive at: {archive_path}")
+                if any((keep_daily, keep_weekly, keep_monthly, keep_yearly)):
+                    dry_run_note(f"[DRY-RUN] Would apply GFS retention (daily={keep_daily}, weekly={keep_weekly}, monthly={keep_monthly}, yearly={keep_yearly}) in {backup_dir}")
+                else:
+                    dry_run_note(f"[DRY-RUN] Would cleanup backups older than {retention_days} days in {backup_dir}")
+                if throttle is not None:
+                    dry_run_note(f"[DRY-RUN] Would throttle the backup (rate={max_rate or '-'} B/s, compression CPU={max_compress_cpu or '-'}%, max active sessions={adaptive_max_active if adaptive_max_active is not None else '-'})")
+                return
+            if throttle is not None:
+                await async_pipeline.to_thread(throttle.start)
+            tracker = None
+            if on_event is not None and dump_format != "directory" and (stream or dump_format != "plain"):
+                expected = None if dump_format in ("incremental", parallel_export.PARALLEL_FORMAT) else await async_pipeline.to_thread(expected_dump_size, database, backup_dir, catalog_path)
+                # COPY shards carry no COPY headers to count rows by
+                tracker = progress_events.StreamProgress(metrics.notify, expected, count_rows=dump_format != parallel_export.PARALLEL_FORMAT)
+            report = tracker.feed if tracker is not None else None
+            if dump_format == "directory":
+                print(f"Dumping in directory format with {jobs} parallel job(s)...")
+                with metrics.phase("dump"):
+                    await async_pipeline.run_command(pg_dump_cmd, env)
+                logging.info(f"Directory-format dump created with {jobs} job(s): {dump_path}")
+
+                def package():
+                    nonlocal archive_file, dump_file
+                    with open_archive_file() as archive_file:
+                        if codec == "zip":
+                            return zip_dump_directory(dump_path, archive_file, os.path.basename(dump_path))
+                        with open_archive(archive_file) as writer:
+                            dump_file = archive_digests.HashingWriter(writer)
+                            return tar_dump_directory(dump_path, dump_file, os.path.basename(dump_path))
+
+                print(f"Packaging dump directory into {archive_path}...")
+                with metrics.phase("compress") as phase:
+                    packaged = await async_pipeline.to_thread(package)
+                    phase.bytes_in = packaged
+                    phase.bytes_out = archive_file.bytes_written
+                metrics.phases["dump"].bytes_out = packaged
+                metrics.uncompressed_bytes = packaged
+                logging.info(f"Packaged {packaged} bytes into {archive_path}")
+            elif dump_format == "incremental":
+                psql_path = get_bin("psql", bin_dir)
+                if shutil.which(psql_path) is None:
+                    raise EnvironmentError(f"'{psql_path}' not found. Incremental backups need psql to read table statistics.")
+                psql_cmd = [psql_path, '-h', host, '-p', str(port), '-U', username, '-d', database]
+
+                print(f"Dumping changed tables into {archive_path}...")
+                stats = {}
+                dumped = 0
+
+                dump_hasher = archive_digests.new_hasher()
+
+                def dump_member(cmd, writer):
+                    nonlocal dumped
+                    n = stream_dump_to_archive(cmd, env, archive_digests.HashingWriter(writer, hasher=dump_hasher), stats=stats, throttle=throttle, progress=report)
+                    dumped += n
+                    return n
+
+                def dump_incremental():
+                    # incremental_backup drives one pg_dump per changed table through
+                    # dump_member; the whole archive is built on a worker thread
+                    nonlocal archive_file
+                    previous_path = None
+                    for b in open_catalog(backup_dir, catalog_path).list_backups(database):
+                        if b["dump_format"] == "incremental" and os.path.exists(b["path"]):
+                            previous_path = b["path"]
+                            break
+                    with open_archive_file() as archive_file:
+                        return incremental_backup.write_incremental_archive(
+                            archive_path,
+                            database,
+                            pg_dump_cmd,
+                            psql_cmd,
+                            env,
+                            dump_member,
+                            previous_path=previous_path,
+                            full=full_backup,
+                            full_every_days=full_every_days,
+                            fileobj=archive_file,
+                        )
+
+                metrics.begin("dump", "compress")
+                started_dump = time.perf_counter()
+                manifest = await async_pipeline.to_thread(dump_incremental)
+                record_stream_phases(metrics, time.perf_counter() - started_dump, stats, dumped, archive_file.bytes_written)
+                kind = "Full" if manifest["full"] else "Incremental"
+                msg = f"{kind} backup: {manifest['dumped_tables']} table(s) dumped, {manifest['reused_tables']} unchanged table(s) reused from earlier archives"
+                print(msg)
+                logging.info(msg)
+            elif dump_format == parallel_export.PARALLEL_FORMAT:
+                psql_path = get_bin("psql", bin_dir)
+                if shutil.which(psql_path) is None:
+                    raise EnvironmentError(f"'{psql_path}' not found. Parallel exports need psql to run the COPY commands.")
+                psql_cmd = [psql_path, '-h', host, '-p', str(port), '-U', username, '-d', database]
+
+                print(f"Exporting tables with {jobs} parallel COPY worker(s)...")
+                with metrics.phase("dump") as phase:
+                    manifest = await parallel_export.export_database(pg_dump_cmd, psql_cmd, env, dump_path, jobs=jobs, codec=shard_codec, level=compress_level, shard_bytes=shard_bytes, progress=report, database=database, created_at=started.timestamp())
+                    phase.bytes_out = manifest["size"]
+                metrics.uncompressed_bytes = manifest["size"]
+                msg = f"Exported {manifest['tables']} table(s) as {len(manifest['shards'])} shard(s), {manifest['size']} bytes"
+                print(msg)
+                logging.info(msg)
+
+                dump_hasher = archive_digests.new_hasher()
+
+                def package():
+                    nonlocal archive_file
+                    with open_archive_file() as archive_file:
+                        return parallel_export.write_archive(archive_file, dump_path, manifest, dump_hasher)
 
-    # Ensure backup dir exists
-    os.makedirs(backup_dir, exist_ok=True)
+                print(f"Packaging shards into {archive_path}...")
+                with metrics.phase("package") as phase:
+                    dumped = await async_pipeline.to_thread(package)
+                    phase.bytes_in = dumped
+                    phase.bytes_out = archive_file.bytes_written
+                logging.info(f"Packaged {dumped} bytes into {archive_path}")
+            elif dump_format == "indexed":
+                print(f"Streaming dump into indexed archive {archive_path}...")
+                stats = {}
+                metrics.begin("dump", "compress")
+                started_dump = time.perf_counter()
+                writer = None
 
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    dump_filename = f"{database}_{timestamp}.sql"
-    zip_filename = f"{database}_{timestamp}.zip"
-    dump_path = os.path.join(backup_dir, dump_filename)
-    zip_path = os.path.join(backup_dir, zip_filename)
+                def open_indexed(sink):
+                    nonlocal writer
+                    writer = indexed_archive.IndexedArchiveWriter(sink, level=compress_level, database=database, created_at=started.timestamp())
+                    return writer
+
+                dumped = await stream_archive(open_indexed, stats)
+                record_stream_phases(metrics, time.perf_counter() - started_dump, stats, dumped, archive_file.bytes_written)
+                logging.info(f"Database dump streamed into {archive_path} ({dumped} bytes uncompressed, {len(writer.segments)} object(s) indexed)")
+            elif chunk_store_dir:
+                print(f"Streaming dump into chunk store {chunk_store_dir}...")
+                store = chunk_store.ChunkStore(chunk_store_dir)
+                stats = {}
+                metrics.begin("dump", "compress")
+                started_dump = time.perf_counter()
+                writer = store.writer(threads=compress_threads)
+                dump_file = archive_digests.HashingWriter(writer)
+                dumped = await pipe_dump_to_archive(pg_dump_cmd, env, dump_file, writer.close, stats=stats, throttle=throttle, progress=report)
+                metrics.labels["pipeline_busy_seconds"] = stats["stages"]
+                record_stream_phases(metrics, time.perf_counter() - started_dump, stats, dumped, writer.stored_bytes)
+                await async_pipeline.to_thread(store.write_manifest, archive_path, writer, database=database, created_at=started.timestamp())
+                msg = f"Deduplicated {dumped} bytes into {len(writer.chunks)} chunk(s); {writer.new_chunks} new, {writer.stored_bytes} bytes written"
+                print(msg)
+                logging.info(msg)
+            elif stream:
+                print(f"Streaming dump into {archive_path} ({codec})...")
+                stats = {}
+                metrics.begin("dump", "compress")
+                started_dump = time.perf_counter()
+                dumped = await stream_archive(open_archive, stats)
+                record_stream_phases(metrics, time.perf_counter() - started_dump, stats, dumped, archive_file.bytes_written)
+                logging.info(f"Database dump streamed into {archive_path} ({dumped} bytes uncompressed, codec {codec})")
+            else:
+                with metrics.phase("dump") as phase:
+                    await async_pipeline.run_command(pg_dump_cmd, env)
+                    phase.bytes_out = os.path.getsize(dump_path)
+                metrics.uncompressed_bytes = phase.bytes_out
+                print(f"Database dump created: {dump_path}")
+                logging.info(f"Database dump created: {dump_path}")
+
+                # Compress the dump file
+                print(f"Compressing to {archive_path} ({codec})...")
+                def compress_dump_file():
+                    nonlocal archive_file, dump_file
+                    with open(dump_path, 'rb') as src, open_archive_file() as archive_file, open_archive(archive_file) as writer:
+                        dump_file = archive_digests.HashingWriter(writer)
+                        shutil.copyfileobj(src, dump_file, CHUNK_SIZE)
+
+                with metrics.phase("compress") as phase:
+                    await async_pipeline.to_thread(compress_dump_file)
+                    phase.bytes_in = metrics.uncompressed_bytes
+                    phase.bytes_out = archive_file.bytes_written
+
+            if tracker is not None:
+                tracker.close()
+            if throttle is not None:
+                await async_pipeline.to_thread(throttle.stop)
+                msg = throttle.summary()
+                print(msg)
+                logging.info(msg)
+                metrics.labels["throttle"] = throttle.to_dict()
+
+            if archive_file is not None:
+                archive_sha256, archive_size = archive_file.hexdigest(), archive_file.bytes_written
+            else:
+                # Chunk-store manifests are small JSON files written in one go
+                archive_sha256, archive_size = await async_pipeline.to_thread(archive_digests.file_digest, archive_path)
+            if dump_file is not None:
+                dump_sha256, dump_size = dump_file.hexdigest(), dump_file.bytes_written
+            elif dump_hasher is not None:
+                dump_sha256, dump_size = dump_hasher.hexdigest(), dumped
+            else:
+                dump_sha256 = dump_size = None
+            record = archive_digests.digest_record(archive_filename, archive_sha256, archive_size, dump_sha256, dump_size)
+            await async_pipeline.to_thread(storage.put_bytes, archive_digests.digest_path(archive_filename), archive_digests.encode_record(record))
+            logging.info(f"Archive digest ({archive_digests.ALGORITHM}): {archive_sha256}")
+
+            print(f"Backup saved successfully: {archive_path}")
+            logging.info(f"Backup saved successfully: {archive_path}")
+
+            if metrics.compressed_bytes is None:
+                metrics.compressed_bytes = archive_size
+
+            with metrics.phase("catalog") as phase:
+                await async_pipeline.to_thread(
+                    open_catalog(backup_dir, catalog_path).record_backup,
+                    database,
+                    archive_path,
+                    created_at=started.timestamp(),
+                    codec=codec,
+                    dump_format=dump_format,
+                    size=archive_size,
+                    checksum=archive_sha256,
+                    duration=round((datetime.datetime.now() - started).total_seconds(), 3),
+                )
+                phase.bytes_in = archive_size
+
+            # Cleanup old backups after success
+            with metrics.phase("cleanup"):
+                await async_pipeline.to_thread(cleanup_old_backups, database, retention_days=retention_days, backup_dir=backup_dir, catalog_path=catalog_path, keep_daily=keep_daily, keep_weekly=keep_weekly, keep_monthly=keep_monthly, keep_yearly=keep_yearly, storage_options=storage_options)
+            return archive_path
+
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode() if e.stderr else "No error output"
+            # Parallel exports also run psql for the COPY commands
+            tool = os.path.basename(e.cmd[0]) if e.cmd else "pg_dump"
+            msg = f"Error running {tool}:\n{stderr}"
+            print(msg)
+            logging.error(msg)
+            await async_pipeline.to_thread(discard_archive)
+            raise
+        except Exception as e:
+            msg = f"An unexpected error occurred: {e}"
+            print(msg)
+            logging.error(msg)
+            await async_pipeline.to_thread(discard_archive)
+            raise
+        except asyncio.CancelledError:
+            msg = f"Backup of database '{database}' was cancelled"
+            print(msg)
+            logging.warning(msg)
+            await async_pipeline.to_thread(discard_archive)
+            raise
+        finally:
+            if throttle is not None:
+                await async_pipeline.to_thread(throttle.stop)
+            if temp_dir_obj:
+                temp_dir_obj.cleanup()
+                logging.info(f"Cleaned up temporary dump directory: {dump_path}")
+            elif os.path.exists(dump_path):
+                os.remove(dump_path)
+                print(f"Cleaned up temporary file: {dump_path}")
+                logging.info(f"Cleaned up temporary file: {dump_path}")
+
+
+def backup_postgres(*args, **kwargs):
+    """Synchronous wrapper: runs backup_postgres_async on a new event loop and returns the archive path."""
+    return asyncio.run(backup_postgres_async(*args, **kwargs))
+
+
+# Keeps the full signature visible to help() and inspect
+functools.update_wrapper(backup_postgres, backup_postgres_async, assigned=())
+
+
+async def backup_physical_async(host, port, username, password, backup_dir=".", retention_days=30, dry_run=False, bin_dir=None, codec="gzip", compress_level=None, compress_threads=1, catalog_path=None, keep_daily=0, keep_weekly=0, keep_monthly=0, keep_yearly=0, label=None, scratch_dir=None, checkpoint="fast", max_rate=None, metrics_file=None, prometheus_dir=None, storage_url=None, storage_options=None, on_event=None):
+    """Backs up a whole PostgreSQL cluster with pg_basebackup and returns the archive path.
+
+    pg_basebackup writes the data directory and every tablespace as tar
+    files, streaming the WAL needed to make them consistent alongside
+    (-X stream), into a scratch directory below scratch_dir (default
+    backup_dir), which needs room for the uncompressed cluster. The tars
+    are then packaged into one <label>_<timestamp>.tar.<ext> archive with
+    `codec`, using compress_threads for gzip and zstd (see
+    physical_backup). zip is not supported. `label` names the backups in
+    the catalog and defaults to cluster_<host>_<port>; retention, digests,
+    storage_url and the run metrics work as for backup_postgres, the
+    archive being catalogued with the "physical" dump format.
+    `checkpoint` is pg_basebackup's -c ("fast" starts at once, "spread"
+    spares the server) and max_rate (bytes per second) its -r.
+    restore_postgres.restore_physical lays out a data directory from the
+    archive. backup_physical is the synchronous wrapper.
+    """
+    label = label or physical_backup.cluster_label(host, port)
+    logging.info(f"Starting physical backup of {host}:{port} as '{label}'")
+
+    if codec == "zip":
+        raise ValueError("Physical backups are tar streams; use the gzip, zstd, lz4 or xz codec.")
+    archive_codecs.check_codec_available(codec)
+    if compress_level == "auto":
+        raise ValueError("compress_level='auto' is picked by the pre-flight check, which physical backups do not run.")
+    if checkpoint not in physical_backup.CHECKPOINT_MODES:
+        raise ValueError(f"Unknown checkpoint mode '{checkpoint}'. Expected one of: {', '.join(physical_backup.CHECKPOINT_MODES)}")
+    storage = storage_backends.open_backend(storage_url, **(storage_options or {})) if storage_url else storage_backends.LocalBackend(backup_dir)
+
+    metrics = run_metrics.RunMetrics("backup", label, on_event=on_event, host=host, port=port, codec=codec, dump_format=physical_backup.PHYSICAL_FORMAT)
+    with metrics.recording(metrics_file, prometheus_dir, enabled=not dry_run):
+        with metrics.phase("resolve_binaries"):
+            pg_basebackup_path = get_bin("pg_basebackup", bin_dir)
+
+            if shutil.which(pg_basebackup_path) is None:
+                msg = f"'{pg_basebackup_path}' not found. Please install PostgreSQL tools or check the bin path."
+                print(msg)
+                logging.error(msg)
+                raise EnvironmentError(msg)
+
+        os.makedirs(backup_dir, exist_ok=True)
+        scratch_root = scratch_dir or backup_dir
+
+        started = datetime.datetime.now()
+        timestamp = started.strftime("%Y%m%d_%H%M%S")
+        archive_filename = f"{label}_{timestamp}{archive_codecs.archive_extension(codec, physical_backup.PHYSICAL_FORMAT)}"
+        archive_path = storage.url(archive_filename)
+        metrics.archive = archive_path
+        metrics.labels.update(compress_level=compress_level, checkpoint=checkpoint)
+
+        env = os.environ.copy()
+        env['PGPASSWORD'] = password
+
+        temp_dir_obj = None
+        base_dir = os.path.join(scratch_root, f".{label}_{timestamp}")
+        archive_file = None
+        dump_file = None
+
+        def basebackup_cmd():
+            return physical_backup.basebackup_command(pg_basebackup_path, host, port, username, base_dir, checkpoint, label=f"pg_backup_restore {archive_filename}", max_rate=max_rate)
+
+        def discard_archive():
+            try:
+                if storage.exists(archive_filename):
+                    storage.delete(archive_filename)
+                    logging.info(f"Cleaned up incomplete archive: {archive_path}")
+                storage.delete(archive_digests.digest_path(archive_filename))
+            except Exception as e:
+                logging.error(f"Could not clean up incomplete archive {archive_path}: {e}")
+
+        def dry_run_note(msg):
+            print(msg)
+            logging.info(msg)
+
+        print(f"Starting physical backup of {host}:{port}...")
+        try:
+            if dry_run:
+                dry_run_note(f"[DRY-RUN] Would run: {' '.join(basebackup_cmd())}")
+                dry_run_note(f"[DRY-RUN] Would package the base backup into {codec} archive at: {archive_path}")
+                if any((keep_daily, keep_weekly, keep_monthly, keep_yearly)):
+                    dry_run_note(f"[DRY-RUN] Would apply GFS retention (daily={keep_daily}, weekly={keep_weekly}, monthly={keep_monthly}, yearly={keep_yearly}) in {backup_dir}")
+                else:
+                    dry_run_note(f"[DRY-RUN] Would cleanup backups older than {retention_days} days in {backup_dir}")
+                return
+
+            # pg_basebackup -X stream cannot write tar output to stdout
+            temp_dir_obj = tempfile.TemporaryDirectory(dir=scratch_root, prefix=f".{label}_{timestamp}_")
+            base_dir = temp_dir_obj.name
+            expected = await async_pipeline.to_thread(expected_dump_size, label, backup_dir, catalog_path) if on_event is not None else None
+
+            async def report_progress():
+                while True:
+                    await asyncio.sleep(progress_events.PROGRESS_INTERVAL)
+                    done = await async_pipeline.to_thread(physical_backup.directory_size, base_dir)
+                    metrics.notify("progress", bytes_done=done, bytes_expected=expected, rows_done=None)
+
+            print("Running pg_basebackup (tar format, streamed WAL)...")
+            with metrics.phase("basebackup") as phase:
+                reporter = asyncio.ensure_future(report_progress()) if on_event is not None else None
+                try:
+                    await async_pipeline.run_command(basebackup_cmd(), env)
+                finally:
+                    if reporter is not None:
+                        reporter.cancel()
+                phase.bytes_out = await async_pipeline.to_thread(physical_backup.directory_size, base_dir)
+            if on_event is not None:
+                metrics.notify("progress", bytes_done=phase.bytes_out, bytes_expected=expected, rows_done=None)
+            logging.info(f"pg_basebackup wrote {phase.bytes_out} bytes into {base_dir}")
+
+            def package():
+                nonlocal archive_file, dump_file
+                with storage.open_write(archive_filename) as raw, archive_digests.HashingWriter(raw) as archive_file:
+                    with archive_codecs.open_writer(archive_path, codec, level=compress_level, threads=compress_threads, fileobj=archive_file) as writer:
+                        dump_file = archive_digests.HashingWriter(writer)
+                        return physical_backup.tar_basebackup(base_dir, dump_file)
+
+            print(f"Compressing base backup into {archive_path} ({codec}, {compress_threads} thread(s))...")
+            with metrics.phase("compress") as phase:
+                packaged = await async_pipeline.to_thread(package)
+                phase.bytes_in = packaged
+                phase.bytes_out = archive_file.bytes_written
+            metrics.uncompressed_bytes = packaged
+            metrics.compressed_bytes = archive_file.bytes_written
+
+            archive_sha256, archive_size = archive_file.hexdigest(), archive_file.bytes_written
+            record = archive_digests.digest_record(archive_filename, archive_sha256, archive_size, dump_file.hexdigest(), dump_file.bytes_written)
+            await async_pipeline.to_thread(storage.put_bytes, archive_digests.digest_path(archive_filename), archive_digests.encode_record(record))
+            logging.info(f"Archive digest ({archive_digests.ALGORITHM}): {archive_sha256}")
+
+            print(f"Backup saved successfully: {archive_path}")
+            logging.info(f"Backup saved successfully: {archive_path}")
+
+            with metrics.phase("catalog") as phase:
+                await async_pipeline.to_thread(
+                    open_catalog(backup_dir, catalog_path).record_backup,
+                    label,
+                    archive_path,
+                    created_at=started.timestamp(),
+                    codec=codec,
+                    dump_format=physical_backup.PHYSICAL_FORMAT,
+                    size=archive_size,
+                    checksum=archive_sha256,
+                    duration=round((datetime.datetime.now() - started).total_seconds(), 3),
+                )
+                phase.bytes_in = archive_size
+
+            with metrics.phase("cleanup"):
+                await async_pipeline.to_thread(cleanup_old_backups, label, retention_days=retention_days, backup_dir=backup_dir, catalog_path=catalog_path, keep_daily=keep_daily, keep_weekly=keep_weekly, keep_monthly=keep_monthly, keep_yearly=keep_yearly, storage_options=storage_options)
+            return archive_path
+
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode() if e.stderr else "No error output"
+            msg = f"Error running pg_basebackup:\n{stderr}"
+            print(msg)
+            logging.error(msg)
+            await async_pipeline.to_thread(discard_archive)
+            raise
+        except Exception as e:
+            msg = f"An unexpected error occurred: {e}"
+            print(msg)
+            logging.error(msg)
+            await async_pipeline.to_thread(discard_archive)
+            raise
+        except asyncio.CancelledError:
+            msg = f"Physical backup of {host}:{port} was cancelled"
+            print(msg)
+            logging.warning(msg)
+            await async_pipeline.to_thread(discard_archive)
+            raise
+        finally:
+            if temp_dir_obj:
+                await async_pipeline.to_thread(temp_dir_obj.cleanup)
+                logging.info(f"Cleaned up scratch directory: {base_dir}")
+
+
+def backup_physical(*args, **kwargs):
+    """Synchronous wrapper: runs backup_physical_async on a new event loop and returns the archive path."""
+    return asyncio.run(backup_physical_async(*args, **kwargs))
+
+
+functools.update_wrapper(backup_physical, backup_physical_async, assigned=())
+
+
+def list_databases(host, port, username, password, bin_dir=None):
+    """Returns the names of all connectable, non-template databases on a server."""
+    psql_path = get_bin("psql", bin_dir)
+    if shutil.which(psql_path) is None:
+        msg = f"'{psql_path}' not found. Please install PostgreSQL tools or check the bin path."
+        logging.error(msg)
+        raise EnvironmentError(msg)
 
     env = os.environ.copy()
     env['PGPASSWORD'] = password
-
-    pg_dump_cmd = [
-        pg_dump_path,
+    cmd = [
+        psql_path,
         '-h', host,
         '-p', str(port),
         '-U', username,
-        '-d', database,
-        '-f', dump_path
+        '-d', 'postgres',
+        '-tA',
+        '-c', "SELECT datname FROM pg_database WHERE NOT datistemplate AND datallowconn ORDER BY datname;"
     ]
+    result = subprocess.run(cmd, env=env, check=True, capture_output=True)
+    return [line.strip() for line in result.stdout.decode().splitlines() if line.strip()]
 
-    print(f"Starting backup for database '{database}' on {host}:{port}...")
-    try:
-        if dry_run:
-            print("[DRY-RUN] Would run:", ' '.join(pg_dump_cmd))
-            print("[DRY-RUN] Skipping actual dump due to dry-run")
-            print(f"[DRY-RUN] Would create dump at: {dump_path}")
-            print(f"[DRY-RUN] Would create zip at: {zip_path}")
-            print(f"[DRY-RUN] Would cleanup backups older than {retention_days} days in {backup_dir}")
-            return
-        subprocess.run(pg_dump_cmd, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"Database dump created: {dump_path}")
-        logging.info(f"Database dump created: {dump_path}")
-
-        # Compress to zip
-        print(f"Compressing to {zip_path}...")
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(dump_path, arcname=os.path.basename(dump_path))
-
-        print(f"Backup saved successfully: {zip_path}")
-        logging.info(f"Backup saved successfully: {zip_path}")
-
-        # Cleanup old backups after success
-        cleanup_old_backups(database, retention_days=retention_days, backup_dir=backup_dir)
-
-    except subprocess.CalledProcessError as e:
-        stderr = e.stderr.decode() if e.stderr else "No error output"
-        msg = f"Error running pg_dump:\n{stderr}"
-        print(msg)
-        logging.error(msg)
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-            logging.info(f"Cleaned up incomplete zip file: {zip_path}")
-        raise
-    except Exception as e:
-        msg = f"An unexpected error occurred: {e}"
-        print(msg)
-        logging.error(msg)
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-            logging.info(f"Cleaned up incomplete zip file: {zip_path}")
-        raise
-    finally:
-        if os.path.exists(dump_path):
-            os.remove(dump_path)
-            print(f"Cleaned up temporary file: {dump_path}")
-            logging.info(f"Cleaned up temporary file: {dump_path}")
+
+async def backup_databases_async(targets, username, password, max_workers=4, max_per_host=2, **backup_kwargs):
+    """Backs up many databases concurrently in one event loop.
+
+    `targets` is a list of (host, port, database) tuples. At most
+    `max_workers` backups run at once overall and at most `max_per_host`
+    against any single host:port. Remaining keyword arguments are passed to
+    backup_postgres_async, so each database still gets its own retention
+    cleanup; an `on_event` callback among them receives the events of every
+    backup (see progress_events), told apart by their host, port and
+    database. Returns one result dict per target, in the order given; a
+    failed backup's result names the phase it failed in.
+    """
+    on_event = backup_kwargs.pop("on_event", None)
+    workers = asyncio.Semaphore(max_workers)
+    host_limits = {}
+
+    async def run_one(host, port, database):
+        host_limit = host_limits.setdefault((host, port), asyncio.Semaphore(max_per_host))
+        # The host slot first, so a backup waiting on a busy server holds no worker
+        async with host_limit, workers:
+            started = time.time()
+            result = {"host": host, "port": port, "database": database}
+            open_phases = []
+
+            def track(event):
+                if event["event"] == "phase_start":
+                    open_phases.append(event["phase"])
+                elif event["event"] == "phase_end" and event["phase"] in open_phases:
+                    open_phases.remove(event["phase"])
+                if on_event is not None:
+                    on_event(event)
+
+            try:
+                result["archive"] = await backup_postgres_async(host, port, database, username, password, on_event=track, **backup_kwargs)
+                result["status"] = "success"
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+                # Overlapping streamed phases fail together; name the first one
+                result["phase"] = open_phases[0] if open_phases else None
+            result["duration"] = round(time.time() - started, 3)
+            return result
+
+    logging.info(f"Starting batch backup of {len(targets)} database(s) with {max_workers} worker(s), {max_per_host} per host")
+    results = await asyncio.gather(*(run_one(host, port, database) for host, port, database in targets))
+
+    for r in results:
+        line = f"{r['database']}@{r['host']}:{r['port']}: {r['status']} in {r['duration']}s"
+        if r["status"] == "failed":
+            line += f" during {r['phase']} ({r['error']})" if r.get("phase") else f" ({r['error']})"
+            logging.error(f"Batch backup {line}")
+        else:
+            logging.info(f"Batch backup {line}")
+        print(line)
+    return results
+
+
+def backup_databases(targets, username, password, max_workers=4, max_per_host=2, **backup_kwargs):
+    """Synchronous wrapper around backup_databases_async; returns its results."""
+    return asyncio.run(backup_databases_async(targets, username, password, max_workers, max_per_host, **backup_kwargs))
+
+
+def int_or_auto(value):
+    """argparse type for options taking a number or 'auto'."""
+    return value if value == "auto" else int(value)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Backup a PostgreSQL database to a ZIP file.")
+    parser = argparse.ArgumentParser(description="Backup a PostgreSQL database to a compressed archive.")
     parser.add_argument("--host", required=True, help="Database host")
     parser.add_argument("--port", type=int, required=True, help="Database port")
-    parser.add_argument("--database", required=True, help="Database name")
+    db_group = parser.add_mutually_exclusive_group(required=True)
+    db_group.add_argument("--database", action="append", help="Database name (repeat to back up several databases concurrently)")
+    db_group.add_argument("--all-databases", action="store_true", help="Back up every non-template database on the server")
+    db_group.add_argument("--physical", action="store_true", help="Back up the whole cluster with pg_basebackup (tar format, streamed WAL) instead of dumping databases")
     parser.add_argument("--username", required=True, help="Database username")
     parser.add_argument("--password", required=False, help="Database password (will prompt if omitted)")
     parser.add_argument("--backup-dir", default='.', help="Directory to store backups")
     parser.add_argument("--retention-days", type=int, default=30, help="Retention days for backups")
+    parser.add_argument("--keep-daily", type=int, default=0, help="GFS retention: keep the newest backup of each of the last N days")
+    parser.add_argument("--keep-weekly", type=int, default=0, help="GFS retention: keep the newest backup of each of the last N weeks")
+    parser.add_argument("--keep-monthly", type=int, default=0, help="GFS retention: keep the newest backup of each of the last N months")
+    parser.add_argument("--keep-yearly", type=int, default=0, help="GFS retention: keep the newest backup of each of the last N years")
+    parser.add_argument("--chunk-store", help="Deduplicate dumps into this chunk-store directory and write only a .manifest to --backup-dir")
+    parser.add_argument("--catalog", help="Path to the backup catalog (default: <backup-dir>/backup_catalog.db)")
     parser.add_argument("--dry-run", action="store_true", help="Run in dry-run mode (no changes)" )
 
-    parser.add_argument("--bin-dir", help="Directory containing PostgreSQL binaries (pg_dump)")
+    parser.add_argument("--bin-dir", help="Directory containing PostgreSQL binaries (pg_dump, psql for --all-databases, pg_basebackup for --physical)")
+    parser.add_argument("--format", choices=DUMP_FORMATS, default="plain", help="Dump format: plain SQL, pg_dump directory format (allows --jobs), table-level incremental, indexed plain SQL (allows restoring single tables or schemas) or parallel COPY shards (allows --jobs, splits large tables)")
+    parser.add_argument("--shard-size-mb", type=int, default=parallel_export.DEFAULT_SHARD_BYTES // (1024 * 1024), help="Parallel format: split tables larger than this into ctid ranges of about this size")
+    parser.add_argument("--full", action="store_true", help="Incremental format: dump every table, starting a new chain base")
+    parser.add_argument("--full-every-days", type=int, default=7, help="Incremental format: start a new full base when the current one is older than N days (0 = never)")
+    parser.add_argument("--jobs", type=int_or_auto, default=1, help="Number of parallel pg_dump jobs or COPY workers (directory and parallel formats only), or 'auto' to size them from the table sizes")
+    parser.add_argument("--codec", choices=archive_codecs.CODECS, help="Compression codec (default: zip, or gzip for --physical; zstd and lz4 need the zstandard / lz4 packages)")
+    parser.add_argument("--compress-level", type=int_or_auto, help="Compression level for the chosen codec (codec default if omitted), or 'auto' to pick one that fits the free space and --max-duration-minutes")
+    parser.add_argument("--compress-threads", type=int, default=1, help="Compression threads (gzip and zstd only)")
+    parser.add_argument("--max-workers", type=int, default=4, help="Maximum concurrent backups when backing up several databases")
+    parser.add_argument("--max-per-host", type=int, default=2, help="Maximum concurrent backups against the same server")
+    parser.add_argument("--no-stream", action="store_true", help="Write the full .sql dump to disk before zipping it (legacy mode)")
+    parser.add_argument("--metrics-file", help="Append a JSON record of per-phase timings for each run to this file (JSON lines)")
+    parser.add_argument("--prometheus-dir", help="Write run metrics as .prom files into this node_exporter textfile-collector directory")
+    parser.add_argument("--storage-url", help="Store archives in this location instead of --backup-dir, e.g. s3://bucket/prefix (needs boto3)")
+    parser.add_argument("--storage-endpoint", help="Endpoint of an S3-compatible service (e.g. http://localhost:9000 for MinIO)")
+    parser.add_argument("--storage-concurrency", type=int, default=storage_backends.DEFAULT_CONCURRENCY, help="Parts uploaded in parallel to object storage")
+    parser.add_argument("--part-size-mb", type=int, default=storage_backends.DEFAULT_PART_SIZE // (1024 * 1024), help="Multipart upload part size in MB (minimum 5)")
+    parser.add_argument("--max-rate-mb", type=float, help="Throttle: read at most this many MB per second of uncompressed dump from pg_dump")
+    parser.add_argument("--max-compress-cpu", type=float, help="Throttle: limit compression to this percentage of one CPU (e.g. 50, or 200 for two cores)")
+    parser.add_argument("--adaptive-max-active", type=int, help="Throttle: slow down while more than N other sessions are active in pg_stat_activity")
+    parser.add_argument("--adaptive-poll-seconds", type=float, default=throttling.DEFAULT_POLL_INTERVAL, help="Throttle: seconds between pg_stat_activity polls")
+    parser.add_argument("--progress", action="store_true", help="Show bytes dumped and phase timings on stderr while the backup runs")
+    parser.add_argument("--events-file", help="Append every progress event (phases, bytes, COPY rows, errors) to this file as JSON lines")
+    parser.add_argument("--preflight", action="store_true", help="Check the database size, free space and expected duration before dumping, and refuse backups that would not fit")
+    parser.add_argument("--max-duration-minutes", type=float, help="Pre-flight: refuse a backup expected to take longer than this (implies --preflight)")
+    parser.add_argument("--scratch-dir", help="Physical: directory for pg_basebackup's uncompressed output before it is compressed (default: --backup-dir)")
+    parser.add_argument("--checkpoint", choices=physical_backup.CHECKPOINT_MODES, default="fast", help="Physical: start the backup with a fast or a spread checkpoint")
 
     args = parser.parse_args()
 
@@ -149,4 +1150,25 @@ if __name__ == "__main__":
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
 
-    backup_postgres(args.host, args.port, args.database, args.username, pwd, backup_dir=args.backup_dir, retention_days=args.retention_days, dry_run=args.dry_run, bin_dir=args.bin_dir)
+    codec = args.codec or ("gzip" if args.physical else "zip")
+    on_event = progress_events.combine(progress_events.ConsoleReporter() if args.progress else None, progress_events.event_file_writer(args.events_file) if args.events_file else None)
+    storage_options = dict(endpoint_url=args.storage_endpoint, concurrency=args.storage_concurrency, part_size=args.part_size_mb * 1024 * 1024)
+    max_rate = int(args.max_rate_mb * 1024 * 1024) if args.max_rate_mb else None
+
+    if args.physical:
+        backup_physical(args.host, args.port, args.username, pwd, backup_dir=args.backup_dir, retention_days=args.retention_days, dry_run=args.dry_run, bin_dir=args.bin_dir, codec=codec, compress_level=args.compress_level, compress_threads=args.compress_threads, catalog_path=args.catalog, keep_daily=args.keep_daily, keep_weekly=args.keep_weekly, keep_monthly=args.keep_monthly, keep_yearly=args.keep_yearly, scratch_dir=args.scratch_dir, checkpoint=args.checkpoint, max_rate=max_rate, metrics_file=args.metrics_file, prometheus_dir=args.prometheus_dir, storage_url=args.storage_url, storage_options=storage_options, on_event=on_event)
+    else:
+        backup_kwargs = dict(backup_dir=args.backup_dir, retention_days=args.retention_days, dry_run=args.dry_run, bin_dir=args.bin_dir, stream=not args.no_stream, dump_format=args.format, jobs=args.jobs, codec=codec, compress_level=args.compress_level, compress_threads=args.compress_threads, catalog_path=args.catalog, keep_daily=args.keep_daily, keep_weekly=args.keep_weekly, keep_monthly=args.keep_monthly, keep_yearly=args.keep_yearly, chunk_store_dir=args.chunk_store, full_backup=args.full, full_every_days=args.full_every_days, metrics_file=args.metrics_file, prometheus_dir=args.prometheus_dir, storage_url=args.storage_url, storage_options=storage_options, max_rate=max_rate, max_compress_cpu=args.max_compress_cpu, adaptive_max_active=args.adaptive_max_active, adaptive_poll_interval=args.adaptive_poll_seconds, preflight=args.preflight, max_duration=args.max_duration_minutes * 60 if args.max_duration_minutes else None, on_event=on_event, shard_bytes=args.shard_size_mb * 1024 * 1024)
+
+        if args.all_databases:
+            databases = list_databases(args.host, args.port, args.username, pwd, bin_dir=args.bin_dir)
+        else:
+            databases = args.database
+
+        if len(databases) == 1 and not args.all_databases:
+            backup_postgres(args.host, args.port, databases[0], args.username, pwd, **backup_kwargs)
+        else:
+            targets = [(args.host, args.port, db) for db in databases]
+            results = backup_databases(targets, args.username, pwd, max_workers=args.max_workers, max_per_host=args.max_per_host, **backup_kwargs)
+            if any(r["status"] != "success" for r in results):
+                sys.exit(1)
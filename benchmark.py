@@ -0,0 +1,559 @@
+import argparse
+import os
+import sys
+import json
+import gzip
+import queue
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import threading
+import contextlib
+import datetime
+import multiprocessing
+
+# Logging is configured in the main block or by the importing application
+
+# Synthetic dump shapes produced by the stand-in pg_dump:
+#   small_tables - thousands of tables with a handful of rows each
+#   huge_copy    - a few tables with very large COPY blocks
+#   wide_values  - rows carrying large text and bytea values
+#   mixed        - an even split of the three
+SHAPES = ("small_tables", "huge_copy", "wide_values", "mixed")
+
+# Fake PostgreSQL client tools written into the benchmark's bin_dir
+FAKE_TOOLS = ("pg_dump", "psql", "createdb", "dropdb", "pg_restore")
+
+# Environment variable carrying the dump description to the fake pg_dump
+DUMP_SPEC_ENV = "PG_BACKUP_BENCH_DUMP"
+
+# Distinct rows generated per table kind, and distinct COPY blocks rendered
+# from them. The blocks repeat only every BLOCK_COUNT * BLOCK_SIZE bytes, far
+# beyond any codec's match window, while keeping the generator fast enough
+# that it is never the bottleneck being measured.
+ROW_POOL_SIZE = {"narrow": 4096, "wide": 256}
+BLOCK_SIZE = 256 * 1024
+BLOCK_COUNT = 32
+
+# How often the disk sampler walks the scratch directories
+DISK_SAMPLE_INTERVAL = 0.02
+
+# How often (seconds) the benchmark checks that a child still runs while waiting for its result
+CHILD_POLL_INTERVAL = 1.0
+
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike "
+    "november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu "
+    "order invoice customer payment shipped pending refunded warehouse region north south "
+    "east west premium standard basic account balance ledger entry credit debit"
+).split()
+
+
+def _row_pool(rng, kind):
+    """Returns ROW_POOL_SIZE[kind] tab-separated COPY rows (without id) for a table kind."""
+    rows = []
+    for _ in range(ROW_POOL_SIZE[kind]):
+        if kind == "wide":
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(400, 1200)))
+            blob = rng.randbytes(rng.randint(1024, 4096)).hex()
+            rows.append(f"{rng.randint(1, 10**6)}\t{text}\t\\\\x{blob}")
+        else:
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+            amount = f"{rng.randint(0, 10**7) / 100:.2f}"
+            day = datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 2000))
+            rows.append(f"{rng.randint(1, 10**6)}\t{words}\t{amount}\t{day.isoformat()}")
+    return rows
+
+
+def _render_blocks(rng, kind):
+    """Renders BLOCK_COUNT blocks of complete COPY rows with unique ids."""
+    pool = _row_pool(rng, kind)
+    blocks = []
+    next_id = 1
+    for _ in range(BLOCK_COUNT):
+        rows = []
+        size = 0
+        while size < BLOCK_SIZE:
+            row = f"{next_id}\t{rng.choice(pool)}\n"
+            rows.append(row)
+            size += len(row)
+            next_id += 1
+        blocks.append("".join(rows).encode())
+    return blocks
+
+
+def _table_ddl(name, kind):
+    if kind == "wide":
+        columns = "id bigint PRIMARY KEY,\n    ref integer,\n    body text,\n    payload bytea"
+        copy_columns = "id, ref, body, payload"
+    else:
+        columns = "id bigint PRIMARY KEY,\n    ref integer,\n    note text,\n    amount numeric(12,2),\n    created date"
+        copy_columns = "id, ref, note, amount, created"
+    ddl = f"CREATE TABLE public.{name} (\n    {columns}\n);\n\n"
+    return ddl, f"COPY public.{name} ({copy_columns}) FROM stdin;\n"
+
+
+def _table_plan(shape, size):
+    """Returns (name, kind, bytes) for each table of a synthetic dump."""
+    if shape == "mixed":
+        plan = []
+        for sub in ("small_tables", "huge_copy", "wide_values"):
+            plan += [(f"{sub}_{name}", kind, n) for name, kind, n in _table_plan(sub, size // 3)]
+        return plan
+    if shape == "small_tables":
+        count = max(1, min(5000, size // (16 * 1024)))
+        return [(f"t{i:05d}", "narrow", size // count) for i in range(count)]
+    if shape == "huge_copy":
+        return [(f"big{i}", "narrow", size // 4) for i in range(4)]
+    if shape == "wide_values":
+        return [(f"wide{i:02d}", "wide", size // 16) for i in range(16)]
+    raise ValueError(f"Unknown dump shape '{shape}'. Expected one of: {', '.join(SHAPES)}")
+
+
+def generate_dump(out, shape, size, seed=0):
+    """Writes a synthetic plain-format SQL dump of roughly `size` bytes to a binary stream.
+
+    Rows are drawn from seeded pools, so the same shape, size and seed always
+    produce the same bytes. Returns the number of bytes written.
+    """
+    rng = random.Random(seed)
+    blocks = {}
+    written = 0
+
+    def emit(text):
+        nonlocal written
+        data = text.encode()
+        out.write(data)
+        written += len(data)
+
+    emit("--\n-- PostgreSQL database dump (synthetic)\n--\n\nSET statement_timeout = 0;\nSET client_encoding = 'UTF8';\n\n")
+    plan = _table_plan(shape, size)
+    for name, kind, _n in plan:
+        emit(_table_ddl(name, kind)[0])
+    next_block = 0
+    for name, kind, table_bytes in plan:
+        if kind not in blocks:
+            blocks[kind] = _render_blocks(rng, kind)
+        emit(_table_ddl(name, kind)[1])
+        target = written + table_bytes
+        while written < target:
+            block = blocks[kind][next_block % BLOCK_COUNT]
+            next_block += 1
+            remaining = target - written
+            if len(block) > remaining:
+                # Cut on a row boundary so every COPY line stays complete
+                block = block[:block.rfind(b"\n", 0, remaining) + 1]
+                if not block:
+                    break
+            out.write(block)
+            written += len(block)
+        emit("\\.\n\n")
+    for name, _kind, _n in plan:
+        emit(f"CREATE INDEX {name}_ref_idx ON public.{name} (ref);\n")
+    emit("\n--\n-- PostgreSQL database dump complete\n--\n")
+    return written
+
+
+def _fake_pg_dump(args):
+    spec = json.loads(os.environ.get(DUMP_SPEC_ENV, "{}"))
+    shape = spec.get("shape", "mixed")
+    size = int(spec.get("size", 64 * 1024 * 1024))
+    seed = int(spec.get("seed", 0))
+    out = None
+    directory = False
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '-f':
+            out = args[i + 1]
+            i += 1
+        elif a == '-Fd':
+            directory = True
+        i += 1
+    if directory:
+        # Directory format: a toc.dat plus one gzip-compressed data file, like pg_dump -Fd
+        os.makedirs(out, exist_ok=True)
+        with open(os.path.join(out, "toc.dat"), 'wb') as f:
+            f.write(b"PGDMP" + json.dumps(spec).encode())
+        with gzip.open(os.path.join(out, "3000.dat.gz"), 'wb', compresslevel=1) as f:
+            generate_dump(f, shape, size, seed)
+        return 0
+    if out:
+        with open(out, 'wb') as f:
+            generate_dump(f, shape, size, seed)
+    else:
+        generate_dump(sys.stdout.buffer, shape, size, seed)
+        sys.stdout.buffer.flush()
+    return 0
+
+
+def _drain(src):
+    while src.read(1024 * 1024):
+        pass
+
+
+def _fake_psql(args):
+    if '-c' in args:
+        # Catalog queries and session termination: nothing to report
+        return 0
+    if '-f' in args:
+        with open(args[args.index('-f') + 1], 'rb') as f:
+            _drain(f)
+        return 0
+    _drain(sys.stdin.buffer)
+    return 0
+
+
+def _fake_pg_restore(args):
+    for root, _dirs, files in os.walk(args[-1]):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as f:
+                _drain(f)
+    return 0
+
+
+def fake_main(tool):
+    """Entry point of the stand-in client tools written by install_fake_tools."""
+    args = sys.argv[1:]
+    if tool == "pg_dump":
+        return _fake_pg_dump(args)
+    if tool == "psql":
+        return _fake_psql(args)
+    if tool == "pg_restore":
+        return _fake_pg_restore(args)
+    # createdb / dropdb always succeed
+    return 0
+
+
+def install_fake_tools(bin_dir):
+    """Writes executable stand-ins for the PostgreSQL client tools into bin_dir."""
+    if sys.platform == "win32":
+        raise EnvironmentError("The benchmark's stand-in tools are Python scripts and need a POSIX system.")
+    os.makedirs(bin_dir, exist_ok=True)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    for tool in FAKE_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write(f"#!{sys.executable}\n")
+            f.write("import sys\n")
+            f.write(f"sys.path.insert(0, {repo_dir!r})\n")
+            f.write("import benchmark\n")
+            f.write(f"sys.exit(benchmark.fake_main({tool!r}))\n")
+        os.chmod(path, 0o755)
+
+
+class DiskSampler:
+    """Background thread that records the size of every file under some directories.
+
+    The samples are kept so that peak() can leave files out once the run
+    is over and the path of the archive it produced is known.
+    """
+
+    def __init__(self, dirs, interval=DISK_SAMPLE_INTERVAL):
+        self.dirs = dirs
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        sizes = {}
+        for d in self.dirs:
+            for root, _dirs, files in os.walk(d):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        sizes[path] = os.path.getsize(path)
+                    except OSError:
+                        # Removed between listing and stat
+                        pass
+        self.samples.append(sizes)
+        return sizes
+
+    def peak(self, exclude=None):
+        """Largest total size seen, not counting the files for which exclude(path) is true."""
+        exclude = exclude or (lambda path: False)
+        return max((sum(size for path, size in sizes.items() if not exclude(path)) for sizes in self.samples), default=0)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return False
+
+
+def _maxrss_bytes(who):
+    import resource
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _run_operation(operation, case, work_dir, bin_dir, result_queue):
+    """Runs one backup or restore in a fresh process so peak RSS belongs to it alone."""
+    import resource
+    import archive_digests
+    import backup_catalog
+    import backup_postgres
+    import restore_postgres
+
+    tmp_dir = os.path.join(work_dir, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tempfile.tempdir = tmp_dir
+    logging.basicConfig(
+        filename=os.path.join(work_dir, "benchmark.log"),
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    os.environ[DUMP_SPEC_ENV] = json.dumps({"shape": case["shape"], "size": case["size"], "seed": case["seed"]})
+    backup_dir = os.path.abspath(os.path.join(work_dir, "backups"))
+    metrics_file = os.path.join(work_dir, f"{operation}_metrics.jsonl")
+
+    def excluder(archive):
+        # Only the finished archive, its digest file and the catalog are left
+        # out; pg_dump's directory-format output is scratch space
+        kept = {os.path.abspath(archive), os.path.abspath(archive_digests.digest_path(archive))}
+
+        def exclude(path):
+            return path in kept or (os.path.dirname(path) == backup_dir and os.path.basename(path).startswith(backup_catalog.CATALOG_FILENAME))
+        return exclude
+
+    result = {"operation": operation}
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+                DiskSampler([backup_dir, tmp_dir]) as sampler:
+            started = time.perf_counter()
+            if operation == "backup":
+                result["archive"] = backup_postgres.backup_postgres(
+                    "bench", 5432, "bench", "bench", "bench",
+                    backup_dir=backup_dir,
+                    bin_dir=bin_dir,
+                    stream=case["stream"],
+                    dump_format=case["format"],
+                    jobs=case["jobs"],
+                    codec=case["codec"],
+                    compress_level=case["level"],
+                    compress_threads=case["threads"],
+                    metrics_file=metrics_file,
+                )
+            else:
+                restore_postgres.restore_postgres(
+                    "bench", 5432, "bench_restore", "bench", "bench", case["archive"],
+                    auto_confirm=True,
+                    bin_dir=bin_dir,
+                    stream=case["stream"],
+                    jobs=case["jobs"],
+                    metrics_file=metrics_file,
+                )
+            result["seconds"] = round(time.perf_counter() - started, 3)
+        result["status"] = "success"
+        result["peak_temp_bytes"] = sampler.peak(excluder(result["archive"] if operation == "backup" else case["archive"]))
+        result["peak_rss_bytes"] = _maxrss_bytes(resource.RUSAGE_SELF)
+        result["tool_peak_rss_bytes"] = _maxrss_bytes(resource.RUSAGE_CHILDREN)
+        with open(metrics_file) as f:
+            result["metrics"] = json.loads(f.readlines()[-1])
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result_queue.put(result)
+
+
+def run_in_child(operation, case, work_dir, bin_dir):
+    """Runs one operation in a spawned process and returns its result.
+
+    A child that dies without posting one (killed for memory, crashed, or
+    failed before it could report) gives a failed result with its exit code.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=_run_operation, args=(operation, case, work_dir, bin_dir, result_queue))
+    proc.start()
+    while True:
+        try:
+            result = result_queue.get(timeout=CHILD_POLL_INTERVAL)
+            break
+        except queue.Empty:
+            if proc.is_alive():
+                continue
+        try:
+            # Posted just before the child exited
+            result = result_queue.get(timeout=CHILD_POLL_INTERVAL)
+        except queue.Empty:
+            result = {"operation": operation, "status": "failed", "error": f"{operation} process exited with code {proc.exitcode} without a result"}
+        break
+    proc.join()
+    return result
+
+
+def _summary(result, uncompressed_bytes=None):
+    """Throughput figures of one backup or restore result.
+
+    A restore passes the uncompressed size of the archive it read, which
+    its own metrics do not record for every format.
+    """
+    metrics = result.get("metrics", {})
+    dumped = uncompressed_bytes or metrics.get("uncompressed_bytes")
+    summary = {
+        "status": result["status"],
+        "seconds": result.get("seconds"),
+        "peak_rss_bytes": result.get("peak_rss_bytes"),
+        "tool_peak_rss_bytes": result.get("tool_peak_rss_bytes"),
+        "peak_temp_bytes": result.get("peak_temp_bytes"),
+        "uncompressed_bytes": dumped,
+        "compressed_bytes": metrics.get("compressed_bytes"),
+        "compression_ratio": metrics.get("compression_ratio"),
+        "mb_per_second": round(dumped / result["seconds"] / 1e6, 2) if dumped and result.get("seconds") else None,
+        "phases": metrics.get("phases", []),
+    }
+    if result["status"] != "success":
+        summary["error"] = result.get("error")
+    return summary
+
+
+def case_name(case):
+    name = f"{case['shape']}-{case['format']}-{case['codec']}"
+    if case["level"] is not None:
+        name += f"-l{case['level']}"
+    if case["threads"] > 1:
+        name += f"-t{case['threads']}"
+    if case["jobs"] > 1:
+        name += f"-j{case['jobs']}"
+    if not case["stream"]:
+        name += "-nostream"
+    return name
+
+
+def run_case(case, work_root):
+    """Backs up and restores one synthetic database; returns the case's results."""
+    work_dir = tempfile.mkdtemp(prefix=f"{case_name(case)}_", dir=work_root)
+    bin_dir = os.path.join(work_dir, "bin")
+    install_fake_tools(bin_dir)
+    try:
+        backup = run_in_child("backup", case, work_dir, bin_dir)
+        record = {"case": case_name(case), "config": dict(case), "backup": _summary(backup)}
+        if backup["status"] == "success":
+            restore = run_in_child("restore", dict(case, archive=backup["archive"]), work_dir, bin_dir)
+            record["restore"] = _summary(restore, record["backup"]["uncompressed_bytes"])
+        return record
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(results, baseline):
+    """Returns printable lines comparing throughput against a previous results file."""
+    previous = {r["case"]: r for r in baseline.get("cases", [])}
+    lines = []
+    for r in results["cases"]:
+        old = previous.get(r["case"])
+        if not old:
+            continue
+        for op in ("backup", "restore"):
+            new_rate = r.get(op, {}).get("mb_per_second")
+            old_rate = old.get(op, {}).get("mb_per_second")
+            if new_rate and old_rate:
+                change = (new_rate - old_rate) / old_rate * 100
+                lines.append(f"{r['case']:<48} {op:<8} {old_rate:>9.1f} -> {new_rate:>9.1f} MB/s ({change:+.1f}%)")
+    return lines
+
+
+def run_benchmarks(shapes, size, codecs, formats, levels=(None,), threads=1, jobs=1, stream=True, seed=0, repeat=1, work_root=None):
+    """Runs every combination of the given settings and returns the results document."""
+    work_root = work_root or tempfile.gettempdir()
+    os.makedirs(work_root, exist_ok=True)
+    cases = []
+    for shape in shapes:
+        for dump_format in formats:
+            for codec in codecs:
+                for level in levels:
+                    case = {
+                        "shape": shape,
+                        "size": size,
+                        "seed": seed,
+                        "format": dump_format,
+                        "codec": codec,
+                        "level": level,
+                        "threads": threads,
+                        "jobs": jobs if dump_format == "directory" else 1,
+                        "stream": stream,
+                    }
+                    for _ in range(repeat):
+                        print(f"Running {case_name(case)}...")
+                        record = run_case(case, work_root)
+                        logging.info(f"Benchmark {record['case']}: {json.dumps(record)}")
+                        cases.append(record)
+                        for op in ("backup", "restore"):
+                            if op in record:
+                                s = record[op]
+                                if s["status"] == "success":
+                                    rate = f"{s['mb_per_second']:>9.1f} MB/s" if s["mb_per_second"] else f"{'-':>9} MB/s"
+                                    print(f"  {op:<8} {s['seconds']:>8.2f}s  {rate}  "
+                                          f"rss {s['peak_rss_bytes'] / 2**20:>7.1f} MiB  temp {s['peak_temp_bytes'] / 2**20:>8.1f} MiB")
+                                else:
+                                    print(f"  {op:<8} failed: {s.get('error')}")
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cases": cases,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark backup and restore throughput against stand-in PostgreSQL tools.")
+    parser.add_argument("--shape", action="append", choices=SHAPES, help="Synthetic dump shape (repeatable, default: mixed)")
+    parser.add_argument("--size-mb", type=int, default=256, help="Approximate uncompressed dump size in MiB")
+    parser.add_argument("--codec", action="append", help="Compression codec to benchmark (repeatable, default: zip)")
+    parser.add_argument("--format", action="append", choices=("plain", "directory"), help="Dump format (repeatable, default: plain)")
+    parser.add_argument("--compress-level", type=int, action="append", help="Compression level (repeatable, default: codec default)")
+    parser.add_argument("--compress-threads", type=int, default=1, help="Compression threads (gzip and zstd only)")
+    parser.add_argument("--jobs", type=int, default=1, help="Parallel pg_dump / pg_restore jobs for the directory format")
+    parser.add_argument("--no-stream", action="store_true", help="Benchmark the legacy dump-to-disk pipeline")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--repeat", type=int, default=1, help="Run every case this many times")
+    parser.add_argument("--work-dir", help="Scratch directory for archives (default: system temp dir)")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Previous results file to compare throughput against")
+
+    args = parser.parse_args()
+
+    # Configure logging for CLI usage
+    logging.basicConfig(
+        filename='benchmark.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    results = run_benchmarks(
+        args.shape or ["mixed"],
+        args.size_mb * 1024 * 1024,
+        args.codec or ["zip"],
+        args.format or ["plain"],
+        levels=args.compress_level or [None],
+        threads=args.compress_threads,
+        jobs=args.jobs,
+        stream=not args.no_stream,
+        seed=args.seed,
+        repeat=args.repeat,
+        work_root=args.work_dir,
+    )
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            for line in compare(results, json.load(f)):
+                print(line)
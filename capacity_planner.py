@@ -0,0 +1,419 @@
+import os
+import shutil
+import logging
+import statistics
+
+import archive_digests
+import backup_catalog
+import incremental_backup
+import run_metrics
+import storage_backends
+
+# Logging is configured in the main block or by the importing application
+
+DATABASE_SIZE_QUERY = "SELECT pg_database_size(current_database());"
+
+# Heap and TOAST size of every table and materialized view, without indexes:
+# roughly what a logical dump writes out
+TABLE_SIZES_QUERY = (
+    "SELECT n.nspname, c.relname, pg_table_size(c.oid) "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind IN ('r', 'm') AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+    "AND n.nspname NOT LIKE 'pg_toast%' ORDER BY 3 DESC;"
+)
+
+# (fastest, default, smallest) compression level of each codec; "auto" picks among them
+COMPRESS_LEVELS = {
+    "zip": (1, 6, 9),
+    "gzip": (1, 6, 9),
+    "zstd": (1, 3, 19),
+    "lz4": (0, 0, 12),
+    "xz": (0, 6, 9),
+}
+
+# Uncompressed / compressed size of a typical SQL dump at the codec's default
+# level, used until the history has a run with the codec
+DEFAULT_RATIOS = {"zip": 4.0, "gzip": 4.0, "zstd": 4.5, "lz4": 2.5, "xz": 6.0, "chunks": 4.5}
+
+# Throughput and ratio of the fastest and smallest levels relative to the
+# default one, used until the history has a run at that level
+FAST_LEVEL_FACTORS = (2.0, 0.85)
+SMALL_LEVEL_FACTORS = (0.35, 1.15)
+
+# pg_dump -Fd compresses every table file with gzip at its default level
+DIRECTORY_DUMP_RATIO = DEFAULT_RATIOS["gzip"]
+
+# Free space required on top of the estimate, as a fraction of it
+SPACE_MARGIN = 0.1
+
+# Most parallel pg_dump jobs picked automatically
+MAX_AUTO_JOBS = 8
+
+# Most recent successful runs of the database the estimate is based on
+HISTORY_RUNS = 5
+
+
+def read_database_size(psql_cmd, env):
+    """Returns (pg_database_size, [(schema.table, bytes), ...] largest first)."""
+    rows = incremental_backup.run_query(psql_cmd, env, DATABASE_SIZE_QUERY)
+    database_size = int(rows[0][0]) if rows and rows[0][0] else 0
+    tables = [(f"{schema}.{name}", int(size or 0)) for schema, name, size in incremental_backup.run_query(psql_cmd, env, TABLE_SIZES_QUERY)]
+    return database_size, tables
+
+
+def read_history(database, metrics_file=None, backup_dir=".", catalog_path=None):
+    """Past successful backups of a database, newest first, as plain dicts.
+
+    Run records in `metrics_file` (see run_metrics) are used when there
+    are any, as they also hold the compression level, job count and
+    database size. Otherwise the backup catalog gives each archive's size
+    and duration, and its digest file the dump size.
+    """
+    runs = []
+    for r in reversed(run_metrics.read_records(metrics_file, operation="backup", database=database)):
+        if r.get("status") != "success" or not r.get("uncompressed_bytes") or not r.get("duration_seconds"):
+            continue
+        runs.append({
+            "codec": r.get("codec"),
+            "compress_level": r.get("compress_level"),
+            "dump_format": r.get("dump_format"),
+            "jobs": r.get("jobs") or 1,
+            "database_size": r.get("database_size"),
+            "uncompressed_bytes": r["uncompressed_bytes"],
+            "compressed_bytes": r.get("compressed_bytes"),
+            "seconds": r["duration_seconds"],
+        })
+    if runs:
+        return runs[:HISTORY_RUNS]
+
+    catalog = backup_catalog.BackupCatalog(catalog_path or backup_catalog.default_catalog_path(backup_dir), backup_dir)
+    for b in catalog.list_backups(database):
+        # The digests of incremental and parallel archives do not cover a whole plain dump
+        if not b["duration"] or b["dump_format"] in ("incremental", "parallel") or storage_backends.is_url(b["path"]):
+            continue
+        record = archive_digests.read_digests(b["path"])
+        if not record or not record.get("dump_size"):
+            continue
+        runs.append({
+            "codec": b["codec"],
+            "compress_level": None,
+            "dump_format": b["dump_format"],
+            "jobs": 1,
+            "database_size": None,
+            "uncompressed_bytes": record["dump_size"],
+            "compressed_bytes": b["size"],
+            "seconds": b["duration"],
+        })
+        if len(runs) == HISTORY_RUNS:
+            break
+    return runs
+
+
+def logical_bytes(run):
+    """Plain-SQL size of a past run's dump.
+
+    A directory-format run records the size of its packaged, already
+    compressed table files.
+    """
+    if run["dump_format"] == "directory":
+        return int(run["uncompressed_bytes"] * DIRECTORY_DUMP_RATIO)
+    return run["uncompressed_bytes"]
+
+
+def format_duration(seconds):
+    return f"{seconds:.0f}s" if seconds < 120 else f"{seconds / 60:.1f} min"
+
+
+def _existing(path):
+    """`path` or its nearest existing parent."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def free_space(path):
+    """Free bytes on the filesystem holding `path` (or its nearest existing parent)."""
+    return shutil.disk_usage(_existing(path)).free
+
+
+def same_filesystem(path, other):
+    """True if both paths (or their nearest existing parents) are on the same filesystem."""
+    return os.stat(_existing(path)).st_dev == os.stat(_existing(other)).st_dev
+
+
+def level_factors(codec, level):
+    """(throughput, ratio) multipliers of a compression level relative to the codec default.
+
+    Interpolated between the fastest, default and smallest levels of
+    COMPRESS_LEVELS; 1.0 for codecs without levels.
+    """
+    if codec not in COMPRESS_LEVELS or level is None:
+        return 1.0, 1.0
+    fast, default, small = COMPRESS_LEVELS[codec]
+    if level < default and default > fast:
+        share, (speed, ratio) = (default - level) / (default - fast), FAST_LEVEL_FACTORS
+    elif level > default and small > default:
+        share, (speed, ratio) = (level - default) / (small - default), SMALL_LEVEL_FACTORS
+    else:
+        return 1.0, 1.0
+    share = min(share, 1.0)
+    return 1.0 + (speed - 1.0) * share, 1.0 + (ratio - 1.0) * share
+
+
+def _level(codec, level):
+    # None means the codec default
+    if level is None and codec in COMPRESS_LEVELS:
+        return COMPRESS_LEVELS[codec][1]
+    return level
+
+
+def parallel_speedup(jobs, table_sizes):
+    """How much faster pg_dump -j `jobs` dumps these tables than one job.
+
+    Each table is dumped by one worker, so the largest table bounds it.
+    """
+    total = sum(size for _name, size in table_sizes)
+    largest = max((size for _name, size in table_sizes), default=0)
+    if not largest:
+        return 1.0
+    return max(1.0, min(jobs, total / largest))
+
+
+def dump_speedup(dump_format, jobs, table_sizes):
+    """How much faster a dump in this format runs with `jobs` workers than with one.
+
+    The parallel format splits large tables into ctid ranges, so no single
+    table bounds it.
+    """
+    if dump_format == "directory":
+        return parallel_speedup(jobs, table_sizes)
+    if dump_format == "parallel":
+        return float(max(1, jobs))
+    return 1.0
+
+
+def pick_jobs(table_sizes, cpu_count=None, max_jobs=MAX_AUTO_JOBS):
+    """Number of pg_dump -Fd jobs worth running for these tables.
+
+    Adding workers stops helping once the largest table alone takes as
+    long as the rest; there is no point either in more workers than
+    cores or non-empty tables.
+    """
+    tables = [size for _name, size in table_sizes if size > 0]
+    if not tables:
+        return 1
+    limit = min(cpu_count or os.cpu_count() or 1, max_jobs, len(tables))
+    return max(1, min(limit, int(sum(tables) / max(tables))))
+
+
+class CapacityEstimate:
+    """Predicted dump size, archive size, disk space and duration of one backup.
+
+    `seconds` is None when the history has no run to derive a throughput
+    from. `refusal` holds the reason the backup should not start, or None.
+    """
+
+    def __init__(self, database, database_size, dump_bytes, dump_source):
+        self.database = database
+        self.database_size = database_size
+        self.dump_bytes = dump_bytes
+        self.dump_source = dump_source
+        self.codec = None
+        self.compress_level = None
+        self.jobs = 1
+        self.archive_bytes = None
+        self.needed_bytes = None
+        self.free_bytes = None
+        self.seconds = None
+        self.max_seconds = None
+        self.refusal = None
+        self.notes = []
+
+    def fits(self):
+        space = self.free_bytes is None or self.needed_bytes * (1 + SPACE_MARGIN) <= self.free_bytes
+        window = self.max_seconds is None or self.seconds is None or self.seconds <= self.max_seconds
+        return space and window
+
+    def to_dict(self):
+        return {
+            "database_size": self.database_size,
+            "dump_bytes": self.dump_bytes,
+            "dump_estimate_source": self.dump_source,
+            "archive_bytes": self.archive_bytes,
+            "needed_bytes": self.needed_bytes,
+            "free_bytes": self.free_bytes,
+            "seconds": round(self.seconds, 1) if self.seconds is not None else None,
+            "max_seconds": self.max_seconds,
+            "codec": self.codec,
+            "compress_level": self.compress_level,
+            "jobs": self.jobs,
+            "refused": self.refusal,
+        }
+
+    def summary(self):
+        text = (f"Pre-flight: database {self.database_size / 1e6:.1f} MB, dump ~{self.dump_bytes / 1e6:.1f} MB ({self.dump_source}), "
+                f"archive ~{self.archive_bytes / 1e6:.1f} MB")
+        if self.free_bytes is not None:
+            text += f", needs ~{self.needed_bytes / 1e6:.1f} MB of {self.free_bytes / 1e6:.1f} MB free"
+        text += f", ~{format_duration(self.seconds)}" if self.seconds is not None else ", duration unknown (no earlier run)"
+        if self.compress_level is not None:
+            text += f"; {self.codec} level {self.compress_level}"
+        if self.jobs > 1:
+            text += f", {self.jobs} jobs"
+        return text
+
+
+def estimate_backup(database, database_size, table_sizes, history, codec, dump_format="plain", stream=True, compress_level=None, jobs=1, free_bytes=None, scratch_free_bytes=None, same_filesystem=True, max_seconds=None, cpu_count=None):
+    """Predicts a backup's size and duration and sizes it to fit the space and time available.
+
+    `history` comes from read_history. The dump size is scaled from the
+    newest earlier full run (by database size when known), or else taken as
+    the tables' size. The compression ratio and throughput come from earlier
+    runs with the same codec and format, adjusted for the level (see
+    level_factors), or from DEFAULT_RATIOS when there are none.
+
+    jobs="auto" picks the pg_dump -Fd job count (see pick_jobs), or one
+    COPY worker per core for the parallel format.
+    compress_level="auto" takes the codec's smallest, default or fastest
+    level: the smallest-output one that fits both `max_seconds` and
+    `free_bytes`, preferring the default when the duration is unknown.
+    `free_bytes` is the space where the archive goes (None for object
+    storage) and `scratch_free_bytes` where a directory-format, parallel or
+    unstreamed dump is written first. With same_filesystem both come out
+    of the same free space, so their sum must fit; otherwise each is checked
+    on its own. If nothing fits, `refusal` says why.
+    """
+    tables_size = sum(size for _name, size in table_sizes)
+    # An incremental run dumps only the changed tables; for an incremental
+    # backup the full size is an upper bound
+    full_runs = [r for r in history if r["dump_format"] != "incremental"]
+    latest = full_runs[0] if full_runs else None
+    if latest and latest["database_size"] and database_size:
+        dump_bytes = int(logical_bytes(latest) * database_size / latest["database_size"])
+        source = "scaled from the last backup"
+    elif latest:
+        dump_bytes = logical_bytes(latest)
+        source = "size of the last backup"
+    else:
+        dump_bytes = tables_size or database_size
+        source = "table sizes"
+    estimate = CapacityEstimate(database, database_size, dump_bytes, source)
+    estimate.codec = codec
+    estimate.max_seconds = max_seconds
+
+    if jobs == "auto":
+        if dump_format == "directory":
+            jobs = pick_jobs(table_sizes, cpu_count)
+        elif dump_format == "parallel":
+            jobs = min(cpu_count or os.cpu_count() or 1, MAX_AUTO_JOBS)
+        else:
+            jobs = 1
+        estimate.notes.append(f"{jobs} parallel job(s) for {len(table_sizes)} table(s)")
+    estimate.jobs = jobs
+
+    similar = [r for r in history if r["codec"] == codec and r["dump_format"] == dump_format] or [r for r in history if r["codec"] == codec]
+
+    def predict(level):
+        speed_factor, ratio_factor = level_factors(codec, _level(codec, level))
+        ratios, speeds = [], []
+        for r in similar:
+            hist_speed, hist_ratio = level_factors(codec, _level(codec, r["compress_level"]))
+            if r["compressed_bytes"] and r["dump_format"] not in ("directory", "incremental"):
+                ratios.append(r["uncompressed_bytes"] / r["compressed_bytes"] / hist_ratio)
+            hist_speedup = dump_speedup(r["dump_format"], r["jobs"], table_sizes)
+            speeds.append(logical_bytes(r) / r["seconds"] / hist_speed / hist_speedup)
+        ratio = (statistics.median(ratios) if ratios else DEFAULT_RATIOS.get(codec, DEFAULT_RATIOS["zip"])) * ratio_factor
+        if dump_format == "directory":
+            # The table files are compressed by pg_dump already; the archive barely shrinks them
+            ratio = DIRECTORY_DUMP_RATIO
+        archive_bytes = int(dump_bytes / ratio)
+        seconds = None
+        if speeds:
+            speedup = dump_speedup(dump_format, jobs, table_sizes)
+            seconds = dump_bytes / (statistics.median(speeds) * speed_factor * speedup)
+        return archive_bytes, seconds
+
+    def size(level):
+        estimate.compress_level = _level(codec, level)
+        estimate.archive_bytes, estimate.seconds = predict(level)
+        scratch = 0
+        if dump_format == "directory":
+            scratch = int(dump_bytes / DIRECTORY_DUMP_RATIO)
+        elif dump_format == "plain" and not stream:
+            scratch = dump_bytes
+        elif dump_format == "parallel":
+            # The compressed shards are written out before they are packaged
+            scratch = estimate.archive_bytes
+        if free_bytes is None:
+            # Object storage: only the scratch space is local
+            estimate.needed_bytes = scratch
+            estimate.free_bytes = scratch_free_bytes if scratch else None
+        elif scratch_free_bytes is not None and not same_filesystem:
+            # Scratch and archive live on different filesystems; check the tighter one
+            estimate.needed_bytes = estimate.archive_bytes
+            estimate.free_bytes = free_bytes
+            if scratch and scratch * (1 + SPACE_MARGIN) > scratch_free_bytes:
+                estimate.needed_bytes, estimate.free_bytes = scratch, scratch_free_bytes
+        else:
+            estimate.needed_bytes = estimate.archive_bytes + scratch
+            estimate.free_bytes = free_bytes
+        return estimate.fits()
+
+    if compress_level == "auto" and codec in COMPRESS_LEVELS:
+        fast, default, small = COMPRESS_LEVELS[codec]
+        if predict(default)[1] is None:
+            # No throughput known: stay at the default unless only the smallest output fits
+            candidates = [default, small]
+        else:
+            candidates = [small, default, fast]
+        for level in dict.fromkeys(candidates):
+            if size(level):
+                break
+        estimate.notes.append(f"compression level {estimate.compress_level} picked from {', '.join(str(c) for c in dict.fromkeys(candidates))}")
+    else:
+        size(None if compress_level == "auto" else compress_level)
+
+    if not estimate.fits():
+        if estimate.free_bytes is not None and estimate.needed_bytes * (1 + SPACE_MARGIN) > estimate.free_bytes:
+            estimate.refusal = (f"not enough free space: the backup needs ~{estimate.needed_bytes / 1e6:.1f} MB "
+                                f"(plus {SPACE_MARGIN:.0%} headroom) but only {estimate.free_bytes / 1e6:.1f} MB are free")
+        else:
+            estimate.refusal = f"the backup would take ~{format_duration(estimate.seconds)}, longer than the {format_duration(max_seconds)} allowed"
+    return estimate
+
+
+def preflight(database, psql_cmd, env, codec, dump_format="plain", stream=True, compress_level=None, jobs=1, backup_dir=".", storage_url=None, chunk_store_dir=None, catalog_path=None, metrics_file=None, max_seconds=None):
+    """Queries the server, reads the history and free space, and returns a CapacityEstimate.
+
+    The archive goes to backup_dir, or to chunk_store_dir for chunk-store
+    backups; with a storage_url only the local scratch space is checked.
+    """
+    database_size, table_sizes = read_database_size(psql_cmd, env)
+    history = read_history(database, metrics_file, backup_dir, catalog_path)
+    scratch_free = free_space(backup_dir)
+    shared = True
+    if storage_url:
+        archive_free = None
+    elif chunk_store_dir:
+        archive_free = free_space(chunk_store_dir)
+        shared = same_filesystem(backup_dir, chunk_store_dir)
+    else:
+        archive_free = scratch_free
+    estimate = estimate_backup(
+        database,
+        database_size,
+        table_sizes,
+        history,
+        codec,
+        dump_format=dump_format,
+        stream=stream,
+        compress_level=compress_level,
+        jobs=jobs,
+        free_bytes=archive_free,
+        scratch_free_bytes=scratch_free,
+        same_filesystem=shared,
+        max_seconds=max_seconds,
+    )
+    logging.info(f"Pre-flight for '{database}' based on {len(history)} earlier run(s): {estimate.to_dict()}")
+    return estimate
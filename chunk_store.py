@@ -0,0 +1,350 @@
+import os
+import io
+import json
+import time
+import zlib
+import hashlib
+import logging
+import tempfile
+import concurrent.futures
+
+import archive_codecs
+
+# Logging is configured in the main block or by the importing application
+
+# Extension of the manifest written to the backup directory for each backup
+MANIFEST_EXTENSION = archive_codecs.MANIFEST_EXTENSION
+
+MANIFEST_FORMAT = "pg_backup_restore-chunks"
+MANIFEST_VERSION = 1
+
+# Chunk size bounds. A boundary is only considered once a chunk reaches
+# MIN_CHUNK_SIZE and is forced at MAX_CHUNK_SIZE.
+MIN_CHUNK_SIZE = 512 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# A line ends a chunk when the low bits of its CRC32 are all zero (1 line in 256)
+BOUNDARY_MASK = 0xFF
+
+# Unreferenced chunks younger than this are never collected, so a backup that
+# is still writing its manifest cannot lose chunks to a concurrent cleanup.
+GC_GRACE_SECONDS = 3600
+
+# Present in the reference directory of stores that have tracked every
+# manifest since they were created; only those are garbage-collected
+REFS_COMPLETE_MARKER = ".complete"
+
+
+def is_manifest(path):
+    """True if the path names a chunk-store manifest."""
+    return path.endswith(MANIFEST_EXTENSION)
+
+
+class ChunkStore:
+    """Content-addressed, deduplicating store of compressed dump chunks.
+
+    Chunks live under <root>/chunks/<first two hex digits>/<sha256> and are
+    zlib-compressed. A chunk that already exists is never written again, so
+    consecutive backups of a mostly-static database only add the chunks
+    that changed. Every manifest written is registered under <root>/refs,
+    wherever it is stored, so garbage collection knows all backups using
+    the store.
+    """
+
+    def __init__(self, root, level=6):
+        self.root = root
+        self.level = level
+        self.chunks_dir = os.path.join(root, "chunks")
+        self.refs_dir = os.path.join(root, "refs")
+        new_store = not os.path.exists(self.chunks_dir)
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+        if new_store:
+            # Stores from before reference tracking lack the marker and are never collected
+            open(os.path.join(self.refs_dir, REFS_COMPLETE_MARKER), 'w').close()
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def put(self, data):
+        """Stores a chunk if it is new. Returns (digest, bytes_written)."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            # Refresh mtime so garbage collection treats the chunk as in use
+            os.utime(path)
+            return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data, self.level)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, len(compressed)
+
+    def get(self, digest):
+        """Returns the uncompressed content of a chunk, verifying its digest."""
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Chunk {digest} is corrupt.")
+        return data
+
+    def writer(self, threads=1):
+        """Returns a ChunkWriter that splits a stream into chunks of this store."""
+        return ChunkWriter(self, threads=threads)
+
+    def write_manifest(self, manifest_path, writer, **metadata):
+        """Writes the manifest of a finished ChunkWriter next to the backups."""
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+        try:
+            store = os.path.relpath(os.path.abspath(self.root), manifest_dir)
+        except ValueError:
+            store = os.path.abspath(self.root)
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "version": MANIFEST_VERSION,
+            "store": store,
+            "size": writer.total_bytes,
+            "chunks": writer.chunks,
+        }
+        manifest.update(metadata)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+        self.register(manifest_path)
+
+    def _ref_path(self, manifest_path):
+        key = hashlib.sha256(os.path.abspath(manifest_path).encode()).hexdigest()
+        return os.path.join(self.refs_dir, key)
+
+    def register(self, manifest_path):
+        """Records that a manifest uses this store."""
+        ref_path = self._ref_path(manifest_path)
+        tmp_path = ref_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(os.path.abspath(manifest_path))
+        os.replace(tmp_path, ref_path)
+
+    def unregister(self, manifest_path):
+        """Forgets a deleted manifest."""
+        try:
+            os.remove(self._ref_path(manifest_path))
+        except FileNotFoundError:
+            pass
+
+    def referenced_chunks(self):
+        """Returns the digests of every chunk a registered manifest lists.
+
+        A reference whose manifest is gone from a reachable directory is
+        dropped. Raises ValueError when the set cannot be established: the
+        store predates reference tracking, or a registered manifest's
+        directory is unreachable or the manifest unreadable.
+        """
+        if not os.path.exists(os.path.join(self.refs_dir, REFS_COMPLETE_MARKER)):
+            raise ValueError(f"Chunk store {self.root} was created before manifests were tracked; its chunks are not collected.")
+        referenced = set()
+        root = os.path.realpath(self.root)
+        for name in os.listdir(self.refs_dir):
+            if name.startswith("."):
+                continue
+            ref_path = os.path.join(self.refs_dir, name)
+            with open(ref_path) as f:
+                manifest_path = f.read()
+            if not os.path.exists(manifest_path):
+                if not os.path.isdir(os.path.dirname(manifest_path)):
+                    raise ValueError(f"Cannot reach the directory of manifest {manifest_path}; not collecting chunk store {self.root}.")
+                os.remove(ref_path)
+                logging.info(f"Dropped reference to deleted manifest {manifest_path}")
+                continue
+            manifest = read_manifest(manifest_path)
+            if os.path.realpath(store_for_manifest(manifest_path, manifest).root) != root:
+                # Overwritten by a manifest of another store
+                os.remove(ref_path)
+                continue
+            referenced.update(digest for digest, _size in manifest["chunks"])
+        return referenced
+
+    def collect_garbage(self, grace_seconds=GC_GRACE_SECONDS):
+        """Deletes chunks not referenced by any registered manifest.
+
+        Raises ValueError instead of deleting anything when the referenced
+        chunks cannot be established (see referenced_chunks). Returns
+        (chunks_deleted, bytes_freed).
+        """
+        referenced = self.referenced_chunks()
+
+        cutoff = time.time() - grace_seconds
+        deleted = 0
+        freed = 0
+        for sub in os.listdir(self.chunks_dir):
+            sub_dir = os.path.join(self.chunks_dir, sub)
+            for digest in os.listdir(sub_dir):
+                path = os.path.join(sub_dir, digest)
+                if digest in referenced or os.path.getmtime(path) >= cutoff:
+                    continue
+                freed += os.path.getsize(path)
+                os.remove(path)
+                deleted += 1
+        logging.info(f"Chunk store GC in {self.root}: deleted {deleted} chunk(s), freed {freed} bytes")
+        return deleted, freed
+
+
+class ChunkWriter(io.RawIOBase):
+    """Writable stream that cuts its input into content-defined chunks.
+
+    Boundaries are placed at the end of a line whose CRC32 matches
+    BOUNDARY_MASK, once the chunk has reached MIN_CHUNK_SIZE. Because the
+    decision depends only on line content, an insert or delete early in a
+    dump shifts boundaries locally instead of changing every later chunk.
+    Input without newlines (e.g. binary data) falls back to MAX_CHUNK_SIZE
+    cuts. With threads > 1 new chunks are hashed and compressed on a thread
+    pool, keeping at most two chunks per thread in flight; cpu_seconds is
+    the CPU time the pool threads spent on the chunks collected so far.
+    """
+
+    def __init__(self, store, threads=1):
+        self.store = store
+        self.chunks = []
+        self.total_bytes = 0
+        self.stored_bytes = 0
+        self.new_chunks = 0
+        self._current = bytearray()
+        self._partial_line = b""
+        self._threads = max(1, threads)
+        self._pending = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads) if self._threads > 1 else None
+        self.cpu_seconds = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        buf = self._partial_line + bytes(data)
+        pos = 0
+        while True:
+            need = MIN_CHUNK_SIZE - len(self._current)
+            if need > 0:
+                # Below the minimum size no boundary can occur: take whole lines in one slice
+                nl = buf.find(b"\n", pos + need - 1)
+                if nl == -1:
+                    break
+                self._current += buf[pos:nl + 1]
+                pos = nl + 1
+                if len(self._current) >= MAX_CHUNK_SIZE:
+                    self._flush_chunk()
+                continue
+            nl = buf.find(b"\n", pos)
+            if nl == -1:
+                break
+            boundary = (zlib.crc32(buf[pos:nl]) & BOUNDARY_MASK) == 0
+            self._current += buf[pos:nl + 1]
+            pos = nl + 1
+            if boundary or len(self._current) >= MAX_CHUNK_SIZE:
+                self._flush_chunk()
+        self._partial_line = buf[pos:]
+        while len(self._current) + len(self._partial_line) >= MAX_CHUNK_SIZE:
+            cut = MAX_CHUNK_SIZE - len(self._current)
+            self._current += self._partial_line[:cut]
+            self._partial_line = self._partial_line[cut:]
+            self._flush_chunk()
+        return size
+
+    def _flush_chunk(self):
+        if not self._current:
+            return
+        data = bytes(self._current)
+        self._current.clear()
+        if self._executor is None:
+            self._record(len(data), *self.store.put(data))
+            return
+        self._pending.append((len(data), self._executor.submit(self._put, data)))
+        while len(self._pending) > self._threads * 2:
+            self._collect_one()
+
+    def _put(self, data):
+        # Runs on a pool thread, so that thread's CPU time is all this chunk's
+        started = time.thread_time()
+        digest, written = self.store.put(data)
+        return digest, written, time.thread_time() - started
+
+    def _collect_one(self):
+        size, future = self._pending.pop(0)
+        digest, written, cpu = future.result()
+        self.cpu_seconds += cpu
+        self._record(size, digest, written)
+
+    def _record(self, size, digest, written):
+        self.chunks.append([digest, size])
+        self.total_bytes += size
+        self.stored_bytes += written
+        if written:
+            self.new_chunks += 1
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._current += self._partial_line
+                self._partial_line = b""
+                self._flush_chunk()
+                while self._pending:
+                    self._collect_one()
+            finally:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
+
+
+class ManifestReader(io.RawIOBase):
+    """Readable stream that reassembles a backup from its manifest."""
+
+    def __init__(self, store, chunks):
+        self._store = store
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            entry = next(self._chunks, None)
+            if entry is None:
+                return 0
+            self._buffer = memoryview(self._store.get(entry[0]))
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def read_manifest(manifest_path):
+    """Loads and validates a manifest file."""
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError(f"'{manifest_path}' is not a chunk-store manifest.")
+    return manifest
+
+
+def store_for_manifest(manifest_path, manifest=None):
+    """Opens the chunk store a manifest refers to."""
+    manifest = manifest or read_manifest(manifest_path)
+    root = manifest["store"]
+    if not os.path.isabs(root):
+        root = os.path.join(os.path.dirname(os.path.abspath(manifest_path)), root)
+    return ChunkStore(root)
+
+
+def open_manifest_reader(manifest_path):
+    """Opens a readable stream of the dump described by a manifest."""
+    manifest = read_manifest(manifest_path)
+    store = store_for_manifest(manifest_path, manifest)
+    return io.BufferedReader(ManifestReader(store, manifest["chunks"]), buffer_size=MAX_CHUNK_SIZE)
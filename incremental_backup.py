@@ -0,0 +1,380 @@
+import io
+import os
+import json
+import time
+import logging
+import zipfile
+import datetime
+import subprocess
+
+# Logging is configured in the main block or by the importing application
+
+# Name of the manifest member inside an incremental archive
+MANIFEST_MEMBER = "incremental.json"
+
+MANIFEST_FORMAT = "pg_backup_restore-incremental"
+MANIFEST_VERSION = 1
+
+# Field separator for psql's unaligned output (cannot appear in identifiers in practice)
+FIELD_SEP = "\x1f"
+
+# Modification counters, plus a fingerprint of the column names, positions
+# and types: ALTER TABLE can change those without touching either
+TABLE_STATS_QUERY = (
+    "SELECT s.relid, s.schemaname, s.relname, pg_relation_filenode(s.relid), "
+    "s.n_tup_ins, s.n_tup_upd, s.n_tup_del, "
+    "(SELECT md5(string_agg(a.attnum || ' ' || a.attname || ' ' || format_type(a.atttypid, a.atttypmod), ',' ORDER BY a.attnum)) "
+    "FROM pg_attribute a WHERE a.attrelid = s.relid AND a.attnum > 0 AND NOT a.attisdropped) "
+    "FROM pg_stat_user_tables s JOIN pg_class c ON c.oid = s.relid "
+    "WHERE c.relkind = 'r' ORDER BY s.schemaname, s.relname;"
+)
+
+# When the statistics were last reset, and whether they are collected at all
+STATS_STATE_QUERY = (
+    "SELECT coalesce(stats_reset::text, ''), current_setting('track_counts') "
+    "FROM pg_stat_database WHERE datname = current_database();"
+)
+
+# Backends report their counters some time after commit (PostgreSQL 15+
+# flushes them up to 60 seconds late; the older statistics collector may lag
+# or drop messages under load). Tables about to be reused are checked again
+# once this long has passed since the snapshot was taken
+STATS_FLUSH_SECONDS = 60
+
+SEQUENCES_QUERY = "SELECT schemaname, sequencename FROM pg_sequences ORDER BY 1, 2;"
+
+
+def quote_pattern(schema, name):
+    """Quotes schema.name as an exact pg_dump -t pattern."""
+    def q(ident):
+        return '"' + ident.replace('"', '""') + '"'
+    return f"{q(schema)}.{q(name)}"
+
+
+def run_query(psql_cmd, env, query):
+    """Runs a query with psql and returns its rows as lists of strings."""
+    cmd = psql_cmd + ['-tA', '-F', FIELD_SEP, '-c', query]
+    result = subprocess.run(cmd, env=env, check=True, capture_output=True)
+    return [line.split(FIELD_SEP) for line in result.stdout.decode().splitlines() if line]
+
+
+def read_table_stats(psql_cmd, env):
+    """Returns {"schema.name": stats} from pg_stat_user_tables for ordinary tables."""
+    tables = {}
+    for relid, schema, name, filenode, ins, upd, dele, columns in run_query(psql_cmd, env, TABLE_STATS_QUERY):
+        tables[f"{schema}.{name}"] = {
+            "schema": schema,
+            "name": name,
+            "relid": int(relid),
+            "filenode": int(filenode) if filenode else None,
+            "n_tup_ins": int(ins),
+            "n_tup_upd": int(upd),
+            "n_tup_del": int(dele),
+            "columns": columns,
+        }
+    return tables
+
+
+def read_stats_state(psql_cmd, env):
+    """Returns (stats_reset, track_counts) for the current database."""
+    rows = run_query(psql_cmd, env, STATS_STATE_QUERY)
+    if not rows:
+        return "", "off"
+    stats_reset, track_counts = rows[0]
+    return stats_reset, track_counts
+
+
+def table_changed(previous, current):
+    """True if a table must be dumped again.
+
+    Any difference in the modification counters counts as a change, including
+    counters going backwards after a statistics reset. TRUNCATE does not
+    touch the counters but gives the table a new filenode, as do VACUUM FULL
+    and CLUSTER; a dropped and re-created table has a new relid. Adding,
+    dropping, renaming or retyping a column changes the column fingerprint
+    (entries from before the fingerprint was recorded count as changed).
+    """
+    if previous is None or current is None:
+        return True
+    for key in ("relid", "filenode", "n_tup_ins", "n_tup_upd", "n_tup_del", "columns"):
+        if previous.get(key) != current.get(key):
+            return True
+    return False
+
+
+class ExportedSnapshot:
+    """Keeps a REPEATABLE READ transaction open in psql and exports its snapshot.
+
+    Every pg_dump started with --snapshot=<id> while the context is active
+    sees exactly the same data, so separately dumped tables stay consistent.
+    """
+
+    def __init__(self, psql_cmd, env):
+        self.psql_cmd = psql_cmd
+        self.env = env
+        self.proc = None
+        self.snapshot_id = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(
+            self.psql_cmd + ['-X', '-tAq', '-v', 'ON_ERROR_STOP=1'],
+            env=self.env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.proc.stdin.write(b"BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;\nSELECT pg_export_snapshot();\n")
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline().decode().strip()
+        if not line:
+            self.proc.kill()
+            self.proc.wait()
+            raise RuntimeError("Could not export a snapshot with pg_export_snapshot().")
+        self.snapshot_id = line
+        logging.info(f"Exported snapshot {self.snapshot_id}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.proc.stdin.write(b"COMMIT;\n")
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.stdout.close()
+        self.proc.wait()
+        return False
+
+
+def read_manifest(archive_path):
+    """Returns the incremental manifest of an archive, or None if it is not incremental."""
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as zipf:
+            if MANIFEST_MEMBER not in zipf.namelist():
+                return None
+            with zipf.open(MANIFEST_MEMBER) as f:
+                manifest = json.load(f)
+    except (zipfile.BadZipFile, OSError):
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    return manifest
+
+
+def referenced_archives(archive_path):
+    """Names of the archives (in the same directory) an incremental archive reads table data from."""
+    manifest = read_manifest(archive_path)
+    if not manifest:
+        return set()
+    return {t["archive"] for t in manifest["tables"].values()}
+
+
+def write_incremental_archive(archive_path, database, pg_dump_cmd, psql_cmd, env, dump_member, previous_path=None, full=False, full_every_days=7, fileobj=None):
+    """Writes an incremental archive and returns its manifest.
+
+    pg_dump_cmd and psql_cmd are the connection parts of the commands (binary,
+    host, port, user, database). dump_member(cmd, writer) runs a dump command
+    into an open archive member and returns the byte count. Tables whose
+    pg_stat_user_tables counters are unchanged since the archive at
+    previous_path point back to their last dump instead of being exported.
+    A full dump is taken when there is no previous archive, when full=True,
+    when the chain's base is older than full_every_days, or when the
+    statistics were reset since the previous archive or are not collected.
+    Because counters reach the statistics late, tables about to be reused
+    are checked again STATS_FLUSH_SECONDS after the snapshot and dumped
+    after all if they changed. With `fileobj` the archive is written to
+    that open binary file instead of archive_path.
+    """
+    archive_name = os.path.basename(archive_path)
+    previous = read_manifest(previous_path) if previous_path else None
+    now = datetime.datetime.now()
+
+    if previous and not full and full_every_days:
+        base_age = now.timestamp() - previous.get("base_created_at", 0)
+        if base_age > full_every_days * 86400:
+            logging.info(f"Chain base {previous['base']} is older than {full_every_days} days; taking a full dump")
+            full = True
+    if not previous:
+        full = True
+
+    stats_reset, track_counts = read_stats_state(psql_cmd, env)
+    if not full and track_counts != "on":
+        logging.info("track_counts is off, so table changes cannot be detected; taking a full dump")
+        full = True
+    if not full and previous.get("stats_reset") != stats_reset:
+        logging.info("Statistics were reset since the previous incremental backup; taking a full dump")
+        full = True
+
+    # Read the counters before the snapshot is taken: any change committed
+    # after this point is either in the dump or shows up as a change next run.
+    stats = read_table_stats(psql_cmd, env)
+    sequences = run_query(psql_cmd, env, SEQUENCES_QUERY)
+
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        "database": database,
+        "created_at": now.timestamp(),
+        "full": full,
+        "base": archive_name if full else previous["base"],
+        "base_created_at": now.timestamp() if full else previous["base_created_at"],
+        "stats_reset": stats_reset,
+        "tables": {},
+    }
+    dumped_tables = 0
+    reused_tables = 0
+
+    with ExportedSnapshot(psql_cmd, env) as snapshot, \
+            zipfile.ZipFile(fileobj or archive_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+        snapshot_time = time.monotonic()
+        base_cmd = pg_dump_cmd + [f'--snapshot={snapshot.snapshot_id}']
+
+        def dump(member, extra_args):
+            with zipf.open(member, 'w', force_zip64=True) as writer:
+                return dump_member(base_cmd + extra_args, writer)
+
+        dump("pre-data.sql", ['--section=pre-data'])
+
+        def dump_table(entry):
+            entry["archive"] = archive_name
+            entry["member"] = f"tables/{entry['relid']}.sql"
+            dump(entry["member"], ['--data-only', '-t', quote_pattern(entry["schema"], entry["name"])])
+
+        reused = []
+        for key, current in stats.items():
+            prev = previous["tables"].get(key) if previous and not full else None
+            entry = dict(current)
+            if prev and not table_changed(prev, current):
+                entry["archive"] = prev["archive"]
+                entry["member"] = prev["member"]
+                reused.append(key)
+            else:
+                dump_table(entry)
+                dumped_tables += 1
+            manifest["tables"][key] = entry
+
+        # A change committed before the snapshot may not have been counted
+        # yet when the counters were read: once it must have been, dump the
+        # reused tables whose counters moved. The entry keeps the earlier
+        # counters, so a change after the snapshot is dumped again next run.
+        if reused:
+            wait = STATS_FLUSH_SECONDS - (time.monotonic() - snapshot_time)
+            if wait > 0:
+                logging.info(f"Waiting {wait:.0f}s for table statistics to settle before reusing {len(reused)} table(s)")
+                time.sleep(wait)
+            settled = read_table_stats(psql_cmd, env)
+            for key in reused:
+                entry = manifest["tables"][key]
+                if table_changed(previous["tables"][key], settled.get(key)):
+                    logging.info(f"Table {key} changed while its statistics were pending; dumping it")
+                    dump_table(entry)
+                    dumped_tables += 1
+                else:
+                    reused_tables += 1
+
+        # Sequence values and large objects are small and always dumped
+        if sequences:
+            seq_args = []
+            for schema, name in sequences:
+                seq_args += ['-t', quote_pattern(schema, name)]
+            dump("data-other.sql", ['--data-only', '-b'] + seq_args)
+        else:
+            dump("data-other.sql", ['--data-only', '-b', '--exclude-table-data=*'])
+
+        dump("post-data.sql", ['--section=post-data'])
+
+        manifest["dumped_tables"] = dumped_tables
+        manifest["reused_tables"] = reused_tables
+        zipf.writestr(MANIFEST_MEMBER, json.dumps(manifest, indent=1))
+
+    logging.info(f"Incremental backup {archive_name}: {dumped_tables} table(s) dumped, {reused_tables} unchanged table(s) reused")
+    return manifest
+
+
+def restore_plan(archive_path):
+    """Returns the ordered (archive_path, member) list that rebuilds the database.
+
+    Schema comes from the newest archive; each table's data comes from the
+    archive that holds its latest dump. Raises FileNotFoundError if any
+    archive in the chain is missing, before anything is restored.
+    """
+    manifest = read_manifest(archive_path)
+    if not manifest:
+        raise ValueError(f"'{archive_path}' is not an incremental archive.")
+    backup_dir = os.path.dirname(os.path.abspath(archive_path))
+
+    plan = [(archive_path, "pre-data.sql")]
+    for entry in manifest["tables"].values():
+        plan.append((os.path.join(backup_dir, entry["archive"]), entry["member"]))
+    plan.append((archive_path, "data-other.sql"))
+    plan.append((archive_path, "post-data.sql"))
+
+    members_by_archive = {}
+    for path, member in plan:
+        if path not in members_by_archive:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Incremental chain is broken: '{path}' is missing.")
+            with zipfile.ZipFile(path, 'r') as zipf:
+                members_by_archive[path] = set(zipf.namelist())
+        if member not in members_by_archive[path]:
+            raise FileNotFoundError(f"Incremental chain is broken: '{member}' is missing from '{path}'.")
+    return plan
+
+
+class ChainReader(io.RawIOBase):
+    """Readable stream that concatenates zip members, opening one at a time.
+
+    An archive stays open while consecutive members come from it, so its
+    central directory is read once rather than once per member.
+    """
+
+    def __init__(self, plan):
+        self._plan = iter(plan)
+        self._zipf = None
+        self._zip_path = None
+        self._current = None
+
+    def readable(self):
+        return True
+
+    def _next_member(self):
+        self._close_current()
+        entry = next(self._plan, None)
+        if entry is None:
+            self._close_zip()
+            return False
+        path, member = entry
+        if path != self._zip_path:
+            self._close_zip()
+            self._zipf = zipfile.ZipFile(path, 'r')
+            self._zip_path = path
+        self._current = self._zipf.open(member, 'r')
+        return True
+
+    def _close_current(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+    def _close_zip(self):
+        if self._zipf is not None:
+            self._zipf.close()
+            self._zipf = None
+            self._zip_path = None
+
+    def readinto(self, b):
+        while True:
+            if self._current is None and not self._next_member():
+                return 0
+            n = self._current.readinto(b)
+            if n:
+                return n
+            self._close_current()
+
+    def close(self):
+        self._close_current()
+        self._close_zip()
+        super().close()
+
+
+def open_chain_reader(archive_path):
+    """Opens a readable stream of the full SQL needed to restore an incremental archive."""
+    return io.BufferedReader(ChainReader(restore_plan(archive_path)), buffer_size=1024 * 1024)
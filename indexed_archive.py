@@ -0,0 +1,292 @@
+import io
+import re
+import json
+import logging
+import zipfile
+
+import incremental_backup
+
+# Logging is configured in the main block or by the importing application
+
+# Name of the table-of-contents member inside an indexed archive
+TOC_MEMBER = "toc.json"
+
+TOC_FORMAT = "pg_backup_restore-indexed"
+TOC_VERSION = 1
+
+# Kind of the SET statements etc. that precede pg_dump's first object
+PREAMBLE = "PREAMBLE"
+
+# Object types that belong to the table named first in their "Name:" header
+# field, e.g. "-- Name: users users_pkey; Type: CONSTRAINT; ..."
+TABLE_PREFIXED_TYPES = ("CONSTRAINT", "FK CONSTRAINT", "TRIGGER", "DEFAULT", "RULE", "POLICY")
+
+# Bytes of each non-data segment kept to resolve the table it belongs to
+SQL_SAMPLE_SIZE = 4096
+
+_IDENT = r'(?:"(?:[^"]|"")+"|[^\s."(]+)'
+_QUALIFIED = re.compile(rf'({_IDENT})\.({_IDENT})')
+_INDEX_TABLE = re.compile(rf'\bON\s+(?:ONLY\s+)?({_IDENT}\.{_IDENT})')
+_OWNED_BY = re.compile(rf'OWNED BY\s+({_IDENT}\.{_IDENT})\.{_IDENT}')
+
+
+def _unquote(ident):
+    if ident.startswith('"'):
+        return ident[1:-1].replace('""', '"')
+    return ident
+
+
+def _split_qualified(text):
+    m = _QUALIFIED.fullmatch(text)
+    if not m:
+        return None
+    return _unquote(m.group(1)), _unquote(m.group(2))
+
+
+def parse_header(line):
+    """Parses a pg_dump object header line into its fields.
+
+    "-- Name: users; Type: TABLE; Schema: public; Owner: app" gives
+    {"name": "users", "type": "TABLE", "schema": "public", "owner": "app"};
+    "-- Data for Name: ..." headers are reported the same way.
+    """
+    text = line.decode("utf-8", "replace").strip()
+    for prefix in ("-- Data for Name: ", "-- Name: "):
+        if text.startswith(prefix):
+            text = "Name: " + text[len(prefix):]
+            break
+    else:
+        return None
+    fields = {}
+    for part in text.split("; "):
+        key, sep, value = part.partition(": ")
+        if sep:
+            fields[key.lower()] = value
+    return fields if "name" in fields and "type" in fields else None
+
+
+class IndexedArchiveWriter(io.RawIOBase):
+    """Writable stream that splits a plain pg_dump into one zip member per object.
+
+    pg_dump precedes every object with a comment header naming it, its type
+    and schema. Each header starts a new member, so a table's DDL, its COPY
+    data, its indexes and its constraints can later be read on their own.
+    COPY data is passed through in bulk and never scanned for headers. The
+    table of contents (member, byte offset and sizes of every object) is
+    written as toc.json when the stream is closed. `path` may also be an
+    open binary file, which is left open.
+    """
+
+    def __init__(self, path, level=None, **metadata):
+        self._zipf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=level)
+        self._metadata = metadata
+        self._buffer = b""
+        self._held = b""
+        self._in_copy = False
+        self._member = None
+        self._current = None
+        self.segments = []
+        self.total_bytes = 0
+        self._start_segment({"type": PREAMBLE, "name": "", "schema": "-"})
+
+    def writable(self):
+        return True
+
+    def _start_segment(self, fields):
+        self._close_member()
+        member = f"segments/{len(self.segments):06d}.sql"
+        self._current = {
+            "member": member,
+            "type": fields["type"],
+            "name": fields["name"],
+            "schema": fields.get("schema", "-"),
+            "size": 0,
+        }
+        self._sample = b""
+        self.segments.append(self._current)
+        self._member = self._zipf.open(member, 'w', force_zip64=True)
+
+    def _close_member(self):
+        if self._member is not None:
+            self._member.close()
+            self._member = None
+            self._current["table"] = self._owning_table(self._current, self._sample)
+
+    def _write_segment(self, data):
+        if not data:
+            return
+        self._member.write(data)
+        self._current["size"] += len(data)
+        if len(self._sample) < SQL_SAMPLE_SIZE:
+            self._sample += data[:SQL_SAMPLE_SIZE - len(self._sample)]
+
+    @staticmethod
+    def _owning_table(segment, sample):
+        """Returns [schema, table] of the table a segment belongs to, or None."""
+        kind = segment["type"]
+        schema = segment["schema"]
+        if kind in ("TABLE", "TABLE DATA"):
+            return [schema, segment["name"]]
+        if kind in TABLE_PREFIXED_TYPES:
+            return [schema, segment["name"].split(" ", 1)[0]]
+        text = sample.decode("utf-8", "replace")
+        if kind == "INDEX":
+            m = _INDEX_TABLE.search(text)
+            return list(_split_qualified(m.group(1))) if m else None
+        if kind == "SEQUENCE OWNED BY":
+            m = _OWNED_BY.search(text)
+            return list(_split_qualified(m.group(1))) if m else None
+        if kind in ("COMMENT", "ACL"):
+            # "TABLE users" or "COLUMN users.email"
+            target_kind, _sep, target = segment["name"].partition(" ")
+            if target_kind in ("TABLE", "COLUMN"):
+                return [schema, target.split(".", 1)[0]]
+        return None
+
+    def write(self, data):
+        size = len(data)
+        buf = self._buffer + bytes(data)
+        pos = 0
+        while pos < len(buf):
+            if self._in_copy:
+                # The end-of-data marker is a line holding only "\."
+                if buf.startswith(b"\\.\n", pos):
+                    end = pos
+                else:
+                    end = buf.find(b"\n\\.\n", pos)
+                    if end != -1:
+                        end += 1
+                if end == -1:
+                    last_nl = buf.rfind(b"\n", pos)
+                    if last_nl == -1:
+                        break
+                    self._write_segment(buf[pos:last_nl + 1])
+                    pos = last_nl + 1
+                    continue
+                self._write_segment(buf[pos:end + 3])
+                pos = end + 3
+                self._in_copy = False
+                continue
+            nl = buf.find(b"\n", pos)
+            if nl == -1:
+                break
+            line = buf[pos:nl + 1]
+            pos = nl + 1
+            self._write_line(line)
+        self._buffer = buf[pos:]
+        self.total_bytes += size
+        return size
+
+    def _write_line(self, line):
+        if self._held:
+            held, self._held = self._held, b""
+            fields = parse_header(line) if line.startswith(b"-- ") else None
+            if fields:
+                self._start_segment(fields)
+            self._write_segment(held)
+        if line == b"--\n":
+            # Possibly the first line of an object header; decided by the next line
+            self._held = line
+            return
+        self._write_segment(line)
+        if line.startswith(b"COPY ") and line.rstrip().endswith(b"FROM stdin;"):
+            self._in_copy = True
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._held:
+                    self._write_segment(self._held)
+                    self._held = b""
+                self._write_segment(self._buffer)
+                self._buffer = b""
+                self._close_member()
+                infos = {i.filename: i for i in self._zipf.infolist()}
+                for segment in self.segments:
+                    info = infos[segment["member"]]
+                    segment["offset"] = info.header_offset
+                    segment["compressed_size"] = info.compress_size
+                toc = {"format": TOC_FORMAT, "version": TOC_VERSION, "size": self.total_bytes, "segments": self.segments}
+                toc.update(self._metadata)
+                self._zipf.writestr(TOC_MEMBER, json.dumps(toc))
+            finally:
+                self._zipf.close()
+        super().close()
+
+
+def read_toc(archive_path):
+    """Returns the table of contents of an indexed archive, or None if it is not one."""
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as zipf:
+            if TOC_MEMBER not in zipf.namelist():
+                return None
+            with zipf.open(TOC_MEMBER) as f:
+                toc = json.load(f)
+    except (zipfile.BadZipFile, OSError):
+        return None
+    if toc.get("format") != TOC_FORMAT:
+        return None
+    return toc
+
+
+def _table_matches(table, tables):
+    schema, name = table
+    for pattern in tables:
+        p_schema, _sep, p_name = pattern.rpartition(".")
+        if p_name == name and (not p_schema or p_schema == schema):
+            return True
+    return False
+
+
+def select_segments(toc, tables=(), schemas=()):
+    """Returns the segments needed to restore some tables and/or schemas.
+
+    `tables` are "schema.table" or bare "table" names (any schema); a table
+    brings its DDL, data, indexes, constraints, triggers, defaults, owned
+    sequences, comments and grants. `schemas` select every object in those
+    schemas. The preamble and the CREATE SCHEMA of every schema involved
+    are always included. With no filter, every segment is returned.
+    """
+    segments = toc["segments"]
+    if not tables and not schemas:
+        return list(segments)
+
+    owned_sequences = set()
+    for s in segments:
+        if s["type"] == "SEQUENCE OWNED BY" and s.get("table") and _table_matches(s["table"], tables):
+            owned_sequences.add((s["schema"], s["name"]))
+
+    selected = []
+    for s in segments:
+        table = s.get("table")
+        if s["schema"] in schemas:
+            selected.append(s)
+        elif table and _table_matches(table, tables):
+            selected.append(s)
+        elif s["type"] in ("SEQUENCE", "SEQUENCE SET") and (s["schema"], s["name"]) in owned_sequences:
+            selected.append(s)
+
+    needed_schemas = set(schemas) | {s["schema"] for s in selected}
+    selected_ids = {id(s) for s in selected}
+    return [
+        s for s in segments
+        if s["type"] == PREAMBLE
+        or (s["type"] == "SCHEMA" and s["name"] in needed_schemas)
+        or id(s) in selected_ids
+    ]
+
+
+def open_reader(archive_path, tables=(), schemas=()):
+    """Opens a readable stream of the selected objects' SQL, in dump order.
+
+    Only the zip members of the selected objects are read.
+    """
+    toc = read_toc(archive_path)
+    if not toc:
+        raise ValueError(f"'{archive_path}' is not an indexed archive.")
+    segments = select_segments(toc, tables, schemas)
+    if tables or schemas:
+        restored = sum(s["size"] for s in segments)
+        logging.info(f"Selective restore from {archive_path}: {len(segments)} of {len(toc['segments'])} object(s), {restored} of {toc['size']} bytes")
+    plan = [(archive_path, s["member"]) for s in segments]
+    return io.BufferedReader(incremental_backup.ChainReader(plan), buffer_size=1024 * 1024)
@@ -0,0 +1,286 @@
+import os
+import json
+import asyncio
+import logging
+import zipfile
+import contextlib
+
+import archive_codecs
+import async_pipeline
+import incremental_backup
+
+# Logging is configured in the main block or by the importing application
+
+# Name of the manifest member inside a parallel archive
+MANIFEST_MEMBER = "parallel.json"
+
+MANIFEST_FORMAT = "pg_backup_restore-parallel"
+MANIFEST_VERSION = 1
+
+# Catalog dump format of parallel COPY archives
+PARALLEL_FORMAT = "parallel"
+
+# Tables larger than this (heap size) are split into ctid ranges of about this size
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+
+# Codec of the shards when the archive codec is zip, the container they are stored in
+DEFAULT_SHARD_CODEC = "gzip"
+
+# Schema and non-table data, dumped with pg_dump from the same snapshot
+PRE_DATA_MEMBER = "pre-data.sql"
+DATA_OTHER_MEMBER = "data-other.sql"
+POST_DATA_MEMBER = "post-data.sql"
+
+# Every ordinary table outside the system schemas, largest first, with its
+# heap size, the block size and the columns COPY can write back (dropped
+# and generated columns left out). attgenerated exists from PostgreSQL 12,
+# so it is read through to_jsonb to keep older servers working. Tables
+# belonging to extensions are created by CREATE EXTENSION; the rows of their
+# configuration tables go through pg_dump (see EXTENSION_CONFIG_QUERY)
+TABLES_QUERY = (
+    "SELECT n.nspname, c.relname, pg_relation_size(c.oid), current_setting('block_size'), "
+    "(SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum) FROM pg_attribute a "
+    "WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped "
+    "AND coalesce(to_jsonb(a) ->> 'attgenerated', '') = '') "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind = 'r' AND c.relpersistence <> 't' "
+    "AND n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%' "
+    "AND NOT EXISTS (SELECT 1 FROM pg_depend d WHERE d.classid = 'pg_class'::regclass AND d.objid = c.oid AND d.deptype = 'e') "
+    "ORDER BY 3 DESC, 1, 2;"
+)
+
+# Extension configuration tables registered with pg_extension_config_dump;
+# pg_dump -t dumps the rows the extension marked as user data
+EXTENSION_CONFIG_QUERY = (
+    "SELECT n.nspname, c.relname FROM pg_extension e "
+    "CROSS JOIN LATERAL unnest(e.extconfig) AS x(oid) "
+    "JOIN pg_class c ON c.oid = x.oid JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "ORDER BY 1, 2;"
+)
+
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def snapshot_session(psql_cmd, snapshot_id):
+    """psql command whose -c commands run in a read-only transaction on an exported snapshot.
+
+    The caller appends its own -c commands and a final '-c COMMIT'. -X
+    keeps a ~/.psqlrc from adding output to a COPY stream.
+    """
+    return psql_cmd + [
+        '-X', '-q', '-v', 'ON_ERROR_STOP=1',
+        '-c', 'BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY',
+        '-c', f"SET TRANSACTION SNAPSHOT '{snapshot_id}'",
+    ]
+
+
+def parse_tables(output):
+    """Parses TABLES_QUERY's unaligned output into table dicts."""
+    tables = []
+    for line in output.decode().splitlines():
+        if not line:
+            continue
+        schema, name, size, block_size, columns = line.split(incremental_backup.FIELD_SEP)
+        tables.append({
+            "schema": schema,
+            "name": name,
+            "size": int(size or 0),
+            "block_size": int(block_size),
+            "columns": columns,
+        })
+    return tables
+
+
+def plan_shards(tables, shard_bytes=DEFAULT_SHARD_BYTES):
+    """Splits tables into COPY shards, largest first.
+
+    A table larger than shard_bytes is split into ranges of heap pages of
+    about that size; the last range is left open so rows on pages added
+    since the size was read are not missed. Each shard holds the page
+    range as first_page and end_page (None for an open end, both None for
+    a whole table) and its estimated size.
+    """
+    shards = []
+    for table in tables:
+        pages = table["size"] // table["block_size"]
+        count = 1
+        if table["columns"] and table["size"] > shard_bytes and pages > 1:
+            count = min(pages, -(-table["size"] // shard_bytes))
+        step = -(-pages // count)
+        for i in range(count):
+            shards.append({
+                "schema": table["schema"],
+                "table": table["name"],
+                "columns": table["columns"],
+                "first_page": i * step if count > 1 else None,
+                "end_page": (i + 1) * step if i < count - 1 else None,
+                "estimated_size": table["size"] // count,
+            })
+    # Largest first, so the last shards to finish are short ones
+    shards.sort(key=lambda s: s["estimated_size"], reverse=True)
+    return shards
+
+
+def copy_to_query(shard):
+    """COPY ... TO STDOUT exporting one shard.
+
+    The ctid range becomes a TID Range Scan on PostgreSQL 14 and later,
+    which reads only the shard's pages; older servers scan the whole
+    table for every shard.
+    """
+    relation = f"{quote_ident(shard['schema'])}.{quote_ident(shard['table'])}"
+    if not shard["columns"]:
+        return f"COPY {relation} TO STDOUT"
+    if shard["first_page"] is None:
+        return f"COPY {relation} ({shard['columns']}) TO STDOUT"
+    condition = f"ctid >= '({shard['first_page']},0)'::tid"
+    if shard["end_page"] is not None:
+        condition += f" AND ctid < '({shard['end_page']},0)'::tid"
+    # ONLY: an inheritance parent's children are exported as tables of their own
+    return f"COPY (SELECT {shard['columns']} FROM ONLY {relation} WHERE {condition}) TO STDOUT"
+
+
+def copy_from_query(shard):
+    """COPY ... FROM STDIN loading one shard back."""
+    relation = f"{quote_ident(shard['schema'])}.{quote_ident(shard['table'])}"
+    if not shard["columns"]:
+        return f"COPY {relation} FROM STDIN"
+    return f"COPY {relation} ({shard['columns']}) FROM STDIN"
+
+
+async def export_database(pg_dump_cmd, psql_cmd, env, scratch_dir, jobs=1, codec=DEFAULT_SHARD_CODEC, level=None, shard_bytes=DEFAULT_SHARD_BYTES, progress=None, **metadata):
+    """Exports a database into scratch_dir as schema files and compressed COPY shards.
+
+    pg_dump_cmd and psql_cmd are the connection parts of the commands. One
+    snapshot is exported (see incremental_backup.ExportedSnapshot) and
+    every worker imports it, so all shards and the schema-only pg_dumps
+    see the same data. Tables are split by plan_shards; at most `jobs`
+    COPY commands or pg_dumps run at once, each shard being compressed
+    with `codec` as it arrives. `progress` is called with every block of
+    COPY data. Returns the manifest; `metadata` is added to it.
+    """
+    os.makedirs(os.path.join(scratch_dir, "data"), exist_ok=True)
+    extension = archive_codecs.CODEC_EXTENSIONS[codec]
+
+    async with async_pipeline.in_thread(incremental_backup.ExportedSnapshot(psql_cmd, env)) as snapshot:
+        session = snapshot_session(psql_cmd, snapshot.snapshot_id)
+        result = await async_pipeline.run_command(session + ['-tA', '-F', incremental_backup.FIELD_SEP, '-c', TABLES_QUERY, '-c', 'COMMIT'], env)
+        tables = parse_tables(result.stdout)
+        shards = plan_shards(tables, shard_bytes)
+        for i, shard in enumerate(shards):
+            shard["member"] = f"data/{i:06d}.copy{extension}"
+        split = sum(1 for t in tables if t["size"] > shard_bytes)
+        logging.info(f"Exporting {len(tables)} table(s) as {len(shards)} shard(s) with {jobs} worker(s) from snapshot {snapshot.snapshot_id}; {split} table(s) split by ctid range")
+
+        # Sequence values and extension configuration rows are not in any shard
+        other = await async_pipeline.to_thread(incremental_backup.run_query, psql_cmd, env, incremental_backup.SEQUENCES_QUERY)
+        other += await async_pipeline.to_thread(incremental_backup.run_query, psql_cmd, env, EXTENSION_CONFIG_QUERY)
+        if other:
+            data_other_args = ['--data-only', '-b']
+            for schema, name in dict.fromkeys(map(tuple, other)):
+                data_other_args += ['-t', incremental_backup.quote_pattern(schema, name)]
+        else:
+            data_other_args = ['--data-only', '-b', '--exclude-table-data=*']
+
+        workers = asyncio.Semaphore(max(1, jobs))
+
+        async def dump(member, extra_args):
+            async with workers:
+                cmd = pg_dump_cmd + [f'--snapshot={snapshot.snapshot_id}', '-f', os.path.join(scratch_dir, member)] + extra_args
+                await async_pipeline.run_command(cmd, env)
+
+        async def export_shard(shard):
+            async with workers:
+                cmd = session + ['-c', copy_to_query(shard), '-c', 'COMMIT']
+
+                async def blocks():
+                    async for chunk in async_pipeline.process_output(cmd, env):
+                        if progress is not None:
+                            progress(chunk)
+                        yield chunk
+
+                writer = archive_codecs.open_writer(os.path.join(scratch_dir, shard["member"]), codec, level=level)
+                stage = async_pipeline.Stage("compress", writer.write, finish=writer.close, abort=lambda _error: writer.close())
+                shard["size"] = await async_pipeline.run_pipeline(blocks(), [stage])
+                shard["stored_size"] = os.path.getsize(os.path.join(scratch_dir, shard["member"]))
+
+        await async_pipeline.run_all(
+            [dump(PRE_DATA_MEMBER, ['--section=pre-data'])]
+            + [export_shard(shard) for shard in shards]
+            + [dump(DATA_OTHER_MEMBER, data_other_args), dump(POST_DATA_MEMBER, ['--section=post-data'])]
+        )
+
+    schema_size = sum(os.path.getsize(os.path.join(scratch_dir, m)) for m in (PRE_DATA_MEMBER, DATA_OTHER_MEMBER, POST_DATA_MEMBER))
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        "snapshot": snapshot.snapshot_id,
+        "codec": codec,
+        "tables": len(tables),
+        "size": schema_size + sum(s["size"] for s in shards),
+        "shards": shards,
+    }
+    manifest.update(metadata)
+    return manifest
+
+
+def write_archive(fileobj, scratch_dir, manifest, hasher=None):
+    """Packages an exported database from scratch_dir into a zip container.
+
+    The shards are compressed already and are stored as they are; the
+    schema files are deflated. Members are written in load order with the
+    manifest last. `hasher` is updated with every member's data, in the
+    order verify_backups reads it back. Returns the bytes of member data
+    written.
+    """
+    total = 0
+    members = [(PRE_DATA_MEMBER, zipfile.ZIP_DEFLATED)]
+    members += [(s["member"], zipfile.ZIP_STORED) for s in manifest["shards"]]
+    members += [(DATA_OTHER_MEMBER, zipfile.ZIP_DEFLATED), (POST_DATA_MEMBER, zipfile.ZIP_DEFLATED)]
+    with zipfile.ZipFile(fileobj, 'w', allowZip64=True) as zipf:
+        for member, compress_type in members:
+            info = zipfile.ZipInfo.from_file(os.path.join(scratch_dir, member), arcname=member)
+            info.compress_type = compress_type
+            with open(os.path.join(scratch_dir, member), 'rb') as src, zipf.open(info, 'w', force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(async_pipeline.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    total += len(chunk)
+        zipf.writestr(MANIFEST_MEMBER, json.dumps(manifest, indent=1))
+    return total
+
+
+def read_manifest(archive_path):
+    """Returns the manifest of a parallel archive, or None if it is not one."""
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as zipf:
+            if MANIFEST_MEMBER not in zipf.namelist():
+                return None
+            with zipf.open(MANIFEST_MEMBER) as f:
+                manifest = json.load(f)
+    except (zipfile.BadZipFile, OSError):
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    return manifest
+
+
+@contextlib.contextmanager
+def open_member(archive_path, member, codec=None):
+    """Opens a stream of one member of a parallel archive, decompressing it with `codec` if given.
+
+    Every call reads the archive through its own file handle, so shards
+    can be read concurrently.
+    """
+    with archive_codecs.open_reader(archive_path, "zip", member=member) as raw:
+        if codec is None:
+            yield raw
+        else:
+            with archive_codecs.open_reader(None, codec, fileobj=raw) as src:
+                yield src
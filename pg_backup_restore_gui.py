@@ -1,32 +1,63 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import threading
-import sys
+import queue
+import time
+import collections
+import logging
 import os
-import io
 
 # Import the logic modules directly
+import archive_codecs
 import backup_postgres
 import restore_postgres
 
-class RedirectText(io.StringIO):
-    """Callback-based stream to redirect stdout/stderr to the GUI."""
-    def __init__(self, callback):
-        super().__init__()
-        self.callback = callback
+# How often (ms) queued log output and progress are drawn
+REFRESH_MS = 100
 
-    def write(self, s):
-        if s:
-            self.callback(s)
+# Lines kept in the log widget; older lines are dropped
+MAX_LOG_LINES = 5000
 
-    def flush(self):
-        pass
+# Seconds of progress samples the displayed throughput is averaged over
+THROUGHPUT_WINDOW = 5.0
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class QueueLogHandler(logging.Handler):
+    """Logging handler that queues formatted records for the log widget.
+
+    Records logged by any thread only go onto the queue; the Tk loop draws
+    them. Unlike redirecting sys.stdout, this is safe with several jobs
+    running in threads.
+    """
+    def __init__(self, log_queue):
+        super().__init__(level=logging.INFO)
+        self.log_queue = log_queue
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%H:%M:%S'))
+
+    def emit(self, record):
+        try:
+            self.log_queue.put(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
 
 class PgBackupRestoreApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Postgres Backup & Restore Manager")
-        self.root.geometry("600x750")
+        self.root.geometry("600x850")
 
         # Variables
         self.host_var = tk.StringVar(value="localhost")
@@ -40,14 +71,35 @@ class PgBackupRestoreApp:
         self.backup_dir_var = tk.StringVar(value=os.getcwd())
         self.retention_var = tk.IntVar(value=30)
         self.backup_dry_run_var = tk.BooleanVar(value=False)
+        self.backup_physical_var = tk.BooleanVar(value=False)
 
         # Restore Variables
         self.restore_target_db_var = tk.StringVar()
         self.restore_zip_var = tk.StringVar()
         self.restore_dry_run_var = tk.BooleanVar(value=True)
         self.restore_yes_var = tk.BooleanVar(value=False)
+        self.restore_data_dir_var = tk.StringVar()
+        self.restore_command_var = tk.StringVar()
+        self.restore_target_time_var = tk.StringVar()
+
+        # Log text written by worker threads, drawn by the Tk loop every REFRESH_MS
+        self.log_queue = queue.Queue()
+        logging.getLogger().addHandler(QueueLogHandler(self.log_queue))
+        # Latest (operation, bytes done, bytes expected, rows done), phase and error of the
+        # running operation; set from its progress events by the worker thread
+        self.progress_state = None
+        self.progress_phase = None
+        self.progress_phases = []
+        self.progress_error = None
+        self.progress_samples = collections.deque()
+        self.progress_started = None
+        # ("Done" or "Failed", dialog message) once the worker thread has finished;
+        # the dialog is shown by refresh, as Tk may only be used from its own thread
+        self.progress_finished = None
+        self.progress_var = tk.StringVar(value="Idle")
 
         self.create_widgets()
+        self.root.after(REFRESH_MS, self.refresh)
 
     def create_widgets(self):
         # Common Connection Details
@@ -89,6 +141,13 @@ class PgBackupRestoreApp:
         self.notebook.add(self.restore_frame, text="Restore")
         self.create_restore_widgets()
 
+        # Progress
+        progress_frame = ttk.Frame(self.root, padding=(10, 0))
+        progress_frame.pack(fill="x", padx=10)
+        self.progress_bar = ttk.Progressbar(progress_frame, orient="horizontal", mode="determinate", maximum=100)
+        self.progress_bar.pack(fill="x")
+        ttk.Label(progress_frame, textvariable=self.progress_var).pack(anchor="w")
+
         # Log Area
         log_frame = ttk.LabelFrame(self.root, text="Logs", padding="5")
         log_frame.pack(fill="both", expand=True, padx=10, pady=5)
@@ -113,9 +172,11 @@ class PgBackupRestoreApp:
         ttk.Label(self.backup_frame, text="Retention Days:").grid(row=2, column=0, sticky="w", pady=5)
         ttk.Spinbox(self.backup_frame, from_=1, to=3650, textvariable=self.retention_var, width=5).grid(row=2, column=1, sticky="w", pady=5)
 
-        ttk.Checkbutton(self.backup_frame, text="Dry Run (Test only)", variable=self.backup_dry_run_var).grid(row=3, column=0, columnspan=2, sticky="w", pady=10)
+        ttk.Checkbutton(self.backup_frame, text="Physical Backup of the Whole Cluster (pg_basebackup)", variable=self.backup_physical_var).grid(row=3, column=0, columnspan=2, sticky="w", pady=5)
+
+        ttk.Checkbutton(self.backup_frame, text="Dry Run (Test only)", variable=self.backup_dry_run_var).grid(row=4, column=0, columnspan=2, sticky="w", pady=10)
 
-        ttk.Button(self.backup_frame, text="Start Backup", command=self.run_backup).grid(row=4, column=0, columnspan=2, pady=10)
+        ttk.Button(self.backup_frame, text="Start Backup", command=self.run_backup).grid(row=5, column=0, columnspan=2, pady=10)
         
         self.backup_frame.columnconfigure(1, weight=1)
 
@@ -129,10 +190,23 @@ class PgBackupRestoreApp:
         ttk.Entry(file_frame, textvariable=self.restore_zip_var).pack(side="left", fill="x", expand=True)
         ttk.Button(file_frame, text="Browse", command=self.browse_zip_file).pack(side="left", padx=5)
 
-        ttk.Checkbutton(self.restore_frame, text="Dry Run (Test only)", variable=self.restore_dry_run_var).grid(row=2, column=0, columnspan=2, sticky="w", pady=5)
-        ttk.Checkbutton(self.restore_frame, text="Auto Confirm Replacement (--yes)", variable=self.restore_yes_var).grid(row=3, column=0, columnspan=2, sticky="w", pady=5)
+        # A data directory selects the physical restore; the target database is then unused
+        ttk.Label(self.restore_frame, text="Data Directory (physical):").grid(row=2, column=0, sticky="w", pady=5)
+        data_dir_frame = ttk.Frame(self.restore_frame)
+        data_dir_frame.grid(row=2, column=1, sticky="ew", pady=5)
+        ttk.Entry(data_dir_frame, textvariable=self.restore_data_dir_var).pack(side="left", fill="x", expand=True)
+        ttk.Button(data_dir_frame, text="Browse", command=self.browse_data_dir).pack(side="left", padx=5)
+
+        ttk.Label(self.restore_frame, text="Restore Command (PITR):").grid(row=3, column=0, sticky="w", pady=5)
+        ttk.Entry(self.restore_frame, textvariable=self.restore_command_var).grid(row=3, column=1, sticky="ew", pady=5)
+
+        ttk.Label(self.restore_frame, text="Recover Up To (time):").grid(row=4, column=0, sticky="w", pady=5)
+        ttk.Entry(self.restore_frame, textvariable=self.restore_target_time_var).grid(row=4, column=1, sticky="ew", pady=5)
+
+        ttk.Checkbutton(self.restore_frame, text="Dry Run (Test only)", variable=self.restore_dry_run_var).grid(row=5, column=0, columnspan=2, sticky="w", pady=5)
+        ttk.Checkbutton(self.restore_frame, text="Auto Confirm Replacement (--yes)", variable=self.restore_yes_var).grid(row=6, column=0, columnspan=2, sticky="w", pady=5)
 
-        ttk.Button(self.restore_frame, text="Start Restore", command=self.run_restore).grid(row=4, column=0, columnspan=2, pady=10)
+        ttk.Button(self.restore_frame, text="Start Restore", command=self.run_restore).grid(row=7, column=0, columnspan=2, pady=10)
         
         self.restore_frame.columnconfigure(1, weight=1)
 
@@ -146,83 +220,199 @@ class PgBackupRestoreApp:
         if d:
             self.backup_dir_var.set(d)
 
+    def browse_data_dir(self):
+        d = filedialog.askdirectory()
+        if d:
+            self.restore_data_dir_var.set(d)
+
     def browse_zip_file(self):
-        f = filedialog.askopenfilename(filetypes=[("Zip files", "*.zip"), ("All files", "*.*")])
+        f = filedialog.askopenfilename(filetypes=[("Backup archives", " ".join(f"*{ext}" for ext in archive_codecs.ARCHIVE_EXTENSIONS)), ("All files", "*.*")])
         if f:
             self.restore_zip_var.set(f)
 
     def log_safe(self, message):
-        """Append text to the log widget in a thread-safe way."""
-        self.log_text.after(0, self._log_insert, message)
-
-    def _log_insert(self, message):
+        """Queue text for the log widget; safe to call from any thread."""
+        self.log_queue.put(message)
+
+    def event_safe(self, event):
+        """Progress event callback of the running operation; safe to call from any thread."""
+        kind = event["event"]
+        if kind == "progress":
+            self.progress_state = (event["operation"], event["bytes_done"], event["bytes_expected"], event["rows_done"])
+        elif kind == "phase_start":
+            # Streamed phases overlap (e.g. dump and compress); show the first one still open
+            self.progress_phases.append(event["phase"])
+            self.progress_phase = self.progress_phases[0]
+        elif kind == "phase_end" and event["phase"] in self.progress_phases:
+            self.progress_phases.remove(event["phase"])
+        elif kind == "error":
+            self.progress_error = f"{event['error_type']} during {self.progress_phase}" if self.progress_phase else event["error_type"]
+
+    def refresh(self):
+        """Draws queued log output and the current progress, then reschedules itself."""
+        try:
+            self._drain_log()
+            self._draw_progress()
+            if self.progress_finished is not None:
+                (status, message), self.progress_finished = self.progress_finished, None
+                self.finish_progress(status)
+                if status == "Done":
+                    messagebox.showinfo("Success", message)
+                else:
+                    messagebox.showerror("Error", message)
+        finally:
+            self.root.after(REFRESH_MS, self.refresh)
+
+    def _drain_log(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.log_queue.get_nowait())
+            except queue.Empty:
+                break
+        if not chunks:
+            return
+        # Only the newest MAX_LOG_LINES lines of a large burst can stay on screen anyway
+        lines = collections.deque("".join(chunks).splitlines(keepends=True), maxlen=MAX_LOG_LINES)
         self.log_text.config(state="normal")
-        self.log_text.insert("end", message)
-        if not message.endswith('\n'):
-             self.log_text.insert("end", "\n")
+        self.log_text.insert("end", "".join(lines))
+        # Ring buffer: drop the oldest lines beyond the cap
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - MAX_LOG_LINES
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
         self.log_text.see("end")
         self.log_text.config(state="disabled")
 
-    def run_backup_thread(self, host, port, db, user, password, backup_dir, retention, dry_run, bin_dir):
-        # Redirect stdout and stderr to our log
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        
-        sys.stdout = RedirectText(self.log_safe)
-        sys.stderr = RedirectText(self.log_safe)
-        
-        self.log_safe(f"Starting backup for {db}...\n")
+    def start_progress(self):
+        self.progress_state = None
+        self.progress_phase = None
+        self.progress_phases = []
+        self.progress_error = None
+        self.progress_samples.clear()
+        self.progress_started = time.monotonic()
+        self.progress_bar.config(mode="determinate", value=0)
+        self.progress_var.set("Starting...")
+
+    def finish_progress(self, status):
+        self.progress_started = None
+        self.progress_bar.stop()
+        self.progress_bar.config(mode="determinate", value=100 if status == "Done" else 0)
+        if status != "Done" and self.progress_error:
+            status = f"{status} ({self.progress_error})"
+        done = self.progress_state[1] if self.progress_state else None
+        self.progress_var.set(status if done is None else f"{status}: {format_bytes(done)}")
+
+    def _draw_progress(self):
+        if self.progress_started is None:
+            return
+        if self.progress_state is None:
+            if self.progress_phase:
+                self.progress_var.set(f"{self.progress_phase}... | elapsed {format_duration(time.monotonic() - self.progress_started)}")
+            return
+        operation, done, expected, rows = self.progress_state
+        now = time.monotonic()
+        self.progress_samples.append((now, done))
+        while len(self.progress_samples) > 2 and now - self.progress_samples[0][0] > THROUGHPUT_WINDOW:
+            self.progress_samples.popleft()
+        (t0, d0), (t1, d1) = self.progress_samples[0], self.progress_samples[-1]
+        rate = (d1 - d0) / (t1 - t0) if t1 > t0 else 0.0
+
+        text = f"{'Dumped' if operation == 'backup' else 'Loaded'} {format_bytes(done)}"
+        if expected:
+            if str(self.progress_bar.cget("mode")) != "determinate":
+                self.progress_bar.stop()
+                self.progress_bar.config(mode="determinate")
+            # An estimate; the dump may have grown since the previous backup
+            self.progress_bar.config(value=min(99.0, done * 100.0 / expected))
+            text += f" of ~{format_bytes(expected)}"
+        if rows:
+            text += f" ({rows:,} rows)"
+        if not expected and str(self.progress_bar.cget("mode")) != "indeterminate":
+            self.progress_bar.config(mode="indeterminate")
+            self.progress_bar.start(REFRESH_MS)
+        text += f" | {format_bytes(rate)}/s | elapsed {format_duration(now - self.progress_started)}"
+        if expected and rate > 0 and expected > done:
+            text += f" | ETA {format_duration((expected - done) / rate)}"
+        self.progress_var.set(text)
+
+    def run_backup_thread(self, host, port, db, user, password, backup_dir, retention, dry_run, bin_dir, physical=False):
+        # Log lines arrive through QueueLogHandler, progress through event_safe
+        self.log_safe(f"Starting physical backup of {host}:{port}...\n" if physical else f"Starting backup for {db}...\n")
+        status = "Failed"
+        message = "Backup was interrupted."
         
         try:
-            backup_postgres.backup_postgres(
-                host=host,
-                port=port,
-                database=db,
-                username=user,
-                password=password,
-                backup_dir=backup_dir,
-                retention_days=retention,
-                dry_run=dry_run,
-                bin_dir=bin_dir
-            )
+            if physical:
+                backup_postgres.backup_physical(
+                    host=host,
+                    port=port,
+                    username=user,
+                    password=password,
+                    backup_dir=backup_dir,
+                    retention_days=retention,
+                    dry_run=dry_run,
+                    bin_dir=bin_dir,
+                    on_event=self.event_safe
+                )
+            else:
+                backup_postgres.backup_postgres(
+                    host=host,
+                    port=port,
+                    database=db,
+                    username=user,
+                    password=password,
+                    backup_dir=backup_dir,
+                    retention_days=retention,
+                    dry_run=dry_run,
+                    bin_dir=bin_dir,
+                    on_event=self.event_safe
+                )
+            status = "Done"
+            message = "Backup completed successfully!"
             self.log_safe("SUCCESS\n")
-            messagebox.showinfo("Success", "Backup completed successfully!")
         except Exception as e:
+            message = f"Backup failed: {e}"
             self.log_safe(f"FAILED: {e}\n")
-            messagebox.showerror("Error", f"Backup failed: {e}")
         finally:
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
+            self.progress_finished = (status, message)
 
-    def run_restore_thread(self, host, port, db, user, password, zip_file, auto_confirm, dry_run, bin_dir):
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        
-        sys.stdout = RedirectText(self.log_safe)
-        sys.stderr = RedirectText(self.log_safe)
-        
-        self.log_safe(f"Starting restore for {db}...\n")
+    def run_restore_thread(self, host, port, db, user, password, zip_file, auto_confirm, dry_run, bin_dir, data_dir=None, restore_command=None, target_time=None):
+        self.log_safe(f"Starting physical restore into {data_dir}...\n" if data_dir else f"Starting restore for {db}...\n")
+        status = "Failed"
+        message = "Restore was interrupted."
         
         try:
-            restore_postgres.restore_postgres(
-                host=host,
-                port=port,
-                target_database=db,
-                username=user,
-                password=password,
-                zip_file=zip_file,
-                auto_confirm=auto_confirm,
-                dry_run=dry_run,
-                bin_dir=bin_dir
-            )
+            if data_dir:
+                restore_postgres.restore_physical(
+                    zip_file=zip_file,
+                    data_dir=data_dir,
+                    auto_confirm=auto_confirm,
+                    dry_run=dry_run,
+                    restore_command=restore_command or None,
+                    recovery_target_time=target_time or None,
+                    on_event=self.event_safe
+                )
+            else:
+                restore_postgres.restore_postgres(
+                    host=host,
+                    port=port,
+                    target_database=db,
+                    username=user,
+                    password=password,
+                    zip_file=zip_file,
+                    auto_confirm=auto_confirm,
+                    dry_run=dry_run,
+                    bin_dir=bin_dir,
+                    on_event=self.event_safe
+                )
+            status = "Done"
+            message = "Restore completed successfully!"
             self.log_safe("SUCCESS\n")
-            messagebox.showinfo("Success", "Restore completed successfully!")
         except Exception as e:
+            message = f"Restore failed: {e}"
             self.log_safe(f"FAILED: {e}\n")
-            messagebox.showerror("Error", f"Restore failed: {e}")
         finally:
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
+            self.progress_finished = (status, message)
 
     def run_backup(self):
         host = self.host_var.get()
@@ -234,14 +424,16 @@ class PgBackupRestoreApp:
         retention = self.retention_var.get()
         dry_run = self.backup_dry_run_var.get()
         bin_dir = self.bin_dir_var.get()
+        physical = self.backup_physical_var.get()
 
-        if not all([host, port, user, db]):
+        if not all([host, port, user, db or physical]):
             messagebox.showwarning("Validation", "Please fill in all required fields.")
             return
 
+        self.start_progress()
         threading.Thread(
             target=self.run_backup_thread, 
-            args=(host, int(port), db, user, password, directory, int(retention), dry_run, bin_dir), 
+            args=(host, int(port), db, user, password, directory, int(retention), dry_run, bin_dir, physical), 
             daemon=True
         ).start()
 
@@ -255,18 +447,27 @@ class PgBackupRestoreApp:
         dry_run = self.restore_dry_run_var.get()
         auto_confirm = self.restore_yes_var.get()
         bin_dir = self.bin_dir_var.get()
+        data_dir = self.restore_data_dir_var.get()
+        restore_command = self.restore_command_var.get()
+        target_time = self.restore_target_time_var.get()
 
-        if not all([host, port, user, db, zip_file]):
+        if not zip_file or not (data_dir or all([host, port, user, db])):
             messagebox.showwarning("Validation", "Please fill in all required fields.")
             return
 
+        self.start_progress()
         threading.Thread(
             target=self.run_restore_thread,
-            args=(host, int(port), db, user, password, zip_file, auto_confirm, dry_run, bin_dir),
+            args=(host, int(port), db, user, password, zip_file, auto_confirm, dry_run, bin_dir, data_dir, restore_command, target_time),
             daemon=True
         ).start()
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        filename='pg_backup_restore_gui.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
     root = tk.Tk()
     app = PgBackupRestoreApp(root)
     root.mainloop()
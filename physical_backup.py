@@ -0,0 +1,305 @@
+import os
+import re
+import io
+import shutil
+import tarfile
+import logging
+import datetime
+
+import archive_codecs
+
+# Logging is configured in the main block or by the importing application
+
+# Catalog dump format of pg_basebackup archives
+PHYSICAL_FORMAT = "physical"
+
+# Tar file holding the main data directory in pg_basebackup's tar output
+BASE_MEMBER = "base.tar"
+
+# Tar file holding the WAL streamed while the backup ran (-X stream)
+WAL_MEMBER = "pg_wal.tar"
+
+# Manifest pg_basebackup writes since PostgreSQL 13, checked by pg_verifybackup
+MANIFEST_MEMBER = "backup_manifest"
+
+# File in base.tar listing each tablespace's OID and location
+TABLESPACE_MAP = "tablespace_map"
+
+# Tablespaces are written as <oid>.tar
+TABLESPACE_MEMBER_RE = re.compile(r"^(\d+)\.tar$")
+
+# Checkpoint modes pg_basebackup accepts (-c)
+CHECKPOINT_MODES = ("fast", "spread")
+
+# What the server does once it reaches a recovery target
+RECOVERY_TARGET_ACTIONS = ("promote", "pause", "shutdown")
+
+# Present while a server runs on a data directory
+POSTMASTER_PID = "postmaster.pid"
+
+
+def cluster_label(host, port):
+    """Name under which a server's physical backups are catalogued, e.g. 'cluster_db1_5432'."""
+    return "cluster_" + re.sub(r"[^A-Za-z0-9.-]+", "_", f"{host}_{port}").strip("_")
+
+
+def basebackup_command(pg_basebackup_path, host, port, username, target_dir, checkpoint="fast", label=None, max_rate=None):
+    """Builds the pg_basebackup command writing tar files with streamed WAL into target_dir.
+
+    max_rate is in bytes per second; pg_basebackup takes kB/s with a
+    minimum of 32.
+    """
+    if checkpoint not in CHECKPOINT_MODES:
+        raise ValueError(f"Unknown checkpoint mode '{checkpoint}'. Expected one of: {', '.join(CHECKPOINT_MODES)}")
+    cmd = [
+        pg_basebackup_path,
+        '-h', host,
+        '-p', str(port),
+        '-U', username,
+        '-D', target_dir,
+        '-Ft',
+        '-X', 'stream',
+        '-c', checkpoint,
+        '-w',
+    ]
+    if label:
+        cmd += ['-l', label]
+    if max_rate:
+        cmd += ['-r', f"{max(32, int(max_rate) // 1024)}k"]
+    return cmd
+
+
+def member_order(names):
+    """Sorts pg_basebackup's output files into the order they are archived and restored.
+
+    base.tar comes first, as it holds the tablespace map the tablespace
+    tars are placed by; the WAL and the manifest follow.
+    """
+    def key(name):
+        if name == BASE_MEMBER:
+            return (0, name)
+        if TABLESPACE_MEMBER_RE.match(name):
+            return (1, name)
+        if name == WAL_MEMBER:
+            return (2, name)
+        return (3, name)
+    return sorted(names, key=key)
+
+
+def directory_size(path):
+    """Total size of the files below path; files vanishing meanwhile are skipped."""
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def tar_basebackup(backup_dir, writer):
+    """Writes pg_basebackup's tar output as one tar stream into an archive writer.
+
+    Returns the number of bytes of pg_basebackup output packaged.
+    """
+    names = os.listdir(backup_dir)
+    if BASE_MEMBER not in names:
+        raise ValueError(f"pg_basebackup wrote no {BASE_MEMBER} into {backup_dir}.")
+    total = 0
+    with tarfile.open(fileobj=writer, mode='w|') as tar:
+        for name in member_order(names):
+            path = os.path.join(backup_dir, name)
+            tar.add(path, arcname=name)
+            total += os.path.getsize(path)
+    return total
+
+
+def is_physical_archive(path, codec=None):
+    """True if a single-stream archive holds a pg_basebackup (its first member is base.tar)."""
+    try:
+        with archive_codecs.open_reader(path, codec) as src, tarfile.open(fileobj=src, mode='r|') as tar:
+            first = tar.next()
+            return first is not None and first.name == BASE_MEMBER
+    except (OSError, EOFError, ValueError, tarfile.TarError):
+        return False
+
+
+def read_tablespace_map(data_dir):
+    """Returns {oid: location} from a restored data directory's tablespace_map."""
+    path = os.path.join(data_dir, TABLESPACE_MAP)
+    mapping = {}
+    if not os.path.exists(path):
+        return mapping
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                oid, _sep, location = line.partition(" ")
+                mapping[oid] = location
+    return mapping
+
+
+def write_tablespace_map(data_dir, mapping):
+    """Rewrites tablespace_map; the server recreates pg_tblspc's links from it at startup."""
+    with open(os.path.join(data_dir, TABLESPACE_MAP), "w", encoding="utf-8") as f:
+        for oid, location in mapping.items():
+            f.write(f"{oid} {location}\n")
+
+
+def is_empty_dir(path):
+    return not os.path.exists(path) or (os.path.isdir(path) and not os.listdir(path))
+
+
+def check_data_dir(data_dir):
+    """True if data_dir holds files already. Raises EnvironmentError if a server is running on it."""
+    if is_empty_dir(data_dir):
+        return False
+    if not os.path.isdir(data_dir):
+        raise EnvironmentError(f"'{data_dir}' exists and is not a directory.")
+    if os.path.exists(os.path.join(data_dir, POSTMASTER_PID)):
+        raise EnvironmentError(f"A server appears to be running on '{data_dir}' ({POSTMASTER_PID} exists); stop it first.")
+    return True
+
+
+def set_aside_path(data_dir):
+    """Where an existing data directory is moved before a restore: <data_dir>.old_<timestamp>."""
+    return f"{os.path.normpath(data_dir)}.old_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+
+def _extract_tar(fileobj, dest_dir):
+    # pg_tblspc links are recreated by the server from tablespace_map
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            if member.issym() and member.name.startswith("pg_tblspc/"):
+                continue
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(member, path=dest_dir, filter='data')
+            else:
+                tar.extract(member, path=dest_dir)
+
+
+def extract_basebackup(src, data_dir, tablespace_dir=None, created=None):
+    """Lays out a data directory from a physical archive's tar stream.
+
+    base.tar goes into data_dir, pg_wal.tar into data_dir/pg_wal and each
+    <oid>.tar to its location in tablespace_map, or below tablespace_dir
+    (which then replaces the locations in the map). Every directory
+    written to is appended to `created` as (path, made), `made` telling
+    whether it was created here, so a failed restore can be undone with
+    discard_restored. Returns {oid: location} of the restored tablespaces.
+    """
+    created = created if created is not None else []
+    tablespaces = {}
+    seen_base = False
+
+    def make_dir(path):
+        if not is_empty_dir(path):
+            raise EnvironmentError(f"'{path}' is not empty; restore tablespaces elsewhere with a tablespace directory.")
+        made = not os.path.exists(path)
+        if made:
+            os.makedirs(path, mode=0o700)
+        created.append((path, made))
+
+    with tarfile.open(fileobj=src, mode='r|') as outer:
+        for member in outer:
+            name = member.name
+            if not member.isfile():
+                continue
+            match = TABLESPACE_MEMBER_RE.match(name)
+            if name == BASE_MEMBER:
+                make_dir(data_dir)
+                _extract_tar(outer.extractfile(member), data_dir)
+                seen_base = True
+                tablespaces = read_tablespace_map(data_dir)
+                if tablespace_dir:
+                    tablespaces = {oid: os.path.join(os.path.abspath(tablespace_dir), oid) for oid in tablespaces}
+                    write_tablespace_map(data_dir, tablespaces)
+            elif not seen_base:
+                raise ValueError(f"Unexpected member '{name}' before {BASE_MEMBER}; not a physical backup archive.")
+            elif match:
+                location = tablespaces.get(match.group(1))
+                if location is None:
+                    raise ValueError(f"Tablespace {match.group(1)} is missing from {TABLESPACE_MAP}.")
+                make_dir(location)
+                _extract_tar(outer.extractfile(member), location)
+                logging.info(f"Restored tablespace {match.group(1)} into {location}")
+            elif name == WAL_MEMBER:
+                wal_dir = os.path.join(data_dir, "pg_wal")
+                os.makedirs(wal_dir, mode=0o700, exist_ok=True)
+                _extract_tar(outer.extractfile(member), wal_dir)
+            elif name == MANIFEST_MEMBER:
+                with outer.extractfile(member) as f, open(os.path.join(data_dir, MANIFEST_MEMBER), "wb") as dst:
+                    shutil.copyfileobj(f, dst)
+            else:
+                logging.warning(f"Skipping unknown member '{name}' of the physical archive")
+    if not seen_base:
+        raise ValueError(f"No {BASE_MEMBER} found; not a physical backup archive.")
+    # The server refuses to start on a data directory others can read
+    os.chmod(data_dir, 0o700)
+    return tablespaces
+
+
+def discard_restored(created):
+    """Removes what extract_basebackup wrote; directories that existed before are emptied, not removed."""
+    for path, made in reversed(created):
+        try:
+            if made:
+                shutil.rmtree(path)
+            else:
+                for name in os.listdir(path):
+                    entry = os.path.join(path, name)
+                    if os.path.isdir(entry) and not os.path.islink(entry):
+                        shutil.rmtree(entry)
+                    else:
+                        os.remove(entry)
+            logging.info(f"Removed incomplete restore from {path}")
+        except OSError as e:
+            logging.error(f"Could not clean up incomplete restore in {path}: {e}")
+
+
+def quote_setting(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def write_recovery_config(data_dir, restore_command=None, target=None, target_action="promote"):
+    """Sets up recovery from archived WAL on a restored data directory (PostgreSQL 12+).
+
+    restore_command fetches archived WAL beyond the end of the backup;
+    target is a (setting, value) pair such as ("recovery_target_time",
+    "2024-05-01 12:00:00+00"). Without a target recovery runs to the end
+    of the archived WAL. The settings are appended to postgresql.auto.conf
+    and recovery.signal is created.
+    """
+    if target_action not in RECOVERY_TARGET_ACTIONS:
+        raise ValueError(f"Unknown recovery target action '{target_action}'. Expected one of: {', '.join(RECOVERY_TARGET_ACTIONS)}")
+    lines = [f"# Added by pg_backup_restore on {datetime.datetime.now().isoformat(timespec='seconds')}"]
+    lines.append(f"restore_command = {quote_setting(restore_command)}")
+    if target:
+        setting, value = target
+        lines.append(f"{setting} = {quote_setting(value)}")
+        lines.append(f"recovery_target_action = {quote_setting(target_action)}")
+    with open(os.path.join(data_dir, "postgresql.auto.conf"), "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(os.path.join(data_dir, "recovery.signal"), "w"):
+        pass
+    return lines[1:]
+
+
+class ProgressReader(io.RawIOBase):
+    """Readable stream passing each block read from `raw` to `progress`."""
+
+    def __init__(self, raw, progress):
+        self.raw = raw
+        self.progress = progress
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.raw.read(len(b))
+        n = len(data)
+        b[:n] = data
+        if n:
+            self.progress(data)
+        return n
@@ -0,0 +1,185 @@
+import sys
+import time
+import threading
+
+import run_metrics
+
+# Kinds of events passed to an on_event callback (see run_metrics.RunMetrics.notify):
+#   start        the run began
+#   phase_start  a phase began ("phase")
+#   phase_end    a phase ended ("phase", "seconds" and its byte counts so far)
+#   progress     bytes dumped or loaded so far ("bytes_done", "bytes_expected", "rows_done")
+#   copy         a COPY block of a plain dump ended ("table", "rows")
+#   error        the run failed ("error", "error_type")
+#   finish       the run ended ("status", "duration_seconds", byte counts)
+EVENT_KINDS = ("start", "phase_start", "phase_end", "progress", "copy", "error", "finish")
+
+# Minimum seconds between two "progress" events of one stream; the final count is always sent
+PROGRESS_INTERVAL = 0.5
+
+# Seconds between progress lines when the console is not a terminal (e.g. a log file)
+CONSOLE_LINE_INTERVAL = 10.0
+
+# Longest partial line kept between blocks while looking for COPY headers;
+# a longer line cannot be one and only its length matters
+MAX_HEADER_LINE = 64 * 1024
+
+
+class CopyRowCounter:
+    """Follows the COPY blocks of a plain SQL dump fed to it in arbitrary blocks.
+
+    `on_block(table, rows)` is called as each "COPY ... FROM stdin;" block
+    ends with its "\\." line. Only line boundaries are searched, so the cost
+    is a few bytes.find/count calls per block.
+    """
+
+    def __init__(self, on_block):
+        self.on_block = on_block
+        self.table = None
+        self.rows = 0
+        self._tail = b""
+
+    def feed(self, chunk):
+        buf = self._tail + chunk if self._tail else chunk
+        end = buf.rfind(b"\n") + 1
+        pos = 0
+        while pos < end:
+            if self.table is None:
+                i = buf.find(b"COPY ", pos, end)
+                if i == -1:
+                    break
+                nl = buf.find(b"\n", i, end)
+                if i == pos or buf[i - 1] == 0x0A:
+                    line = buf[i:nl].rstrip(b"\r")
+                    if line.endswith(b"FROM stdin;"):
+                        self.table = line[5:].split(b" (", 1)[0].split(b" FROM ", 1)[0].decode("utf-8", "replace")
+                        self.rows = 0
+                pos = nl + 1
+            else:
+                j = pos if buf.startswith(b"\\.\n", pos) else buf.find(b"\n\\.\n", pos, end)
+                if j == -1:
+                    self.rows += buf.count(b"\n", pos, end)
+                    break
+                if j != pos:
+                    j += 1
+                self.rows += buf.count(b"\n", pos, j)
+                self.on_block(self.table, self.rows)
+                self.table = None
+                pos = j + 3
+        tail = buf[end:]
+        # Inside a COPY block only a "\." prefix matters; outside it only a possible header
+        limit = 2 if self.table is not None else MAX_HEADER_LINE
+        self._tail = tail if len(tail) <= limit else b"#"
+
+
+class StreamProgress:
+    """Turns the blocks of a dump stream into "progress" and "copy" events.
+
+    feed() is called with every block dumped or loaded; `notify` is
+    RunMetrics.notify. "progress" events are sent at most every `interval`
+    seconds, and once more by close(). With count_rows the stream is read
+    as a plain SQL dump and every COPY block is reported with its row count.
+    """
+
+    def __init__(self, notify, bytes_expected=None, count_rows=True, interval=PROGRESS_INTERVAL):
+        self.notify = notify
+        self.bytes_expected = bytes_expected
+        self.interval = interval
+        self.bytes_done = 0
+        self.rows_done = 0
+        self._rows = CopyRowCounter(self._copy_block) if count_rows else None
+        self._last = 0.0
+        self._sent = None
+
+    def _copy_block(self, table, rows):
+        self.rows_done += rows
+        self.notify("copy", table=table, rows=rows)
+
+    def _send(self):
+        self._sent = self.bytes_done
+        self.notify("progress", bytes_done=self.bytes_done, bytes_expected=self.bytes_expected, rows_done=self.rows_done if self._rows else None)
+
+    def feed(self, chunk):
+        self.bytes_done += len(chunk)
+        if self._rows is not None:
+            self._rows.feed(chunk)
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._send()
+
+    def close(self):
+        if self._sent != self.bytes_done:
+            self._send()
+
+
+def combine(*callbacks):
+    """Returns one on_event callback calling each given one, or None if none is given."""
+    callbacks = [c for c in callbacks if c is not None]
+    if not callbacks:
+        return None
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def on_event(event):
+        for callback in callbacks:
+            callback(event)
+    return on_event
+
+
+def event_file_writer(path):
+    """on_event callback appending every event to a JSON-lines file."""
+    def on_event(event):
+        run_metrics.append_json_line(path, event)
+    return on_event
+
+
+def _format_bytes(n):
+    return f"{n / 1e6:.1f} MB"
+
+
+class ConsoleReporter:
+    """on_event callback drawing progress and phase timings on a console stream.
+
+    On a terminal the progress of the latest job is redrawn in place; on
+    anything else (a log file, a scheduler) a line is written at most every
+    CONSOLE_LINE_INTERVAL seconds per job. Safe to share between threads.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self._lock = threading.Lock()
+        self._last_line = {}
+        self._open_line = False
+
+    def _write(self, text, in_place=False):
+        # A progress line drawn in place is overwritten, or ended before a normal line
+        if self._open_line:
+            text = ("\r" if in_place else "\n") + text
+        self._open_line = in_place
+        self.stream.write(text if in_place else text + "\n")
+        self.stream.flush()
+
+    def __call__(self, event):
+        kind = event["event"]
+        job = f"{event['operation']} {event['database']}"
+        with self._lock:
+            if kind == "progress":
+                now = time.monotonic()
+                if not self.tty and now - self._last_line.get(job, 0.0) < CONSOLE_LINE_INTERVAL:
+                    return
+                self._last_line[job] = now
+                text = f"{job}: {_format_bytes(event['bytes_done'])}"
+                if event.get("bytes_expected"):
+                    text += f" of ~{_format_bytes(event['bytes_expected'])} ({min(99, event['bytes_done'] * 100 // event['bytes_expected'])}%)"
+                if event.get("rows_done"):
+                    text += f", {event['rows_done']} rows"
+                self._write(text.ljust(79) if self.tty else text, in_place=self.tty)
+            elif kind == "phase_end":
+                self._write(f"{job}: {event['phase']} took {event['seconds']:.1f}s")
+            elif kind == "error":
+                self._write(f"{job}: failed: {event['error']}")
+            elif kind == "finish" and self._open_line:
+                self.stream.write("\n")
+                self._open_line = False
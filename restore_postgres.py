@@ -7,76 +7,229 @@ import shutil
 import getpass
 import subprocess
 import tempfile
+import tarfile
+import time
+import datetime
+import contextlib
+import threading
+import asyncio
+import functools
+
+import archive_codecs
+import archive_digests
+import archive_tiers
+import async_pipeline
+import backup_catalog
+import chunk_store
+import incremental_backup
+import indexed_archive
+import parallel_export
+import physical_backup
+import progress_events
+import run_metrics
+import storage_backends
+import template_cache
 
 # Logging is configured in the main block or by the importing application
 
+# Size of the blocks decompressed from the archive and written to psql's stdin
+CHUNK_SIZE = 1024 * 1024
 
+# maintenance_work_mem used by the fast-restore profile unless overridden
+FAST_RESTORE_MAINTENANCE_WORK_MEM = "1GB"
 
-def restore_postgres(host, port, target_database, username, password, zip_file, auto_confirm=False, dry_run=False, bin_dir=None):
-    """Restores a PostgreSQL database from a ZIP file."""
-    logging.info(f"Starting restore for database '{target_database}' from {zip_file}")
+# Phases compared against earlier restores to estimate the fast profile's gain
+LOAD_PHASES = ("decompress", "load", "vacuum_analyze")
 
-    # Resolve binary paths
-    def get_bin(name):
-        if not bin_dir:
-            return name
-        path = os.path.join(bin_dir, name)
-        if sys.platform == "win32" and not path.lower().endswith(".exe"):
-            path += ".exe"
-        return path
-
-    psql_bin = get_bin("psql")
-    createdb_bin = get_bin("createdb")
-    dropdb_bin = get_bin("dropdb")
-
-    # Preflight: ensure required binaries exist
-    for b in [psql_bin, createdb_bin, dropdb_bin]:
-        if shutil.which(b) is None:
-            msg = f"Required command '{b}' not found. Please check bin path."
-            print(msg)
-            logging.error(msg)
-            raise EnvironmentError(msg)
+# Longest database name PostgreSQL accepts (NAMEDATALEN - 1 bytes)
+MAX_IDENTIFIER_LENGTH = 63
+
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def fast_restore_options(maintenance_work_mem=FAST_RESTORE_MAINTENANCE_WORK_MEM):
+    """Returns the PGOPTIONS session settings of the fast-restore profile.
+
+    synchronous_commit=off lets each commit return before its WAL reaches
+    disk; a crash can lose the last few transactions, which only matters
+    until the restore is re-run. A large maintenance_work_mem lets CREATE
+    INDEX and foreign-key validation sort in memory.
+    """
+    return f"-c synchronous_commit=off -c maintenance_work_mem={maintenance_work_mem}"
+
+
+def _load_seconds(record):
+    return sum(p["seconds"] for p in record.get("phases", []) if p["phase"] in LOAD_PHASES)
+
+
+def estimate_time_saved(metrics_file, database, uncompressed_bytes, load_seconds):
+    """Estimates the time the fast-restore profile saved on this restore.
+
+    The most recent successful default-profile restore in the metrics file
+    (of the same database if there is one) gives a load throughput, which
+    is scaled to this dump's size. Returns (seconds_saved, baseline_record),
+    or None when there is nothing to compare against.
+    """
+    candidates = [
+        r for r in run_metrics.read_records(metrics_file, operation="restore")
+        if r.get("status") == "success" and r.get("profile", "default") == "default"
+        and r.get("uncompressed_bytes") and _load_seconds(r) > 0
+    ]
+    same_database = [r for r in candidates if r.get("database") == database]
+    candidates = same_database or candidates
+    if not candidates or not uncompressed_bytes:
+        return None
+    baseline = candidates[-1]
+    expected = uncompressed_bytes / (baseline["uncompressed_bytes"] / _load_seconds(baseline))
+    return expected - load_seconds, baseline
+
+
+def recorded_checksum(zip_file):
+    """SHA-256 of a local archive as recorded when it was written, or None.
+
+    Taken from the archive's digest file, or else from the catalog of its
+    directory, and only if the recorded size still matches the file.
+    """
+    size = os.path.getsize(zip_file)
+    digests = archive_digests.read_digests(zip_file) or {}
+    if digests.get("archive_sha256") and digests.get("archive_size") == size:
+        return digests["archive_sha256"]
+    catalog_path = backup_catalog.default_catalog_path(os.path.dirname(os.path.abspath(zip_file)))
+    if os.path.exists(catalog_path):
+        parsed = backup_catalog.parse_archive_name(zip_file)
+        for b in backup_catalog.BackupCatalog(catalog_path).list_backups(parsed[0] if parsed else None):
+            if b["checksum"] and b["size"] == size and os.path.abspath(b["path"]) == os.path.abspath(zip_file):
+                return b["checksum"]
+    return None
 
-    # 1. Unzip the file
-    print(f"Unzipping {zip_file}...")
-    temp_dir_obj = tempfile.TemporaryDirectory()
+
+async def pipe_dump_to_psql(psql_cmd, env, src, stats=None, progress=None, queue_size=async_pipeline.DEFAULT_QUEUE_SIZE):
+    """Streams a readable, decompressing stream into psql's stdin through concurrent stages.
+
+    Reading (and so decompressing) `src` and writing to psql's stdin run as
+    two pipeline stages joined by a bounded queue (see async_pipeline), so
+    the next block is decompressed while psql takes the previous one, and
+    no temporary disk space is used. Returns the number of bytes sent to
+    psql. If a `stats` dict is given, the time spent reading the archive
+    ("read_seconds") and blocked on psql ("write_seconds") is added to it.
+    `progress` is called with every block after it was sent (see
+    progress_events.StreamProgress).
+    """
+    stats = stats if stats is not None else {}
+    proc = subprocess.Popen(psql_cmd, env=env, stdin=subprocess.PIPE)
+
+    def load(chunk):
+        proc.stdin.write(chunk)
+        if progress is not None:
+            progress(chunk)
+
+    def finish_load():
+        proc.stdin.close()
+
+    def abort_load(error):
+        if not isinstance(error, BrokenPipeError):
+            proc.kill()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    stage = async_pipeline.Stage("load", load, finish_load, abort_load)
     try:
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            file_list = zip_ref.namelist()
-            sql_file = None
-            for f in file_list:
-                if f.endswith('.sql'):
-                    sql_file = f
-                    break
-
-            if not sql_file:
-                msg = "Error: No .sql file found in the zip archive."
-                print(msg)
-                logging.error(msg)
-                raise ValueError(msg)
-
-            zip_ref.extract(sql_file, path=temp_dir_obj.name)
-            sql_file_path = os.path.join(temp_dir_obj.name, sql_file)
-            print(f"Extracted: {sql_file_path}")
-            logging.info(f"Extracted: {sql_file_path}")
-    except zipfile.BadZipFile:
-        temp_dir_obj.cleanup()
-        msg = "Error: Invalid zip file."
-        print(msg)
-        logging.error(msg)
-        raise
-    except Exception as e:
-        temp_dir_obj.cleanup()
-        msg = f"Error extracting zip: {e}"
-        print(msg)
-        logging.error(msg)
-        raise
+        loaded = await async_pipeline.run_pipeline(async_pipeline.file_blocks(src, CHUNK_SIZE, stats), [stage], queue_size)
+    except BrokenPipeError:
+        # psql exited early; its return code below carries the failure
+        loaded = stage.bytes_in
+    finally:
+        returncode = await async_pipeline.to_thread(proc.wait)
+        stats["write_seconds"] = stats.get("write_seconds", 0.0) + stage.busy_seconds
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, psql_cmd)
+    return loaded
+
+
+async def load_parallel_archive(zip_file, manifest, psql_cmd, env, jobs=1, progress=None):
+    """Loads a parallel COPY archive (see parallel_export) and returns the bytes sent to psql.
+
+    The pre-data schema is loaded first, then the shards with at most
+    `jobs` concurrent psql sessions, each decompressing its own shard into
+    COPY ... FROM STDIN, and last the sequence values, indexes and
+    constraints. `progress` is called with every block loaded.
+    """
+    if progress is not None:
+        # Shards are loaded on several threads at once
+        lock = threading.Lock()
+        feed = progress
+
+        def progress(chunk):
+            with lock:
+                feed(chunk)
+
+    async def load(member, cmd, codec=None):
+        async with async_pipeline.in_thread(parallel_export.open_member(zip_file, member, codec)) as src:
+            return await pipe_dump_to_psql(cmd, env, src, progress=progress)
+
+    workers = asyncio.Semaphore(max(1, jobs))
 
-    # Set password in environment variable for all libpq commands
-    env = os.environ.copy()
-    env['PGPASSWORD'] = password
+    async def load_shard(shard):
+        async with workers:
+            cmd = psql_cmd + ['-X', '-q', '-v', 'ON_ERROR_STOP=1', '-c', parallel_export.copy_from_query(shard)]
+            return await load(shard["member"], cmd, manifest["codec"])
 
-    # 2. Check/Create Database
+    loaded = await load(parallel_export.PRE_DATA_MEMBER, psql_cmd)
+    loaded += sum(await async_pipeline.run_all([load_shard(shard) for shard in manifest["shards"]]))
+    for member in (parallel_export.DATA_OTHER_MEMBER, parallel_export.POST_DATA_MEMBER):
+        loaded += await load(member, psql_cmd)
+    return loaded
+
+
+def extract_tar_stream(src, dest_dir):
+    """Extracts a tar stream (a directory-format dump) into dest_dir.
+
+    Returns the directory containing toc.dat, or None if there is none.
+    """
+    with tarfile.open(fileobj=src, mode='r|') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(path=dest_dir, filter='data')
+        else:
+            tar.extractall(path=dest_dir)
+    for root, _dirs, files in os.walk(dest_dir):
+        if 'toc.dat' in files:
+            return root
+    return None
+
+
+def detect_dump_format(file_list):
+    """Returns ("directory", dir_member) or ("plain", sql_member) for an archive listing.
+
+    Directory-format dumps are recognised by pg_dump's toc.dat; anything else
+    is treated as a plain SQL dump. The member is None when nothing matches.
+    """
+    for f in file_list:
+        if f == 'toc.dat' or f.endswith('/toc.dat'):
+            return "directory", os.path.dirname(f)
+    for f in file_list:
+        if f.endswith('.sql'):
+            return "plain", f
+    return "plain", None
+
+
+def create_database(target_database, host, port, username, env, createdb_bin="createdb", dropdb_bin="dropdb", psql_bin="psql", auto_confirm=False, template=None, replace=True):
+    """Creates the target database, replacing an existing one after confirmation.
+
+    Sessions still connected to an existing database are terminated if it
+    cannot be dropped otherwise. With `template` the new database is a copy
+    of that (template) database. With replace=False an existing database is
+    kept as it is. Returns False if the user declined to replace an existing
+    database.
+    """
     print(f"Checking/Creating database '{target_database}'...")
 
     createdb_cmd = [
@@ -86,6 +239,9 @@ def restore_postgres(host, port, target_database, username, password, zip_file,
         '-U', username,
         target_database
     ]
+    if template:
+        # CREATE DATABASE ... TEMPLATE: a file-level copy made by the server
+        createdb_cmd[-1:-1] = ['-T', template]
 
     try:
         # Try to create the database.
@@ -97,6 +253,8 @@ def restore_postgres(host, port, target_database, username, password, zip_file,
         if "already exists" in stderr:
             print(f"Database '{target_database}' already exists.")
             logging.info(f"Database '{target_database}' already exists.")
+            if not replace:
+                return True
 
             # Interactive confirmation or auto-confirm
             if not auto_confirm:
@@ -105,7 +263,7 @@ def restore_postgres(host, port, target_database, username, password, zip_file,
                     msg = "Restore cancelled by user."
                     print(msg)
                     logging.info(msg)
-                    return
+                    return False
 
             print(f"Replacing database '{target_database}'...")
             logging.info(f"Replacing database '{target_database}'.")
@@ -170,53 +328,723 @@ def restore_postgres(host, port, target_database, username, password, zip_file,
             print(msg)
             logging.error(msg)
             raise RuntimeError(msg)
+    return True
 
-    # 3. Restore using psql
-    print(f"Restoring data into '{target_database}'...")
 
-    psql_cmd = [
-        psql_bin,
-        '-h', host,
-        '-p', str(port),
-        '-U', username,
-        '-d', target_database,
-        '-f', sql_file_path
-    ]
+def database_exists(psql_cmd, env, name):
+    """True if a database exists. psql_cmd is the connection part without -d."""
+    query = f"SELECT 1 FROM pg_database WHERE datname = {quote_literal(name)};"
+    return bool(incremental_backup.run_query(psql_cmd + ['-d', 'postgres'], env, query))
 
+
+def swap_databases(psql_cmd, env, target_database, shadow_database, old_database):
+    """Puts a restored shadow database in place of the target.
+
+    New connections to the target are refused first, so no client can
+    reconnect between terminating its sessions and the renames. The target
+    becomes `old_database` and the shadow takes its name in one transaction.
+    Returns the seconds during which the target was unavailable.
+    """
+    admin_cmd = psql_cmd + ['-d', 'postgres', '-v', 'ON_ERROR_STOP=1']
+    target = quote_ident(target_database)
+    started = time.perf_counter()
+    subprocess.run(admin_cmd + ['-c', f"ALTER DATABASE {target} WITH ALLOW_CONNECTIONS false;"], env=env, check=True, capture_output=True)
+    script = (
+        "BEGIN;\n"
+        f"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = {quote_literal(target_database)} AND pid <> pg_backend_pid();\n"
+        f"ALTER DATABASE {target} RENAME TO {quote_ident(old_database)};\n"
+        f"ALTER DATABASE {quote_ident(shadow_database)} RENAME TO {target};\n"
+        "COMMIT;\n"
+    )
     try:
-        subprocess.run(psql_cmd, env=env, check=True)
-        print("Restore completed successfully.")
-        logging.info("Restore completed successfully.")
-    except subprocess.CalledProcessError as e:
-        stderr = e.stderr.decode() if e.stderr else "No error output"
-        msg = f"Error running psql:\n{stderr}"
-        print(msg)
-        logging.error(msg)
+        subprocess.run(admin_cmd, input=script.encode(), env=env, check=True, capture_output=True)
+    except subprocess.CalledProcessError:
+        # The transaction rolled back; let clients back into the original database
+        subprocess.run(admin_cmd + ['-c', f"ALTER DATABASE {target} WITH ALLOW_CONNECTIONS true;"], env=env, capture_output=True)
         raise
-    finally:
-        # 4. Cleanup
-        if 'temp_dir_obj' in locals():
-            temp_dir_obj.cleanup()
-            print("Cleaned up temporary extraction directory.")
-            logging.info("Cleaned up temporary extraction directory.")
+    return time.perf_counter() - started
+
+
+async def restore_postgres_async(host, port, target_database, username, password, zip_file, auto_confirm=False, dry_run=False, bin_dir=None, stream=True, jobs=1, metrics_file=None, prometheus_dir=None, fast_restore=False, single_transaction=False, maintenance_work_mem=FAST_RESTORE_MAINTENANCE_WORK_MEM, use_template_cache=False, cache_max_templates=template_cache.DEFAULT_MAX_TEMPLATES, cache_max_bytes=None, swap=False, keep_old=False, tables=None, schemas=None, storage_options=None, on_event=None):
+    """Restores a PostgreSQL database from a backup archive.
+
+    The archive codec (zip, gzip, zstd, lz4, xz) is detected from its header;
+    a chunk-store .manifest is reassembled from its deduplicated chunks.
+    With stream=True (default) the .sql dump is piped straight into psql;
+    stream=False extracts it to a temporary directory first (legacy mode).
+    Directory-format archives are extracted and loaded with pg_restore using
+    `jobs` parallel workers; the shards of a parallel COPY archive are
+    loaded by `jobs` concurrent psql sessions (see load_parallel_archive).
+    Per-phase timings are emitted like backup_postgres's (see run_metrics).
+    fast_restore loads with restore-tuned session settings (see
+    fast_restore_options) and runs VACUUM ANALYZE afterwards; the time saved
+    is estimated against earlier restores in metrics_file.
+    single_transaction loads everything in one transaction that rolls back
+    on the first error.
+    With use_template_cache the archive is restored once into a template
+    database keyed by its checksum, and later restores of the same archive
+    copy that template with CREATE DATABASE ... TEMPLATE (see
+    template_cache). cache_max_templates and cache_max_bytes bound the cache.
+    With swap the archive is restored into a shadow database while the
+    existing target keeps serving, then swapped in with two renames (see
+    swap_databases); keep_old keeps the replaced copy instead of dropping it.
+    `tables` ("schema.table" or "table") and `schemas` restore only those
+    objects, into the target database as it is if it already exists. Indexed
+    archives read just the zip members of the selected objects (see
+    indexed_archive); directory-format archives pass the filters to
+    pg_restore -t/-n.
+    An archive that archive_tiers has since recompressed or moved to a cold
+    directory is found through the catalog of the directory it was
+    written to.
+    zip_file may also be a storage URL (e.g. s3://bucket/prefix/name.zip);
+    the archive is then downloaded into a temporary directory with
+    concurrent ranged reads first (see storage_backends), using
+    storage_options.
+    `on_event` is called with a dict for every phase start and end, the
+    bytes loaded so far, each COPY block's row count and any error (see
+    progress_events); while a .sql dump is streamed into psql,
+    bytes_expected comes from the archive's digest file or table of
+    contents, or is None if unknown.
+    A streamed .sql dump is read (decompressed) and loaded as two concurrent
+    stages (see pipe_dump_to_psql); every other blocking step runs on the
+    event loop's thread pool, so many restores can share one event loop.
+    restore_postgres is the synchronous wrapper.
+    """
+    logging.info(f"Starting restore for database '{target_database}' from {zip_file}")
+
+    tables = list(tables or [])
+    schemas = list(schemas or [])
+    selective = bool(tables or schemas)
+    if selective and (swap or use_template_cache):
+        raise ValueError("--table/--schema cannot be combined with --swap or --template-cache.")
+
+    metrics = run_metrics.RunMetrics("restore", target_database, on_event=on_event, host=host, port=port, profile="fast" if fast_restore else "default")
+    metrics.archive = zip_file
+    with metrics.recording(metrics_file, prometheus_dir), contextlib.ExitStack() as cleanup:
+        # Resolve binary paths
+        def get_bin(name):
+            if not bin_dir:
+                return name
+            path = os.path.join(bin_dir, name)
+            if sys.platform == "win32" and not path.lower().endswith(".exe"):
+                path += ".exe"
+            return path
+
+        psql_bin = get_bin("psql")
+        createdb_bin = get_bin("createdb")
+        dropdb_bin = get_bin("dropdb")
+        pg_restore_bin = get_bin("pg_restore")
+
+        def require_bin(b):
+            if shutil.which(b) is None:
+                msg = f"Required command '{b}' not found. Please check bin path."
+                print(msg)
+                logging.error(msg)
+                raise EnvironmentError(msg)
+
+        # Preflight: ensure required binaries exist
+        with metrics.phase("resolve_binaries"):
+            for b in [psql_bin, createdb_bin, dropdb_bin]:
+                require_bin(b)
+
+        # Set password in environment variable for all libpq commands
+        env = os.environ.copy()
+        env['PGPASSWORD'] = password
+        if fast_restore:
+            # PGOPTIONS applies the settings to every session psql and pg_restore open
+            env['PGOPTIONS'] = f"{env.get('PGOPTIONS', '')} {fast_restore_options(maintenance_work_mem)}".strip()
+            logging.info(f"Fast-restore profile: {fast_restore_options(maintenance_work_mem)}")
+
+        if not storage_backends.is_url(zip_file) and not os.path.exists(zip_file):
+            # Recompressed or moved to a colder tier since the path was taken
+            moved = await async_pipeline.to_thread(archive_tiers.locate_archive, zip_file)
+            if moved:
+                msg = f"Archive {zip_file} has moved to {moved}"
+                print(msg)
+                logging.info(msg)
+                zip_file = metrics.archive = moved
+
+        # The template cache keys archives by where they came from, not by the downloaded copy
+        source = zip_file
+        if storage_backends.is_url(zip_file):
+            download_dir = cleanup.enter_context(tempfile.TemporaryDirectory(prefix="pg_restore_download_"))
+            print(f"Downloading {zip_file}...")
+            with metrics.phase("download") as phase:
+                zip_file = await async_pipeline.to_thread(storage_backends.download, zip_file, download_dir, **(storage_options or {}))
+                phase.bytes_out = os.path.getsize(zip_file)
+
+        if swap:
+            shadow_database = f"{target_database}_shadow"
+            old_database = f"{target_database}_old_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            if len(old_database.encode()) > MAX_IDENTIFIER_LENGTH:
+                raise ValueError(f"Database name '{target_database}' is too long for a swap restore (the old copy would be named '{old_database}').")
+            admin_cmd = [psql_bin, '-h', host, '-p', str(port), '-U', username]
+            target_exists = await async_pipeline.to_thread(database_exists, admin_cmd, env, target_database)
+            if target_exists and not auto_confirm:
+                confirm = await async_pipeline.to_thread(input, f"Database '{target_database}' already exists. Replace it once the restore has finished? (y/n): ")
+                if confirm.lower() != 'y':
+                    msg = "Restore cancelled by user."
+                    print(msg)
+                    logging.info(msg)
+                    metrics.finish("cancelled")
+                    return
+
+            print(f"Restoring into shadow database '{shadow_database}'; '{target_database}' stays online...")
+            logging.info(f"Swap restore of '{target_database}' via shadow database '{shadow_database}'")
+            with metrics.phase("restore_shadow"):
+                try:
+                    await restore_postgres_async(host, port, shadow_database, username, password, zip_file, auto_confirm=True, bin_dir=bin_dir, stream=stream, jobs=jobs, fast_restore=fast_restore, single_transaction=single_transaction, maintenance_work_mem=maintenance_work_mem, use_template_cache=use_template_cache, cache_max_templates=cache_max_templates, cache_max_bytes=cache_max_bytes, on_event=on_event)
+                except BaseException:
+                    # The target was never touched; only the shadow copy is discarded
+                    await async_pipeline.to_thread(subprocess.run, admin_cmd + ['-d', 'postgres', '-c', f"DROP DATABASE IF EXISTS {quote_ident(shadow_database)};"], env=env, capture_output=True)
+                    raise
+
+            with metrics.phase("swap"):
+                if target_exists:
+                    print(f"Swapping '{shadow_database}' in place of '{target_database}'...")
+                    try:
+                        downtime = await async_pipeline.to_thread(swap_databases, admin_cmd, env, target_database, shadow_database, old_database)
+                    except subprocess.CalledProcessError as e:
+                        msg = f"Swap failed; '{target_database}' is unchanged and the restored copy remains as '{shadow_database}':\n{e.stderr.decode() if e.stderr else ''}"
+                        print(msg)
+                        logging.error(msg)
+                        raise
+                    metrics.labels["downtime_seconds"] = round(downtime, 3)
+                    msg = f"Database '{target_database}' swapped in; it was unavailable for {downtime:.2f}s"
+                else:
+                    await async_pipeline.run_command(admin_cmd + ['-d', 'postgres', '-v', 'ON_ERROR_STOP=1', '-c', f"ALTER DATABASE {quote_ident(shadow_database)} RENAME TO {quote_ident(target_database)};"], env)
+                    msg = f"Database '{target_database}' created from shadow database '{shadow_database}'"
+            print(msg)
+            logging.info(msg)
+
+            if target_exists and keep_old:
+                await async_pipeline.run_command(admin_cmd + ['-d', 'postgres', '-c', f"ALTER DATABASE {quote_ident(old_database)} WITH ALLOW_CONNECTIONS true;"], env)
+                print(f"Previous database kept as '{old_database}'.")
+                logging.info(f"Previous database kept as '{old_database}'")
+            elif target_exists:
+                with metrics.phase("drop_old"):
+                    await async_pipeline.run_command(admin_cmd + ['-d', 'postgres', '-c', f"DROP DATABASE {quote_ident(old_database)};"], env)
+                logging.info(f"Dropped previous database '{old_database}'")
+            print("Restore completed successfully.")
+            return
+
+        if use_template_cache:
+            cache = template_cache.TemplateCache([psql_bin, '-h', host, '-p', str(port), '-U', username], env, max_templates=cache_max_templates, max_bytes=cache_max_bytes)
+            # Hash the whole archive only when no checksum was recorded for it
+            checksum = await async_pipeline.to_thread(recorded_checksum, zip_file)
+            if checksum is None:
+                with metrics.phase("checksum") as phase:
+                    checksum = await async_pipeline.to_thread(backup_catalog.file_checksum, zip_file)
+                    phase.bytes_in = os.path.getsize(zip_file)
+            for name in await async_pipeline.to_thread(cache.invalidate, source, checksum):
+                print(f"Dropped outdated template '{name}': {source} has changed.")
+            entry = await async_pipeline.to_thread(cache.lookup, checksum)
+            if entry is None:
+                loading = template_cache.loading_name(checksum)
+                print(f"Template cache miss: restoring {source} into a new template database...")
+                logging.info(f"Template cache miss for {source} ({checksum}); restoring into {loading}")
+                with metrics.phase("populate_cache"):
+                    try:
+                        await restore_postgres_async(host, port, loading, username, password, zip_file, auto_confirm=True, bin_dir=bin_dir, stream=stream, jobs=jobs, fast_restore=fast_restore, single_transaction=single_transaction, maintenance_work_mem=maintenance_work_mem, on_event=on_event)
+                        entry = await async_pipeline.to_thread(cache.register, loading, checksum, source)
+                    except BaseException:
+                        # Never leave a half-restored copy behind
+                        await async_pipeline.to_thread(subprocess.run, cache.psql_cmd + ['-c', f'DROP DATABASE IF EXISTS "{loading}";'], env=env, capture_output=True)
+                        raise
+            else:
+                print(f"Template cache hit: '{entry['name']}'")
+                logging.info(f"Template cache hit for {source}: {entry['name']}")
+                await async_pipeline.to_thread(cache.touch, entry)
+
+            with metrics.phase("clone_template"):
+                if not await async_pipeline.to_thread(create_database, target_database, host, port, username, env, createdb_bin, dropdb_bin, psql_bin, auto_confirm=auto_confirm, template=entry["name"]):
+                    metrics.finish("cancelled")
+                    return
+            for name in await async_pipeline.to_thread(cache.evict, keep=entry["name"]):
+                print(f"Evicted template database '{name}' from the cache.")
+            print("Restore completed successfully.")
+            logging.info(f"Database '{target_database}' created from template '{entry['name']}'")
+            return
+
+        # 1. Unpack the archive (or just locate the dump when streaming)
+        metrics.begin("extract")
+        phase_started = time.perf_counter()
+        if stream:
+            print(f"Reading {zip_file}...")
+        else:
+            print(f"Unpacking {zip_file}...")
+        temp_dir_obj = None if stream else tempfile.TemporaryDirectory()
+        codec = dump_format = sql_file = sql_file_path = parallel_manifest = None
+        try:
+            def open_dump():
+                if codec == "chunks":
+                    return chunk_store.open_manifest_reader(zip_file)
+                if dump_format == "incremental":
+                    return incremental_backup.open_chain_reader(zip_file)
+                if dump_format == "indexed":
+                    return indexed_archive.open_reader(zip_file, tables, schemas)
+                return archive_codecs.open_reader(zip_file, codec, member=sql_file)
+
+            def unpack():
+                # Detecting the format and any extraction read the archive; done on a worker thread
+                nonlocal codec, dump_format, sql_file, sql_file_path, temp_dir_obj, parallel_manifest
+                codec = archive_codecs.detect_codec(zip_file)
+                if codec != "chunks":
+                    archive_codecs.check_codec_available(codec)
+                logging.info(f"Detected archive codec: {codec}")
+
+                if codec == "chunks":
+                    # Deduplicated backups are always plain SQL dumps
+                    dump_format = "plain"
+                    sql_file = os.path.basename(zip_file)[:-len(chunk_store.MANIFEST_EXTENSION)] + ".sql"
+                    chunk_store.read_manifest(zip_file)
+                    if not stream:
+                        sql_file_path = os.path.join(temp_dir_obj.name, sql_file)
+                        with open_dump() as src, open(sql_file_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                elif codec == "zip" and incremental_backup.read_manifest(zip_file):
+                    # Table-level incremental archive: schema from this archive, table
+                    # data from wherever each table was last dumped
+                    dump_format = "incremental"
+                    sql_file = os.path.basename(zip_file)[:-len(".zip")] + ".sql"
+                    plan = incremental_backup.restore_plan(zip_file)
+                    logging.info(f"Incremental restore reads {len(plan)} member(s) from {len({p for p, _m in plan})} archive(s)")
+                    if not stream:
+                        sql_file_path = os.path.join(temp_dir_obj.name, sql_file)
+                        with open_dump() as src, open(sql_file_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                elif codec == "zip" and indexed_archive.read_toc(zip_file):
+                    # Indexed archive: one member per object, located through toc.json
+                    dump_format = "indexed"
+                    sql_file = os.path.basename(zip_file)[:-len(".zip")] + ".sql"
+                    if not stream:
+                        sql_file_path = os.path.join(temp_dir_obj.name, sql_file)
+                        with open_dump() as src, open(sql_file_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                elif codec == "zip" and parallel_export.read_manifest(zip_file):
+                    # Parallel COPY archive: schema files and compressed table shards, read in place
+                    dump_format = parallel_export.PARALLEL_FORMAT
+                    parallel_manifest = parallel_export.read_manifest(zip_file)
+                elif codec == "zip":
+                    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+                        file_list = zip_ref.namelist()
+                        dump_format, sql_file = detect_dump_format(file_list)
+                        if dump_format == "directory":
+                            require_bin(pg_restore_bin)
+                            # pg_restore reads a directory-format dump from disk
+                            if temp_dir_obj is None:
+                                temp_dir_obj = tempfile.TemporaryDirectory()
+                            zip_ref.extractall(path=temp_dir_obj.name)
+                            sql_file_path = os.path.join(temp_dir_obj.name, sql_file)
+                        elif sql_file and not stream:
+                            zip_ref.extract(sql_file, path=temp_dir_obj.name)
+                            sql_file_path = os.path.join(temp_dir_obj.name, sql_file)
+                else:
+                    # Single-stream codecs hold either a .sql dump or a .tar of a directory dump
+                    inner_name = os.path.basename(archive_codecs.strip_codec_extension(zip_file))
+                    dump_format = "directory" if inner_name.endswith('.tar') else "plain"
+                    sql_file = inner_name
+                    if dump_format == "directory" and physical_backup.is_physical_archive(zip_file, codec):
+                        raise ValueError(f"{zip_file} is a physical (pg_basebackup) backup; restore it into a data directory with restore_physical (--data-dir).")
+                    if dump_format == "directory":
+                        require_bin(pg_restore_bin)
+                        if temp_dir_obj is None:
+                            temp_dir_obj = tempfile.TemporaryDirectory()
+                        with archive_codecs.open_reader(zip_file, codec) as src:
+                            sql_file_path = extract_tar_stream(src, temp_dir_obj.name)
+                        if not sql_file_path:
+                            msg = "Error: No toc.dat found in the directory-format archive."
+                            print(msg)
+                            logging.error(msg)
+                            raise ValueError(msg)
+                    elif not stream:
+                        sql_file_path = os.path.join(temp_dir_obj.name, inner_name)
+                        with open_dump() as src, open(sql_file_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+                if selective and dump_format not in ("indexed", "directory"):
+                    raise ValueError("Restoring single tables or schemas needs an indexed (--format indexed) or directory-format archive.")
+
+                if dump_format == "directory":
+                    print(f"Extracted directory-format dump: {sql_file_path}")
+                    logging.info(f"Extracted directory-format dump: {sql_file_path}")
+                elif dump_format == parallel_export.PARALLEL_FORMAT:
+                    msg = f"Found parallel archive: {parallel_manifest['tables']} table(s) in {len(parallel_manifest['shards'])} shard(s)"
+                    print(msg)
+                    logging.info(msg)
+                elif not sql_file:
+                    msg = "Error: No .sql file found in the zip archive."
+                    print(msg)
+                    logging.error(msg)
+                    raise ValueError(msg)
+                elif stream:
+                    sql_file_path = None
+                    print(f"Found dump: {sql_file}")
+                    logging.info(f"Streaming dump {sql_file} from {zip_file}")
+                else:
+                    print(f"Extracted: {sql_file_path}")
+                    logging.info(f"Extracted: {sql_file_path}")
+
+            await async_pipeline.to_thread(unpack)
+            archive_size = os.path.getsize(zip_file)
+            extracted = os.path.getsize(sql_file_path) if sql_file_path and os.path.isfile(sql_file_path) else None
+            metrics.record("extract", time.perf_counter() - phase_started, bytes_in=archive_size, bytes_out=extracted)
+            if codec != "chunks" and dump_format != "incremental":
+                # A manifest or one link of an incremental chain says nothing about the compressed size
+                metrics.compressed_bytes = archive_size
+        except zipfile.BadZipFile:
+            if temp_dir_obj:
+                temp_dir_obj.cleanup()
+            msg = "Error: Invalid zip file."
+            print(msg)
+            logging.error(msg)
+            raise
+        except Exception as e:
+            if temp_dir_obj:
+                temp_dir_obj.cleanup()
+            msg = f"Error reading archive: {e}"
+            print(msg)
+            logging.error(msg)
+            raise
+
+        # 2. Check/Create Database
+        metrics.begin("create_database")
+        phase_started = time.perf_counter()
+        # A selective restore adds objects to an existing database instead of replacing it
+        if not await async_pipeline.to_thread(create_database, target_database, host, port, username, env, createdb_bin, dropdb_bin, psql_bin, auto_confirm=auto_confirm, replace=not selective):
+            metrics.finish("cancelled")
+            return
+        metrics.record("create_database", time.perf_counter() - phase_started)
+
+        # 3. Restore using psql
+        print(f"Restoring data into '{target_database}'...")
+
+        psql_cmd = [
+            psql_bin,
+            '-h', host,
+            '-p', str(port),
+            '-U', username,
+            '-d', target_database,
+        ]
+        vacuum_cmd = psql_cmd + ['-c', 'VACUUM ANALYZE;']
+        # Parallel archives are loaded by several sessions, without the single-transaction flags
+        parallel_cmd = list(psql_cmd)
+        if single_transaction:
+            # Without ON_ERROR_STOP psql would carry on after an error and commit a partial restore
+            psql_cmd += ['--single-transaction', '-v', 'ON_ERROR_STOP=1']
+
+        try:
+            if dump_format == "directory":
+                pg_restore_cmd = [
+                    pg_restore_bin,
+                    '-h', host,
+                    '-p', str(port),
+                    '-U', username,
+                    '-d', target_database,
+                    '-j', str(jobs),
+                    sql_file_path
+                ]
+                if single_transaction:
+                    if jobs > 1:
+                        msg = "pg_restore cannot use a single transaction with parallel jobs; loading without it."
+                        print(msg)
+                        logging.warning(msg)
+                    else:
+                        pg_restore_cmd[-1:-1] = ['--single-transaction', '--exit-on-error']
+                for schema in schemas:
+                    pg_restore_cmd[-1:-1] = ['-n', schema]
+                for table in tables:
+                    # pg_restore -t matches a bare table name; the schema narrows it with -n
+                    schema, _sep, name = table.rpartition(".")
+                    pg_restore_cmd[-1:-1] = ['-t', name] + (['-n', schema] if schema else [])
+                print(f"Running pg_restore with {jobs} parallel job(s)...")
+                with metrics.phase("load"):
+                    await async_pipeline.to_thread(subprocess.run, pg_restore_cmd, env=env, check=True)
+            elif dump_format == parallel_export.PARALLEL_FORMAT:
+                if single_transaction:
+                    msg = "A parallel archive is loaded by several sessions and cannot use a single transaction; loading without it."
+                    print(msg)
+                    logging.warning(msg)
+                tracker = progress_events.StreamProgress(metrics.notify, parallel_manifest["size"], count_rows=False) if on_event is not None else None
+                print(f"Loading {len(parallel_manifest['shards'])} shard(s) with {jobs} parallel job(s)...")
+                with metrics.phase("load") as phase:
+                    loaded = await load_parallel_archive(zip_file, parallel_manifest, parallel_cmd, env, jobs, progress=tracker.feed if tracker is not None else None)
+                    phase.bytes_in = loaded
+                if tracker is not None:
+                    tracker.close()
+                metrics.uncompressed_bytes = loaded
+                logging.info(f"Loaded {loaded} bytes from {len(parallel_manifest['shards'])} shard(s) with {jobs} job(s)")
+            elif stream:
+                stats = {}
+                metrics.begin("decompress", "load")
+                phase_started = time.perf_counter()
+                tracker = None
+                if on_event is not None:
+                    def expected_size():
+                        if dump_format == "indexed":
+                            return sum(seg["size"] for seg in indexed_archive.select_segments(indexed_archive.read_toc(zip_file), tables, schemas))
+                        if dump_format == "incremental":
+                            # The chain also reads tables from older archives
+                            return None
+                        return (archive_digests.read_digests(zip_file) or {}).get("dump_size")
+                    tracker = progress_events.StreamProgress(metrics.notify, await async_pipeline.to_thread(expected_size))
+                async with async_pipeline.in_thread(await async_pipeline.to_thread(open_dump)) as src:
+                    loaded = await pipe_dump_to_psql(psql_cmd, env, src, stats=stats, progress=tracker.feed if tracker is not None else None)
+                if tracker is not None:
+                    tracker.close()
+                # Decompression and loading overlap: "load" is the time spent blocked on psql
+                read_seconds = stats.get("read_seconds", 0.0)
+                metrics.record("decompress", read_seconds, bytes_out=loaded)
+                metrics.record("load", time.perf_counter() - phase_started - read_seconds, bytes_in=loaded)
+                metrics.uncompressed_bytes = loaded
+                logging.info(f"Streamed {loaded} bytes into psql")
+            else:
+                psql_cmd += ['-f', sql_file_path]
+                with metrics.phase("load") as phase:
+                    await async_pipeline.to_thread(subprocess.run, psql_cmd, env=env, check=True)
+                    phase.bytes_in = os.path.getsize(sql_file_path)
+                metrics.uncompressed_bytes = phase.bytes_in
+            if fast_restore:
+                # Fresh tables have no statistics and no visibility map until vacuumed
+                print("Running VACUUM ANALYZE...")
+                with metrics.phase("vacuum_analyze"):
+                    await async_pipeline.run_command(vacuum_cmd, env)
+                logging.info(f"VACUUM ANALYZE of '{target_database}' completed")
+            print("Restore completed successfully.")
+            logging.info("Restore completed successfully.")
+
+            if fast_restore:
+                saved = await async_pipeline.to_thread(estimate_time_saved, metrics_file, target_database, metrics.uncompressed_bytes, _load_seconds(metrics.to_dict()))
+                if saved is None:
+                    msg = "Fast restore: no earlier default-profile restore in the metrics file to estimate the time saved."
+                else:
+                    seconds, baseline = saved
+                    metrics.labels["estimated_seconds_saved"] = round(seconds, 3)
+                    msg = (f"Fast restore: load took {_load_seconds(metrics.to_dict()):.1f}s, an estimated {abs(seconds):.1f}s "
+                           f"{'faster' if seconds >= 0 else 'slower'} than the default profile "
+                           f"(baseline: default-profile restore of '{baseline['database']}' loading {baseline['uncompressed_bytes'] / _load_seconds(baseline) / 1e6:.1f} MB/s)")
+                print(msg)
+                logging.info(msg)
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode() if e.stderr else "No error output"
+            tool = "pg_restore" if dump_format == "directory" else "psql"
+            msg = f"Error running {tool}:\n{stderr}"
+            print(msg)
+            logging.error(msg)
+            raise
+        finally:
+            # 4. Cleanup
+            if temp_dir_obj:
+                await async_pipeline.to_thread(temp_dir_obj.cleanup)
+                print("Cleaned up temporary extraction directory.")
+                logging.info("Cleaned up temporary extraction directory.")
+
+
+def restore_postgres(*args, **kwargs):
+    """Synchronous wrapper: runs restore_postgres_async on a new event loop."""
+    return asyncio.run(restore_postgres_async(*args, **kwargs))
+
+
+# Keeps the full signature visible to help() and inspect
+functools.update_wrapper(restore_postgres, restore_postgres_async, assigned=())
+
+
+async def restore_physical_async(zip_file, data_dir, auto_confirm=False, dry_run=False, restore_command=None, recovery_target_time=None, recovery_target_name=None, recovery_target_lsn=None, recovery_target_action="promote", tablespace_dir=None, metrics_file=None, prometheus_dir=None, storage_options=None, on_event=None):
+    """Lays out a PostgreSQL data directory from a physical (pg_basebackup) archive.
+
+    The archive written by backup_postgres.backup_physical is decompressed
+    and unpacked in one pass into data_dir, its streamed WAL into
+    data_dir/pg_wal and each tablespace into its original location, or
+    below tablespace_dir (see physical_backup.extract_basebackup). The
+    archive's SHA-256 is checked against its digest file on the way; a
+    failed or mismatching restore removes what it wrote. A non-empty
+    data_dir is never deleted: after confirmation (or with auto_confirm) it
+    is moved aside to <data_dir>.old_<timestamp>; a data directory with a
+    running server is refused.
+    With restore_command (e.g. "cp /wal_archive/%f %p") the server is set
+    up to recover from archived WAL when started: up to recovery_target_time,
+    recovery_target_name or recovery_target_lsn if one is given (then
+    taking recovery_target_action), else to the end of the archive.
+    The server itself is not started. Moved archives, storage URLs,
+    run metrics and `on_event` work as for restore_postgres.
+    restore_physical is the synchronous wrapper.
+    """
+    logging.info(f"Starting physical restore of {zip_file} into '{data_dir}'")
+
+    targets = [(name, value) for name, value in (("recovery_target_time", recovery_target_time), ("recovery_target_name", recovery_target_name), ("recovery_target_lsn", recovery_target_lsn)) if value]
+    if len(targets) > 1:
+        raise ValueError("Give at most one recovery target (time, name or LSN).")
+    if targets and not restore_command:
+        raise ValueError("Point-in-time recovery needs a restore_command to fetch the archived WAL after the backup.")
+    if recovery_target_action not in physical_backup.RECOVERY_TARGET_ACTIONS:
+        raise ValueError(f"Unknown recovery target action '{recovery_target_action}'. Expected one of: {', '.join(physical_backup.RECOVERY_TARGET_ACTIONS)}")
+    target = targets[0] if targets else None
+
+    parsed = backup_catalog.parse_archive_name(os.path.basename(zip_file))
+    metrics = run_metrics.RunMetrics("restore", parsed[0] if parsed else os.path.basename(zip_file), on_event=on_event, dump_format=physical_backup.PHYSICAL_FORMAT, data_dir=os.path.abspath(data_dir))
+    metrics.archive = zip_file
+    with metrics.recording(metrics_file, prometheus_dir, enabled=not dry_run), contextlib.ExitStack() as cleanup:
+        if not storage_backends.is_url(zip_file) and not os.path.exists(zip_file):
+            moved = await async_pipeline.to_thread(archive_tiers.locate_archive, zip_file)
+            if moved:
+                msg = f"Archive {zip_file} has moved to {moved}"
+                print(msg)
+                logging.info(msg)
+                zip_file = metrics.archive = moved
+
+        def dry_run_note(msg):
+            print(msg)
+            logging.info(msg)
+
+        try:
+            occupied = await async_pipeline.to_thread(physical_backup.check_data_dir, data_dir)
+        except EnvironmentError as e:
+            print(str(e))
+            logging.error(str(e))
+            raise
+        set_aside = physical_backup.set_aside_path(data_dir) if occupied else None
+        if dry_run:
+            if occupied:
+                dry_run_note(f"[DRY-RUN] Would move the existing data directory aside to: {set_aside}")
+            dry_run_note(f"[DRY-RUN] Would restore {zip_file} into data directory: {data_dir}")
+            if tablespace_dir:
+                dry_run_note(f"[DRY-RUN] Would restore tablespaces below: {tablespace_dir}")
+            if restore_command:
+                dry_run_note(f"[DRY-RUN] Would configure recovery with restore_command {restore_command!r}" + (f" up to {target[0]} {target[1]!r}" if target else " to the end of the archived WAL"))
+            return
+
+        if storage_backends.is_url(zip_file):
+            download_dir = cleanup.enter_context(tempfile.TemporaryDirectory(prefix="pg_restore_download_"))
+            print(f"Downloading {zip_file}...")
+            with metrics.phase("download") as phase:
+                zip_file = await async_pipeline.to_thread(storage_backends.download, zip_file, download_dir, **(storage_options or {}))
+                phase.bytes_out = os.path.getsize(zip_file)
+
+        codec = await async_pipeline.to_thread(archive_codecs.detect_codec, zip_file)
+        if codec in ("zip", "chunks"):
+            raise ValueError(f"{zip_file} is not a physical backup archive.")
+        archive_codecs.check_codec_available(codec)
+
+        if occupied:
+            if not auto_confirm:
+                confirm = await async_pipeline.to_thread(input, f"Data directory '{data_dir}' is not empty. Move it aside to '{set_aside}' and restore? (y/n): ")
+                if confirm.lower() != 'y':
+                    msg = "Restore cancelled by user."
+                    print(msg)
+                    logging.info(msg)
+                    metrics.finish("cancelled")
+                    return
+            os.rename(data_dir, set_aside)
+            msg = f"Moved existing data directory aside to {set_aside}"
+            print(msg)
+            logging.info(msg)
+
+        expected = (await async_pipeline.to_thread(archive_digests.read_digests, zip_file)) or {}
+        tracker = progress_events.StreamProgress(metrics.notify, expected.get("dump_size"), count_rows=False) if on_event is not None else None
+        created = []
+
+        def unpack():
+            # One pass: hash the archive, decompress it and unpack both tar levels
+            with archive_digests.HashingReader(zip_file) as hashed, archive_codecs.open_reader(zip_file, codec, fileobj=hashed) as src:
+                reader = physical_backup.ProgressReader(src, tracker.feed) if tracker is not None else src
+                tablespaces = physical_backup.extract_basebackup(reader, data_dir, tablespace_dir, created)
+                # tarfile stops at the end-of-archive blocks; reading on lets the codec check its trailer
+                while reader.read(CHUNK_SIZE):
+                    pass
+                return tablespaces, hashed.finish()
+
+        print(f"Restoring {zip_file} into {data_dir}...")
+        try:
+            with metrics.phase("extract") as phase:
+                tablespaces, (archive_sha256, archive_size) = await async_pipeline.to_thread(unpack)
+                phase.bytes_in = archive_size
+                phase.bytes_out = tracker.bytes_done if tracker is not None else None
+            if tracker is not None:
+                tracker.close()
+            if expected.get("archive_sha256") and expected["archive_sha256"] != archive_sha256:
+                raise ValueError(f"Checksum mismatch: {zip_file} does not match its digest file; the archive is corrupt.")
+            metrics.compressed_bytes = archive_size
+            metrics.uncompressed_bytes = phase.bytes_out
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                msg = f"Error restoring {zip_file}: {e}"
+                print(msg)
+                logging.error(msg)
+            await async_pipeline.to_thread(physical_backup.discard_restored, created)
+            raise
+
+        for oid, location in tablespaces.items():
+            logging.info(f"Tablespace {oid}: {location}")
+        if restore_command:
+            settings = await async_pipeline.to_thread(physical_backup.write_recovery_config, data_dir, restore_command, target, recovery_target_action)
+            msg = f"Recovery configured in {os.path.join(data_dir, 'postgresql.auto.conf')}: {'; '.join(settings)}"
+            print(msg)
+            logging.info(msg)
+            metrics.labels["recovery_target"] = dict([target]) if target else None
+
+        msg = f"Physical restore completed. Start the server with: pg_ctl -D {data_dir} start"
+        print(msg)
+        logging.info(msg)
+        return data_dir
+
+
+def restore_physical(*args, **kwargs):
+    """Synchronous wrapper: runs restore_physical_async on a new event loop and returns the data directory."""
+    return asyncio.run(restore_physical_async(*args, **kwargs))
+
+
+functools.update_wrapper(restore_physical, restore_physical_async, assigned=())
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Restore a PostgreSQL database from a ZIP file.")
-    parser.add_argument("--host", required=True, help="Database host")
-    parser.add_argument("--port", type=int, required=True, help="Database port")
-    parser.add_argument("--target-database", required=True, help="Target database name")
-    parser.add_argument("--username", required=True, help="Database username")
+    parser = argparse.ArgumentParser(description="Restore a PostgreSQL database from a backup archive.")
+    parser.add_argument("--host", help="Database host (required unless --data-dir)")
+    parser.add_argument("--port", type=int, help="Database port (required unless --data-dir)")
+    parser.add_argument("--target-database", help="Target database name (required unless --data-dir)")
+    parser.add_argument("--username", help="Database username (required unless --data-dir)")
     parser.add_argument("--password", required=False, help="Database password (will prompt if omitted)")
-    parser.add_argument("--zip-file", required=True, help="Path to the .zip backup file")
+    parser.add_argument("--zip-file", "--archive", dest="zip_file", required=True, help="Path or storage URL (s3://bucket/prefix/name) of the backup archive (.zip, .gz, .zst, .lz4, .xz or a chunk-store .manifest)")
     parser.add_argument("--yes", action="store_true", help="Automatically confirm destructive prompts")
     parser.add_argument("--dry-run", action="store_true", help="Run in dry-run mode (no changes)")
 
-    parser.add_argument("--bin-dir", help="Directory containing PostgreSQL binaries (psql, createdb, dropdb)")
+    parser.add_argument("--bin-dir", help="Directory containing PostgreSQL binaries (psql, createdb, dropdb, pg_restore)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of parallel pg_restore jobs or psql sessions (directory-format and parallel archives only)")
+    parser.add_argument("--no-stream", action="store_true", help="Extract the .sql dump to a temporary directory before loading it (legacy mode)")
+    parser.add_argument("--metrics-file", help="Append a JSON record of per-phase timings for the run to this file (JSON lines)")
+    parser.add_argument("--fast", action="store_true", help="Fast-restore profile: synchronous_commit=off, larger maintenance_work_mem and VACUUM ANALYZE at the end")
+    parser.add_argument("--maintenance-work-mem", default=FAST_RESTORE_MAINTENANCE_WORK_MEM, help="maintenance_work_mem used by --fast")
+    parser.add_argument("--single-transaction", action="store_true", help="Load the dump in one transaction, rolled back on the first error")
+    parser.add_argument("--template-cache", dest="use_template_cache", action="store_true", help="Restore the archive once into a cached template database and clone it for later restores")
+    parser.add_argument("--cache-max-templates", type=int, default=template_cache.DEFAULT_MAX_TEMPLATES, help="Template cache: maximum number of cached archives")
+    parser.add_argument("--cache-max-gb", type=float, help="Template cache: maximum total size of the cached databases in GB")
+    parser.add_argument("--swap", action="store_true", help="Restore into a shadow database and swap it in with a rename, keeping the existing database online meanwhile")
+    parser.add_argument("--keep-old", action="store_true", help="With --swap, keep the replaced database as <name>_old_<timestamp> instead of dropping it")
+    parser.add_argument("--prometheus-dir", help="Write run metrics as a .prom file into this node_exporter textfile-collector directory")
+    parser.add_argument("--table", dest="tables", action="append", help="Restore only this table (schema.table or table; repeatable). Needs an indexed or directory-format archive")
+    parser.add_argument("--schema", dest="schemas", action="append", help="Restore only the objects of this schema (repeatable). Needs an indexed or directory-format archive")
+    parser.add_argument("--storage-endpoint", help="Endpoint of an S3-compatible service (e.g. http://localhost:9000 for MinIO)")
+    parser.add_argument("--storage-concurrency", type=int, default=storage_backends.DEFAULT_CONCURRENCY, help="Ranges downloaded in parallel from object storage")
+    parser.add_argument("--progress", action="store_true", help="Show bytes loaded and phase timings on stderr while the restore runs")
+    parser.add_argument("--events-file", help="Append every progress event (phases, bytes, COPY rows, errors) to this file as JSON lines")
+    parser.add_argument("--data-dir", help="Restore a physical (--physical) backup into this data directory instead of into a database; the server is not started")
+    parser.add_argument("--tablespace-dir", help="Physical: restore tablespaces below this directory instead of their original locations")
+    parser.add_argument("--restore-command", help="Physical: restore_command the server recovers archived WAL with when started, e.g. \"cp /wal_archive/%%f %%p\"")
+    parser.add_argument("--recovery-target-time", help="Physical: recover up to this timestamp (needs --restore-command)")
+    parser.add_argument("--recovery-target-name", help="Physical: recover up to this named restore point (needs --restore-command)")
+    parser.add_argument("--recovery-target-lsn", help="Physical: recover up to this WAL location (needs --restore-command)")
+    parser.add_argument("--recovery-target-action", choices=physical_backup.RECOVERY_TARGET_ACTIONS, default="promote", help="Physical: what the server does once the recovery target is reached")
 
     args = parser.parse_args()
+    if not args.data_dir:
+        missing = [opt for opt, value in (("--host", args.host), ("--port", args.port), ("--target-database", args.target_database), ("--username", args.username)) if value is None]
+        if missing:
+            parser.error(f"the following arguments are required: {', '.join(missing)}")
 
-    password = args.password if args.password is not None else getpass.getpass("Database password: ")
+    if args.data_dir:
+        # A physical restore only writes files; it needs no database connection
+        password = None
+    else:
+        password = args.password if args.password is not None else getpass.getpass("Database password: ")
 
     # Configure logging for CLI usage
     logging.basicConfig(
@@ -225,14 +1053,54 @@ if __name__ == "__main__":
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
 
-    restore_postgres(
-        args.host,
-        args.port,
-        args.target_database,
-        args.username,
-        password,
-        args.zip_file,
-        auto_confirm=args.yes,
-        dry_run=args.dry_run,
-        bin_dir=args.bin_dir,
+    on_event = progress_events.combine(
+        progress_events.ConsoleReporter() if args.progress else None,
+        progress_events.event_file_writer(args.events_file) if args.events_file else None,
     )
+    storage_options = dict(endpoint_url=args.storage_endpoint, concurrency=args.storage_concurrency)
+
+    if args.data_dir:
+        restore_physical(
+            args.zip_file,
+            args.data_dir,
+            auto_confirm=args.yes,
+            dry_run=args.dry_run,
+            restore_command=args.restore_command,
+            recovery_target_time=args.recovery_target_time,
+            recovery_target_name=args.recovery_target_name,
+            recovery_target_lsn=args.recovery_target_lsn,
+            recovery_target_action=args.recovery_target_action,
+            tablespace_dir=args.tablespace_dir,
+            metrics_file=args.metrics_file,
+            prometheus_dir=args.prometheus_dir,
+            storage_options=storage_options,
+            on_event=on_event,
+        )
+    else:
+        restore_postgres(
+            args.host,
+            args.port,
+            args.target_database,
+            args.username,
+            password,
+            args.zip_file,
+            auto_confirm=args.yes,
+            dry_run=args.dry_run,
+            bin_dir=args.bin_dir,
+            stream=not args.no_stream,
+            jobs=args.jobs,
+            metrics_file=args.metrics_file,
+            prometheus_dir=args.prometheus_dir,
+            fast_restore=args.fast,
+            single_transaction=args.single_transaction,
+            maintenance_work_mem=args.maintenance_work_mem,
+            use_template_cache=args.use_template_cache,
+            cache_max_templates=args.cache_max_templates,
+            cache_max_bytes=int(args.cache_max_gb * 1024 ** 3) if args.cache_max_gb else None,
+            swap=args.swap,
+            keep_old=args.keep_old,
+            tables=args.tables,
+            schemas=args.schemas,
+            storage_options=storage_options,
+            on_event=on_event,
+        )
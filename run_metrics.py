@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+import threading
+import contextlib
+
+# Logging is configured in the main block or by the importing application
+
+# Prefix of every metric written to a Prometheus textfile
+PROMETHEUS_PREFIX = "pg_backup_restore"
+
+# Serialises appends to a shared JSON-lines metrics file from concurrent backups
+_metrics_file_lock = threading.Lock()
+
+
+class Phase:
+    """Wall time and byte counts of one phase of a backup or restore."""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_in = None
+        self.bytes_out = None
+
+    def to_dict(self):
+        record = {"phase": self.name, "seconds": round(self.seconds, 3)}
+        if self.bytes_in is not None:
+            record["bytes_in"] = self.bytes_in
+        if self.bytes_out is not None:
+            record["bytes_out"] = self.bytes_out
+        moved = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if moved is not None and self.seconds > 0:
+            record["bytes_per_second"] = round(moved / self.seconds)
+        return record
+
+
+class RunMetrics:
+    """Per-phase timings of a single backup or restore run.
+
+    Phases are timed with the phase() context manager, or recorded with
+    record() when the time was measured elsewhere (e.g. the dump and
+    compression halves of a streamed pipeline, which overlap). A phase
+    entered twice accumulates. `uncompressed_bytes` and `compressed_bytes`
+    describe the dump and the archive and give the run's compression ratio
+    and throughput.
+
+    With an `on_event` callback every phase boundary, the start, any error
+    and the end of the run are also passed to it as they happen, as dicts
+    (see notify() and progress_events).
+    """
+
+    def __init__(self, operation, database, on_event=None, **labels):
+        self.operation = operation
+        self.database = database
+        self.on_event = on_event
+        self.labels = labels
+        self.phases = {}
+        self.started_at = time.time()
+        self.finished_at = None
+        self.status = "running"
+        self.error = None
+        self.uncompressed_bytes = None
+        self.compressed_bytes = None
+        self.archive = None
+        self._start = time.perf_counter()
+        self._duration = None
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = Phase(name)
+        return self.phases[name]
+
+    def notify(self, event, **fields):
+        """Passes an event to the on_event callback, if any.
+
+        Every event is a dict with the event kind ("event"), the operation,
+        database, host and port, a "time" stamp and the given fields. A
+        failing callback is logged, never raised into the run.
+        """
+        if self.on_event is None:
+            return
+        record = {"event": event, "operation": self.operation, "database": self.database, "time": round(time.time(), 3)}
+        for label in ("host", "port"):
+            if label in self.labels:
+                record[label] = self.labels[label]
+        record.update(fields)
+        try:
+            self.on_event(record)
+        except Exception as e:
+            logging.error(f"Progress event callback failed: {e}")
+
+    def begin(self, *names):
+        """Announces phases whose time is recorded later with record()."""
+        for name in names:
+            self.notify("phase_start", phase=name)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as `name` and yields its Phase for byte counts."""
+        phase = self._phase(name)
+        self.notify("phase_start", phase=name)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds += time.perf_counter() - start
+            self.notify("phase_end", **phase.to_dict())
+
+    def record(self, name, seconds, bytes_in=None, bytes_out=None):
+        """Adds a phase timing measured by the caller."""
+        phase = self._phase(name)
+        phase.seconds += max(0.0, seconds)
+        if bytes_in is not None:
+            phase.bytes_in = (phase.bytes_in or 0) + bytes_in
+        if bytes_out is not None:
+            phase.bytes_out = (phase.bytes_out or 0) + bytes_out
+        self.notify("phase_end", **phase.to_dict())
+
+    def finish(self, status="success", error=None):
+        """Marks the run as finished. Only the first call takes effect."""
+        if self.finished_at is not None:
+            return
+        self.status = status
+        self.error = str(error) if error is not None else None
+        self.finished_at = time.time()
+        self._duration = time.perf_counter() - self._start
+
+    @property
+    def duration(self):
+        if self._duration is not None:
+            return self._duration
+        return time.perf_counter() - self._start
+
+    def to_dict(self):
+        """Returns the run as a JSON-serialisable record."""
+        duration = self.duration
+        record = {
+            "operation": self.operation,
+            "database": self.database,
+            "hostname": socket.gethostname(),
+            "status": self.status,
+            "started_at": round(self.started_at, 3),
+            "finished_at": round(self.finished_at, 3) if self.finished_at else None,
+            "duration_seconds": round(duration, 3),
+            "uncompressed_bytes": self.uncompressed_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "compression_ratio": None,
+            "bytes_per_second": None,
+            "phases": [p.to_dict() for p in self.phases.values()],
+        }
+        record.update(self.labels)
+        if self.archive:
+            record["archive"] = self.archive
+        if self.error:
+            record["error"] = self.error
+        if self.uncompressed_bytes and self.compressed_bytes:
+            record["compression_ratio"] = round(self.uncompressed_bytes / self.compressed_bytes, 3)
+        if self.uncompressed_bytes is not None and duration > 0:
+            record["bytes_per_second"] = round(self.uncompressed_bytes / duration)
+        return record
+
+    @contextlib.contextmanager
+    def recording(self, metrics_file=None, prometheus_dir=None, enabled=True):
+        """Wraps a whole run: finishes it as success or failed and emits the record.
+
+        Nothing is emitted when `enabled` is false (e.g. for dry runs); the
+        start, error and finish events are sent either way.
+        """
+        self.notify("start", archive=self.archive)
+        try:
+            yield self
+        except BaseException as e:
+            self.finish("failed", e)
+            self.notify("error", error=str(e), error_type=type(e).__name__)
+            raise
+        else:
+            self.finish("success")
+        finally:
+            self.notify(
+                "finish",
+                status=self.status,
+                duration_seconds=round(self.duration, 3),
+                archive=self.archive,
+                uncompressed_bytes=self.uncompressed_bytes,
+                compressed_bytes=self.compressed_bytes,
+            )
+            if enabled:
+                try:
+                    emit(self, metrics_file=metrics_file, prometheus_dir=prometheus_dir)
+                except Exception as e:
+                    # Metrics must never turn a good backup into a failed one
+                    logging.error(f"Could not write run metrics: {e}")
+
+
+def append_json_line(path, record):
+    """Appends one record to a JSON-lines file."""
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _metrics_file_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def read_records(path, operation=None, database=None):
+    """Returns the records of a JSON-lines metrics file, oldest first.
+
+    Unreadable lines are skipped; a missing file yields no records.
+    """
+    if not path or not os.path.exists(path):
+        return []
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if operation is not None and record.get("operation") != operation:
+                continue
+            if database is not None and record.get("database") != database:
+                continue
+            records.append(record)
+    return records
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in labels.items()) + "}"
+
+
+def metric_lines(name, help_text, samples, metric_type="gauge"):
+    """Text exposition lines of one metric: HELP, TYPE and a line per (labels, value) sample."""
+    lines = [f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}.", f"# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{PROMETHEUS_PREFIX}_{name}{_labels(labels) if labels else ''} {value}")
+    return lines
+
+
+def prometheus_text(record):
+    """Renders a run record in the Prometheus text exposition format."""
+    base = {"operation": record["operation"], "database": record["database"]}
+    for key in ("host", "port"):
+        if record.get(key) is not None:
+            base[key] = record[key]
+
+    summary = (
+        ("last_run_timestamp_seconds", "Unix time the last run finished", record["finished_at"]),
+        ("last_run_success", "1 if the last run succeeded, 0 otherwise", 1 if record["status"] == "success" else 0),
+        ("last_run_duration_seconds", "Wall time of the last run", record["duration_seconds"]),
+        ("last_run_uncompressed_bytes", "Uncompressed dump size of the last run", record["uncompressed_bytes"]),
+        ("last_run_compressed_bytes", "Archive size of the last run", record["compressed_bytes"]),
+        ("last_run_compression_ratio", "Uncompressed / compressed size of the last run", record["compression_ratio"]),
+        ("last_run_bytes_per_second", "Uncompressed bytes per second over the last run", record["bytes_per_second"]),
+    )
+    throttle = record.get("throttle")
+    if throttle:
+        summary += (
+            ("last_run_throttle_pauses", "Number of throttling pauses in the last run", throttle.get("pauses")),
+            ("last_run_throttle_paused_seconds", "Seconds the last run was paused by throttling", throttle.get("paused_seconds")),
+            ("last_run_throttle_busy_seconds", "Seconds the last run was slowed down by server load", throttle.get("busy_seconds")),
+            ("last_run_effective_bytes_per_second", "Throttled dump throughput of the last run", throttle.get("effective_bytes_per_second")),
+        )
+    lines = []
+    for name, help_text, value in summary:
+        if value is None:
+            continue
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}.")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}_{name}{_labels(base)} {value}")
+
+    stages = record.get("pipeline_busy_seconds")
+    if stages:
+        name = "pipeline_stage_busy_seconds"
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} Seconds each stage of the last run's streaming pipeline was busy.")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+        for stage, seconds in stages.items():
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{_labels(dict(base, stage=stage))} {seconds}")
+
+    phase_metrics = (
+        ("phase_duration_seconds", "Wall time of each phase of the last run", "seconds"),
+        ("phase_bytes_in", "Bytes consumed by each phase of the last run", "bytes_in"),
+        ("phase_bytes_out", "Bytes produced by each phase of the last run", "bytes_out"),
+    )
+    for name, help_text, key in phase_metrics:
+        samples = [p for p in record["phases"] if p.get(key) is not None]
+        if not samples:
+            continue
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}.")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+        for p in samples:
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{_labels(dict(base, phase=p['phase']))} {p[key]}")
+    return "\n".join(lines) + "\n"
+
+
+def prometheus_path(prometheus_dir, operation, database):
+    """Textfile name for one operation and database, so concurrent runs never share a file."""
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in database)
+    return os.path.join(prometheus_dir, f"{PROMETHEUS_PREFIX}_{operation}_{safe}.prom")
+
+
+def write_prometheus(prometheus_dir, record):
+    """Atomically writes a run record for the node_exporter textfile collector."""
+    os.makedirs(prometheus_dir, exist_ok=True)
+    path = prometheus_path(prometheus_dir, record["operation"], record["database"])
+    # The collector only reads *.prom, so the temporary name is never picked up half-written
+    fd, tmp_path = tempfile.mkstemp(dir=prometheus_dir, prefix=".tmp_", suffix=".prom.tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(prometheus_text(record))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def emit(metrics, metrics_file=None, prometheus_dir=None):
+    """Logs a run's JSON record and writes it to the optional outputs."""
+    record = metrics.to_dict()
+    logging.info(f"Run metrics: {json.dumps(record, sort_keys=True)}")
+    if metrics_file:
+        append_json_line(metrics_file, record)
+    if prometheus_dir:
+        write_prometheus(prometheus_dir, record)
+    return record
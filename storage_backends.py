@@ -0,0 +1,543 @@
+import io
+import os
+import sys
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import datetime
+import functools
+import collections
+import urllib.parse
+import concurrent.futures
+
+# Logging is configured in the main block or by the importing application
+
+# Size of each part of a multipart upload. S3 allows at most MAX_PARTS parts,
+# so uploads of unknown length grow their parts as they go (see part_size_for)
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+# Size of each ranged GET when reading an object
+DEFAULT_RANGE_SIZE = 8 * 1024 * 1024
+
+# Parts uploaded or ranges downloaded at the same time
+DEFAULT_CONCURRENCY = 4
+
+# Attempts per part or range before an upload or download fails
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+ObjectInfo = collections.namedtuple("ObjectInfo", ("name", "size", "modified"))
+
+
+def is_url(location):
+    """True if a backup location is a storage URL (e.g. s3://bucket/prefix) rather than a local path."""
+    return "://" in str(location)
+
+
+def part_size_for(part_number, part_size=DEFAULT_PART_SIZE):
+    """Size of a part of an upload whose total length is not known in advance.
+
+    The size doubles every MAX_PARTS // 10 parts, so a stream of any
+    realistic size fits in MAX_PARTS parts while small backups still use
+    small parts.
+    """
+    return part_size * 2 ** ((part_number - 1) // (MAX_PARTS // 10))
+
+
+def _with_retries(what, fn, *args, **kwargs):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            delay = RETRY_DELAY * 2 ** (attempt - 1)
+            logging.warning(f"{what} failed (attempt {attempt}/{MAX_ATTEMPTS}): {e}; retrying in {delay:.0f}s")
+            time.sleep(delay)
+
+
+class StorageBackend:
+    """Where backup archives are kept.
+
+    Objects are addressed by name (an archive file name); url() gives the
+    location recorded in the backup catalog. Subclasses implement the
+    primitives below; upload_file and download_file stream through them.
+    """
+
+    def url(self, name):
+        raise NotImplementedError
+
+    def open_write(self, name):
+        """Opens a writable binary stream that becomes object `name` when closed.
+
+        Leaving the stream's `with` block with an exception discards the
+        object where the backend supports it.
+        """
+        raise NotImplementedError
+
+    def open_read(self, name):
+        """Opens a seekable, readable binary stream of object `name`."""
+        raise NotImplementedError
+
+    def put_bytes(self, name, data):
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Returns ObjectInfo for every object whose name starts with `prefix`, sorted by name."""
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def delete(self, name):
+        """Deletes an object; deleting a missing object is not an error."""
+        raise NotImplementedError
+
+    def upload_file(self, local_path, name):
+        with open(local_path, 'rb') as src, self.open_write(name) as dst:
+            shutil.copyfileobj(src, dst, DEFAULT_RANGE_SIZE)
+
+    def download_file(self, name, local_path):
+        with self.open_read(name) as src, open(local_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, DEFAULT_RANGE_SIZE)
+
+
+class LocalBackend(StorageBackend):
+    """Archives in a local (or mounted) directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def url(self, name):
+        return self.path(name)
+
+    def open_write(self, name):
+        os.makedirs(self.root, exist_ok=True)
+        return open(self.path(name), 'wb')
+
+    def open_read(self, name):
+        return open(self.path(name), 'rb')
+
+    def put_bytes(self, name, data):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.path(name) + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(name))
+
+    def list(self, prefix=""):
+        if not os.path.isdir(self.root):
+            return []
+        objects = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.startswith(prefix):
+                st = entry.stat()
+                objects.append(ObjectInfo(entry.name, st.st_size, st.st_mtime))
+        return sorted(objects)
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def delete(self, name):
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+    def upload_file(self, local_path, name):
+        os.makedirs(self.root, exist_ok=True)
+        shutil.copyfile(local_path, self.path(name))
+
+    def download_file(self, name, local_path):
+        shutil.copyfile(self.path(name), local_path)
+
+
+def _require_boto3():
+    try:
+        import boto3
+    except ImportError:
+        raise EnvironmentError("S3 storage requires the 'boto3' package (pip install boto3).")
+    return boto3
+
+
+@functools.lru_cache(maxsize=None)
+def _s3_client(endpoint_url=None):
+    # Clients are thread-safe and expensive to create; share one per endpoint
+    return _require_boto3().session.Session().client("s3", endpoint_url=endpoint_url)
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """Writable stream uploaded to S3 as a multipart upload.
+
+    Parts are uploaded on a thread pool while the stream is still being
+    written, and each part is retried on its own, so a network error costs
+    one part rather than the whole backup. At most two parts per thread are
+    buffered. A stream shorter than one part is sent with a single PUT.
+    Leaving the `with` block with an exception aborts the upload, so a
+    failed backup never leaves a truncated object behind.
+    """
+
+    def __init__(self, backend, key):
+        self._backend = backend
+        self._key = key
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._part_number = 0
+        self._parts = []
+        self._pending = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=backend.concurrency)
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= part_size_for(self._part_number + 1, self._backend.part_size):
+            size = part_size_for(self._part_number + 1, self._backend.part_size)
+            part = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._submit(part)
+        return len(data)
+
+    def _submit(self, data):
+        client = self._backend.client
+        if self._upload_id is None:
+            response = _with_retries(f"Starting upload of {self._key}", client.create_multipart_upload, Bucket=self._backend.bucket, Key=self._key)
+            self._upload_id = response["UploadId"]
+        self._part_number += 1
+        self._pending.append(self._executor.submit(self._backend._upload_part, self._key, self._upload_id, self._part_number, data))
+        while len(self._pending) > self._backend.concurrency * 2:
+            self._parts.append(self._pending.pop(0).result())
+
+    def close(self):
+        if not self.closed:
+            try:
+                client = self._backend.client
+                if self._upload_id is None:
+                    _with_retries(f"Uploading {self._key}", client.put_object, Bucket=self._backend.bucket, Key=self._key, Body=bytes(self._buffer))
+                else:
+                    if self._buffer:
+                        self._submit(bytes(self._buffer))
+                    self._parts += [f.result() for f in self._pending]
+                    self._pending = []
+                    _with_retries(
+                        f"Completing upload of {self._key}",
+                        client.complete_multipart_upload,
+                        Bucket=self._backend.bucket,
+                        Key=self._key,
+                        UploadId=self._upload_id,
+                        MultipartUpload={"Parts": sorted(self._parts, key=lambda p: p["PartNumber"])},
+                    )
+                    logging.info(f"Uploaded {self.bytes_written} bytes to {self._backend.url_for_key(self._key)} in {self._part_number} part(s)")
+                self._buffer.clear()
+            except BaseException:
+                self._abort()
+                raise
+            finally:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
+
+    def _abort(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self._upload_id is not None:
+            try:
+                self._backend.client.abort_multipart_upload(Bucket=self._backend.bucket, Key=self._key, UploadId=self._upload_id)
+                logging.info(f"Aborted upload of {self._backend.url_for_key(self._key)}")
+            except Exception as e:
+                logging.error(f"Could not abort upload of {self._key}: {e}")
+            self._upload_id = None
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and not self.closed:
+            self._abort()
+            super().close()
+            return False
+        return super().__exit__(exc_type, exc, tb)
+
+
+class RangedReader(io.RawIOBase):
+    """Seekable readable stream of an S3 object fetched with concurrent ranged GETs.
+
+    The ranges after the read position are prefetched on a thread pool
+    (`concurrency` of them, `range_size` bytes each); a seek elsewhere drops
+    them. Each range is retried on its own.
+    """
+
+    def __init__(self, backend, key, size):
+        self._backend = backend
+        self._key = key
+        self._size = size
+        self._range_size = backend.range_size
+        self._pos = 0
+        self._ranges = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=backend.concurrency)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos >= self._size or not len(b):
+            return 0
+        index = self._pos // self._range_size
+        last = (self._size - 1) // self._range_size
+        wanted = range(index, min(index + self._backend.concurrency, last + 1))
+        for i in list(self._ranges):
+            if i not in wanted:
+                self._ranges.pop(i).cancel()
+        for i in wanted:
+            if i not in self._ranges:
+                start = i * self._range_size
+                end = min(start + self._range_size, self._size) - 1
+                self._ranges[i] = self._executor.submit(self._backend._get_range, self._key, start, end)
+        data = self._ranges[index].result()
+        offset = self._pos - index * self._range_size
+        n = min(len(b), len(data) - offset)
+        b[:n] = data[offset:offset + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._ranges.values():
+                future.cancel()
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
+
+
+class S3Backend(StorageBackend):
+    """Archives in an S3-compatible bucket (AWS S3, MinIO, Ceph, ...).
+
+    Credentials come from the usual boto3 sources (environment, profile,
+    instance role); `endpoint_url` points at a non-AWS service.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, part_size=DEFAULT_PART_SIZE, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_CONCURRENCY, client=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"S3 parts must be at least {MIN_PART_SIZE // (1024 * 1024)} MB.")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.endpoint_url = endpoint_url
+        self.part_size = part_size
+        self.range_size = range_size
+        self.concurrency = max(1, concurrency)
+        self.client = client or _s3_client(endpoint_url)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def url_for_key(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+    def url(self, name):
+        return self.url_for_key(self.key(name))
+
+    def _upload_part(self, key, upload_id, part_number, data):
+        response = _with_retries(
+            f"Uploading part {part_number} of {key}",
+            self.client.upload_part,
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def _get_range(self, key, start, end):
+        def get():
+            response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end}")
+            data = response["Body"].read()
+            if len(data) != end - start + 1:
+                raise IOError(f"Short read of {key} bytes {start}-{end}: got {len(data)} bytes")
+            return data
+        return _with_retries(f"Downloading bytes {start}-{end} of {key}", get)
+
+    def open_write(self, name):
+        return MultipartUploadWriter(self, self.key(name))
+
+    def open_read(self, name):
+        size = self.client.head_object(Bucket=self.bucket, Key=self.key(name))["ContentLength"]
+        # Buffered so that read(n) returns n bytes, as zipfile and the codecs expect
+        return io.BufferedReader(RangedReader(self, self.key(name), size), buffer_size=self.range_size)
+
+    def put_bytes(self, name, data):
+        _with_retries(f"Uploading {self.key(name)}", self.client.put_object, Bucket=self.bucket, Key=self.key(name), Body=data)
+
+    def list(self, prefix=""):
+        objects = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(prefix)):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(self.prefix):]
+                # Only objects directly under the prefix, like a directory listing
+                if "/" not in name:
+                    objects.append(ObjectInfo(name, obj["Size"], obj["LastModified"].timestamp()))
+        return sorted(objects)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def _find_upload(self, key):
+        """Returns the id of the newest unfinished multipart upload of a key, or None."""
+        uploads = []
+        paginator = self.client.get_paginator("list_multipart_uploads")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=key):
+            uploads += [u for u in page.get("Uploads", []) if u["Key"] == key]
+        if not uploads:
+            return None
+        return max(uploads, key=lambda u: u["Initiated"])["UploadId"]
+
+    def _uploaded_parts(self, key, upload_id):
+        parts = {}
+        paginator = self.client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id):
+            for p in page.get("Parts", []):
+                parts[p["PartNumber"]] = p
+        return parts
+
+    def upload_file(self, local_path, name):
+        """Uploads a local file with concurrent parts, resuming an interrupted upload.
+
+        If an unfinished multipart upload of the same object exists, parts
+        already uploaded with the same size and MD5 are kept and only the
+        rest are sent.
+        """
+        key = self.key(name)
+        size = os.path.getsize(local_path)
+        if size <= self.part_size:
+            with open(local_path, 'rb') as f:
+                self.put_bytes(name, f.read())
+            return
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        count = -(-size // part_size)
+
+        upload_id = self._find_upload(key)
+        done = self._uploaded_parts(key, upload_id) if upload_id else {}
+        if upload_id and done:
+            logging.info(f"Resuming upload of {self.url_for_key(key)}: {len(done)} part(s) already uploaded")
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)["UploadId"]
+
+        def send(part_number):
+            with open(local_path, 'rb') as f:
+                f.seek((part_number - 1) * part_size)
+                data = f.read(part_size)
+            previous = done.get(part_number)
+            if previous and previous["Size"] == len(data) and previous["ETag"].strip('"') == hashlib.md5(data).hexdigest():
+                return {"PartNumber": part_number, "ETag": previous["ETag"]}
+            return self._upload_part(key, upload_id, part_number, data)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            parts = list(executor.map(send, range(1, count + 1)))
+        # The upload is left open on failure so that the next attempt resumes it
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+        logging.info(f"Uploaded {local_path} to {self.url_for_key(key)} in {count} part(s)")
+
+
+def open_backend(location, endpoint_url=None, part_size=DEFAULT_PART_SIZE, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """Opens the backend for a backup location: a directory or an s3://bucket/prefix URL."""
+    if not is_url(location):
+        return LocalBackend(location)
+    parsed = urllib.parse.urlparse(location)
+    if parsed.scheme != "s3":
+        raise ValueError(f"Unsupported storage URL '{location}'. Expected a directory or s3://bucket/prefix.")
+    return S3Backend(parsed.netloc, parsed.path, endpoint_url=endpoint_url, part_size=part_size, range_size=range_size, concurrency=concurrency)
+
+
+def split_location(location, **options):
+    """Returns (backend, name) for the location of a single archive, as stored in the catalog."""
+    if is_url(location):
+        parent, _sep, name = location.rpartition("/")
+    else:
+        parent, name = os.path.split(location)
+    return open_backend(parent or ".", **options), name
+
+
+def download(location, dest_dir, **options):
+    """Downloads one archive into dest_dir and returns the local path."""
+    backend, name = split_location(location, **options)
+    local_path = os.path.join(dest_dir, name)
+    started = time.perf_counter()
+    backend.download_file(name, local_path)
+    size = os.path.getsize(local_path)
+    elapsed = time.perf_counter() - started
+    logging.info(f"Downloaded {location} ({size} bytes) in {elapsed:.1f}s ({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+    return local_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, upload and download backup archives in a storage location.")
+    parser.add_argument("--storage-url", required=True, help="Backup location: a directory or s3://bucket/prefix")
+    parser.add_argument("--storage-endpoint", help="Endpoint of an S3-compatible service (e.g. http://localhost:9000 for MinIO)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Parts uploaded or ranges downloaded in parallel")
+    parser.add_argument("--part-size-mb", type=int, default=DEFAULT_PART_SIZE // (1024 * 1024), help="Multipart upload part size in MB (minimum 5)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = sub.add_parser("list", help="List the archives in the location")
+    list_parser.add_argument("--prefix", default="", help="Only list names starting with this prefix")
+
+    upload_parser = sub.add_parser("upload", help="Upload local files, resuming interrupted uploads")
+    upload_parser.add_argument("files", nargs="+", help="Local files to upload")
+
+    download_parser = sub.add_parser("download", help="Download an archive")
+    download_parser.add_argument("name", help="Archive name in the location")
+    download_parser.add_argument("--dest-dir", default=".", help="Directory to download into")
+
+    args = parser.parse_args()
+
+    # Configure logging for CLI usage
+    logging.basicConfig(
+        filename='storage_backends.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    backend = open_backend(args.storage_url, endpoint_url=args.storage_endpoint, part_size=args.part_size_mb * 1024 * 1024, concurrency=args.concurrency)
+    try:
+        if args.command == "list":
+            for obj in backend.list(args.prefix):
+                modified = datetime.datetime.fromtimestamp(obj.modified).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"{modified}  {obj.size:>14}  {obj.name}")
+        elif args.command == "upload":
+            for path in args.files:
+                backend.upload_file(path, os.path.basename(path))
+                print(f"Uploaded {path} to {backend.url(os.path.basename(path))}")
+        elif args.command == "download":
+            path = download(backend.url(args.name), args.dest_dir, endpoint_url=args.storage_endpoint, concurrency=args.concurrency)
+            print(f"Downloaded {path}")
+    except Exception as e:
+        msg = f"Storage operation failed: {e}"
+        print(msg)
+        logging.error(msg)
+        sys.exit(1)
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import logging
+import subprocess
+
+import incremental_backup
+
+# Logging is configured in the main block or by the importing application
+
+# Name prefix of the cached template databases; the rest is the archive checksum
+TEMPLATE_PREFIX = "pgbr_tpl_"
+
+# Hex digits of the archive's SHA-256 used in a template's name
+KEY_LENGTH = 16
+
+# Marker stored in each template's COMMENT so foreign databases are never touched
+COMMENT_FORMAT = "pg_backup_restore-template"
+
+# Default eviction limits
+DEFAULT_MAX_TEMPLATES = 3
+
+LIST_QUERY = (
+    "SELECT datname, shobj_description(oid, 'pg_database'), pg_database_size(oid) "
+    f"FROM pg_database WHERE datname LIKE '{TEMPLATE_PREFIX}%' ORDER BY datname;"
+)
+
+
+def template_name(checksum):
+    """Name of the template database caching the archive with this checksum."""
+    return TEMPLATE_PREFIX + checksum[:KEY_LENGTH]
+
+
+def loading_name(checksum):
+    """Name a template is restored under before it is published.
+
+    Unique per process, so two restores that miss the cache at the same time
+    never load into the same database.
+    """
+    return f"{template_name(checksum)}_load_{os.getpid()}"
+
+
+def _literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+class TemplateCache:
+    """Restored archives kept on the server as template databases.
+
+    Each template is named after the checksum of the archive it was restored
+    from and carries a JSON comment (archive path, checksum, timestamps).
+    Templates do not allow connections, so CREATE DATABASE ... TEMPLATE can
+    always copy them. The least recently used templates are dropped once
+    there are more than `max_templates` of them or they take more than
+    `max_bytes` on the server.
+    """
+
+    def __init__(self, psql_cmd, env, max_templates=DEFAULT_MAX_TEMPLATES, max_bytes=None):
+        # psql_cmd is the connection part (binary, host, port, user); the cache
+        # always works from the maintenance database
+        self.psql_cmd = psql_cmd + ['-d', 'postgres']
+        self.env = env
+        self.max_templates = max_templates
+        self.max_bytes = max_bytes
+
+    def _execute(self, sql):
+        subprocess.run(self.psql_cmd + ['-v', 'ON_ERROR_STOP=1', '-c', sql], env=self.env, check=True, capture_output=True)
+
+    def entries(self):
+        """Returns the cached templates, least recently used first."""
+        entries = []
+        for name, comment, size in incremental_backup.run_query(self.psql_cmd, self.env, LIST_QUERY):
+            try:
+                info = json.loads(comment)
+            except ValueError:
+                continue
+            if info.get("format") != COMMENT_FORMAT:
+                continue
+            info["name"] = name
+            info["size"] = int(size) if size else 0
+            entries.append(info)
+        return sorted(entries, key=lambda e: e.get("last_used", 0))
+
+    def lookup(self, checksum):
+        """Returns the template for an archive checksum, or None."""
+        for entry in self.entries():
+            if entry["name"] == template_name(checksum) and entry.get("checksum") == checksum:
+                return entry
+        return None
+
+    def _comment(self, name, info):
+        self._execute(f'COMMENT ON DATABASE "{name}" IS {_literal(json.dumps(info, sort_keys=True))};')
+
+    def register(self, loading, checksum, archive_path):
+        """Publishes a freshly restored database as the template of an archive.
+
+        If another restore published the same template in the meantime, the
+        loaded copy is dropped and the existing template is used.
+        """
+        name = template_name(checksum)
+        now = time.time()
+        info = {
+            "format": COMMENT_FORMAT,
+            "checksum": checksum,
+            "archive": os.path.abspath(archive_path),
+            "created_at": now,
+            "last_used": now,
+        }
+        self._execute(f'ALTER DATABASE "{loading}" WITH ALLOW_CONNECTIONS false IS_TEMPLATE true;')
+        self._comment(loading, info)
+        try:
+            self._execute(f'ALTER DATABASE "{loading}" RENAME TO "{name}";')
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode() if e.stderr else ""
+            if "already exists" not in stderr:
+                raise
+            logging.info(f"Template {name} was published concurrently; dropping {loading}")
+            self.drop(loading)
+        logging.info(f"Cached {archive_path} as template database {name}")
+        return self.lookup(checksum) or dict(info, name=name, size=0)
+
+    def touch(self, entry):
+        """Marks a template as used now."""
+        info = {k: v for k, v in entry.items() if k not in ("name", "size")}
+        info["last_used"] = time.time()
+        self._comment(entry["name"], info)
+
+    def drop(self, name):
+        """Drops a template database."""
+        # Template databases cannot be dropped until they are ordinary again
+        self._execute(f'ALTER DATABASE "{name}" WITH IS_TEMPLATE false;')
+        self._execute(f'DROP DATABASE "{name}";')
+        logging.info(f"Dropped template database {name}")
+
+    def invalidate(self, archive_path, checksum):
+        """Drops templates of the same archive file restored from different contents.
+
+        Returns the names dropped.
+        """
+        archive = os.path.abspath(archive_path)
+        dropped = []
+        for entry in self.entries():
+            if entry.get("archive") == archive and entry.get("checksum") != checksum:
+                self.drop(entry["name"])
+                dropped.append(entry["name"])
+        return dropped
+
+    def evict(self, keep=None):
+        """Drops least recently used templates until the limits hold.
+
+        The template named `keep` (the one just used) is never evicted.
+        Returns the names dropped.
+        """
+        entries = self.entries()
+        dropped = []
+        for entry in list(entries):
+            over_count = self.max_templates is not None and len(entries) > self.max_templates
+            over_size = self.max_bytes is not None and sum(e["size"] for e in entries) > self.max_bytes
+            if not (over_count or over_size):
+                break
+            if entry["name"] == keep:
+                continue
+            self.drop(entry["name"])
+            entries.remove(entry)
+            dropped.append(entry["name"])
+        return dropped
@@ -0,0 +1,267 @@
+import time
+import logging
+import threading
+import subprocess
+
+# Logging is configured in the main block or by the importing application
+
+# Seconds between pg_stat_activity polls in adaptive mode
+DEFAULT_POLL_INTERVAL = 5.0
+
+# Longest a psql poll may take before it counts as failed
+POLL_TIMEOUT = 30
+
+# Lowest fraction of the normal rate adaptive mode slows down to, so a
+# backup on a permanently busy server still finishes
+MIN_BUSY_SCALE = 0.05
+
+# Unused rate or CPU allowance kept for later, so a short stall (e.g.
+# pg_dump waiting on a lock) does not turn into a burst afterwards
+BURST_SECONDS = 1.0
+
+# Pauses at least this long are logged one by one; shorter ones are only counted
+LOG_PAUSE_SECONDS = 1.0
+
+# Sessions competing with the backup: client backends doing work, other than pg_dump's own
+ACTIVE_SESSIONS_SQL = (
+    "SELECT count(*) FROM pg_stat_activity "
+    "WHERE state = 'active' AND backend_type = 'client backend' "
+    "AND application_name <> 'pg_dump' AND pid <> pg_backend_pid();"
+)
+
+
+class LoadMonitor:
+    """Polls pg_stat_activity on a background thread to tell how busy the server is.
+
+    The server counts as busy while more than `max_active` other sessions
+    are active; scale() then returns max_active / active, the fraction of
+    its normal rate the backup should slow down to. A failed poll keeps the
+    previous reading.
+    """
+
+    def __init__(self, psql_cmd, env, max_active, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.psql_cmd = psql_cmd
+        self.env = env
+        self.max_active = max_active
+        self.poll_interval = poll_interval
+        self.active = 0
+        self.peak_active = 0
+        self.polls = 0
+        self.failed_polls = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        try:
+            result = subprocess.run(self.psql_cmd + ['-tA', '-c', ACTIVE_SESSIONS_SQL], env=self.env, capture_output=True, timeout=POLL_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.decode(errors="replace").strip())
+            active = int(result.stdout.decode().strip() or 0)
+        except Exception as e:
+            self.failed_polls += 1
+            logging.warning(f"Could not read pg_stat_activity: {e}")
+            return self.active
+        self.polls += 1
+        self.active = active
+        self.peak_active = max(self.peak_active, active)
+        return active
+
+    def scale(self):
+        """Fraction of the normal rate allowed right now (1.0 when the server is not busy)."""
+        if self.active <= self.max_active:
+            return 1.0
+        return max(MIN_BUSY_SCALE, self.max_active / self.active)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        # The first reading is taken before the backup starts
+        self.poll()
+        self._thread = threading.Thread(target=self._run, name="pg-load-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class Throttle:
+    """Slows a backup pipeline to a byte rate, a compression CPU share and the server's load.
+
+    consume() is called with every block read from pg_dump before it is
+    written to the archive. Sleeping there stops reading pg_dump's output,
+    so pg_dump itself blocks on the full pipe and stops reading from the
+    server. The limits:
+
+    - `bytes_per_second` caps the uncompressed dump rate.
+    - `cpu_percent` caps the CPU time of this backup (compression, hashing
+      and the thread pools of the parallel gzip and chunk-store writers) in
+      percent of one core. It is measured per thread in the calls wrapped
+      with measure(), so backups running side by side in one process (a
+      batch, the scheduler daemon, the GUI) each get their own allowance.
+      zstd's worker threads run outside Python and are not counted.
+    - `monitor` (a LoadMonitor) scales the rate down while the server is
+      busy. Without bytes_per_second, the pipeline's own speed (bytes per
+      second of unpaused time) is scaled.
+
+    Every pause is counted by cause ("rate", "cpu" or "load"); see to_dict().
+    """
+
+    def __init__(self, bytes_per_second=None, cpu_percent=None, monitor=None):
+        if bytes_per_second is not None and bytes_per_second <= 0:
+            raise ValueError("The rate limit must be positive.")
+        if cpu_percent is not None and cpu_percent <= 0:
+            raise ValueError("The compression CPU limit must be positive.")
+        self.bytes_per_second = bytes_per_second
+        self.cpu_percent = cpu_percent
+        self.monitor = monitor
+        self.bytes = 0
+        self.pauses = {"rate": 0, "cpu": 0, "load": 0}
+        self.paused_seconds = {"rate": 0.0, "cpu": 0.0, "load": 0.0}
+        self.busy_seconds = 0.0
+        self._started = None
+        self._rate_clock = None
+        self._cpu_clock = None
+        self._cpu_mark = None
+        self._busy_since = None
+        self.cpu_seconds = 0.0
+        self._cpu_lock = threading.Lock()
+
+    def start(self):
+        if self.monitor is not None:
+            self.monitor.start()
+        now = time.monotonic()
+        self._started = self._rate_clock = self._cpu_clock = now
+        self._cpu_mark = self.cpu_seconds
+
+    def stop(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self._busy_since is not None:
+            self.busy_seconds += time.monotonic() - self._busy_since
+            self._busy_since = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def _scale(self, now):
+        scale = self.monitor.scale() if self.monitor is not None else 1.0
+        if scale < 1.0 and self._busy_since is None:
+            self._busy_since = now
+            logging.info(f"Server busy ({self.monitor.active} active sessions, limit {self.monitor.max_active}): slowing the backup to {scale:.0%} of its normal rate")
+        elif scale >= 1.0 and self._busy_since is not None:
+            busy = now - self._busy_since
+            self.busy_seconds += busy
+            self._busy_since = None
+            logging.info(f"Server load back to normal after {busy:.1f}s; backup resumes its normal rate")
+        return scale
+
+    def _rate(self, now, scale):
+        """Bytes per second allowed right now, or None for no limit."""
+        if scale >= 1.0:
+            return self.bytes_per_second
+        base = self.bytes_per_second
+        if base is None:
+            running = now - self._started - sum(self.paused_seconds.values())
+            if running <= 0 or not self.bytes:
+                return None
+            base = self.bytes / running
+        return base * scale
+
+    def _pause(self, seconds, cause):
+        time.sleep(seconds)
+        self.pauses[cause] += 1
+        self.paused_seconds[cause] += seconds
+        if seconds >= LOG_PAUSE_SECONDS:
+            logging.info(f"Backup paused {seconds:.1f}s ({cause} limit)")
+
+    def measure(self, func, source=None):
+        """Wraps a pipeline call so the CPU time it uses is charged to this backup.
+
+        That is the calling thread's CPU time during the call, plus what
+        `source` (a writer with a thread pool) reports in its cpu_seconds
+        meanwhile.
+        """
+        def measured(*args):
+            cpu = time.thread_time()
+            pool = source.cpu_seconds if source is not None else 0.0
+            try:
+                return func(*args)
+            finally:
+                used = time.thread_time() - cpu
+                if source is not None:
+                    used += source.cpu_seconds - pool
+                with self._cpu_lock:
+                    self.cpu_seconds += used
+        return measured
+
+    def consume(self, n):
+        """Accounts for a block of `n` bytes and sleeps as long as the limits require."""
+        if self._started is None:
+            self.start()
+        now = time.monotonic()
+        scale = self._scale(now)
+        rate = self._rate(now, scale)
+        self.bytes += n
+        if rate:
+            self._rate_clock = max(self._rate_clock, now - BURST_SECONDS) + n / rate
+            if self._rate_clock > now:
+                self._pause(self._rate_clock - now, "rate" if scale >= 1.0 else "load")
+
+        if self.cpu_percent:
+            with self._cpu_lock:
+                cpu = self.cpu_seconds
+            used, self._cpu_mark = cpu - self._cpu_mark, cpu
+            now = time.monotonic()
+            self._cpu_clock = max(self._cpu_clock, now - BURST_SECONDS) + used * 100.0 / self.cpu_percent
+            if self._cpu_clock > now:
+                self._pause(self._cpu_clock - now, "cpu")
+
+    def elapsed(self):
+        return time.monotonic() - self._started if self._started is not None else 0.0
+
+    def to_dict(self):
+        """Pause counts and seconds by cause, time spent slowed by load and the effective throughput."""
+        elapsed = self.elapsed()
+        record = {
+            "max_bytes_per_second": self.bytes_per_second,
+            "max_cpu_percent": self.cpu_percent,
+            "pauses": sum(self.pauses.values()),
+            "paused_seconds": round(sum(self.paused_seconds.values()), 3),
+            "pauses_by_cause": dict(self.pauses),
+            "paused_seconds_by_cause": {k: round(v, 3) for k, v in self.paused_seconds.items()},
+            "bytes": self.bytes,
+            "effective_bytes_per_second": round(self.bytes / elapsed) if elapsed > 0 else None,
+        }
+        if self.monitor is not None:
+            record.update(
+                max_active_sessions=self.monitor.max_active,
+                peak_active_sessions=self.monitor.peak_active,
+                busy_seconds=round(self.busy_seconds, 3),
+                load_polls=self.monitor.polls,
+                failed_load_polls=self.monitor.failed_polls,
+            )
+        return record
+
+    def summary(self):
+        record = self.to_dict()
+        rate = record["effective_bytes_per_second"]
+        text = f"Throttling: {record['pauses']} pause(s), {record['paused_seconds']:.1f}s paused"
+        causes = [f"{cause} {seconds:.1f}s" for cause, seconds in record["paused_seconds_by_cause"].items() if seconds]
+        if causes:
+            text += f" ({', '.join(causes)})"
+        if self.monitor is not None:
+            text += f"; server busy for {record['busy_seconds']:.1f}s, peak {record['peak_active_sessions']} active session(s)"
+        if rate is not None:
+            text += f"; effective throughput {rate / 1e6:.1f} MB/s"
+        return text
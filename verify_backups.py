@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import logging
+import zipfile
+import argparse
+import concurrent.futures
+
+import archive_codecs
+import archive_digests
+import backup_catalog
+import chunk_store
+import incremental_backup
+import indexed_archive
+import parallel_export
+
+# Logging is configured in the main block or by the importing application
+
+# Size of the blocks read from each decompressed archive
+CHUNK_SIZE = 1024 * 1024
+
+# Zip members that hold archive metadata rather than dump data
+METADATA_MEMBERS = (incremental_backup.MANIFEST_MEMBER, indexed_archive.TOC_MEMBER, parallel_export.MANIFEST_MEMBER)
+
+
+def _hash_stream(src, hasher):
+    total = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return total
+        hasher.update(chunk)
+        total += len(chunk)
+
+
+def verify_archive(path, expected=None):
+    """Reads an archive once, decompressing it in memory, and checks its digests.
+
+    `expected` is the archive's digest record (default: its digest file).
+    Returns a result dict whose status is "ok", "corrupt" (a digest differs
+    or the archive does not decompress) or "unverified" (it decompresses
+    cleanly but no digest was recorded for it).
+    """
+    started = time.perf_counter()
+    if expected is None:
+        expected = archive_digests.read_digests(path)
+    result = {"path": path}
+    try:
+        codec = archive_codecs.detect_codec(path)
+        dump_hasher = archive_digests.new_hasher()
+        if codec == "chunks":
+            # The manifest is small; ChunkStore.get checks every chunk's digest too
+            archive_sha256, archive_size = archive_digests.file_digest(path)
+            with chunk_store.open_manifest_reader(path) as src:
+                dump_size = _hash_stream(src, dump_hasher)
+        else:
+            archive_codecs.check_codec_available(codec)
+            with archive_digests.HashingReader(path) as raw:
+                if codec == "zip":
+                    dump_size = 0
+                    with zipfile.ZipFile(raw, 'r') as zipf:
+                        # In archive order, so the file is read front to back
+                        for info in sorted(zipf.infolist(), key=lambda i: i.header_offset):
+                            metadata = info.filename in METADATA_MEMBERS
+                            with zipf.open(info) as src:
+                                # zipfile checks each member's CRC-32 when it reaches the end
+                                n = _hash_stream(src, archive_digests.new_hasher() if metadata else dump_hasher)
+                            if not metadata:
+                                dump_size += n
+                else:
+                    with archive_codecs.open_reader(path, codec, fileobj=raw) as src:
+                        dump_size = _hash_stream(src, dump_hasher)
+                archive_sha256, archive_size = raw.finish()
+    except Exception as e:
+        result.update(status="corrupt", error=f"{type(e).__name__}: {e}", seconds=round(time.perf_counter() - started, 3))
+        return result
+
+    result.update(
+        archive_sha256=archive_sha256,
+        archive_size=archive_size,
+        dump_sha256=dump_hasher.hexdigest(),
+        dump_size=dump_size,
+        seconds=round(time.perf_counter() - started, 3),
+    )
+    if not expected:
+        result["status"] = "unverified"
+        return result
+    errors = []
+    if expected.get("archive_sha256") and expected["archive_sha256"] != archive_sha256:
+        errors.append("archive digest mismatch")
+    if expected.get("dump_sha256") and expected["dump_sha256"] != result["dump_sha256"]:
+        errors.append("dump digest mismatch")
+    result["status"] = "corrupt" if errors else "ok"
+    if errors:
+        result["error"] = ", ".join(errors)
+    return result
+
+
+def find_archives(backup_dir):
+    """Backup archives in a directory, least recently verified first.
+
+    Archives never verified come first, so a time-boxed run picks up where
+    the previous one stopped.
+    """
+    archives = []
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if archive_codecs.is_archive(name) and os.path.isfile(path):
+            record = archive_digests.read_digests(path) or {}
+            archives.append((record.get("verified_at", 0), name, path))
+    return [path for _verified, _name, path in sorted(archives)]
+
+
+def catalog_checksums(backup_dir, catalog_path=None):
+    """{absolute path: sha256} from the backup catalog, for archives without a digest file."""
+    catalog_path = catalog_path or backup_catalog.default_catalog_path(backup_dir)
+    if not os.path.exists(catalog_path):
+        return {}
+    catalog = backup_catalog.BackupCatalog(catalog_path, backup_dir=backup_dir)
+    return {os.path.abspath(b["path"]): b["checksum"] for b in catalog.list_backups() if b["checksum"]}
+
+
+def verify_archives(paths, workers=None, time_budget=None, checksums=None):
+    """Verifies archives concurrently on a process pool and returns their results.
+
+    Decompression and hashing are CPU-bound, so each archive is checked in
+    its own process (`workers`, default one per CPU). With `time_budget`
+    (seconds) no new archive is started once the budget is spent; those
+    are reported as "skipped". `checksums` maps archive paths to the
+    archive SHA-256 expected when an archive has no digest file.
+    """
+    checksums = checksums or {}
+    deadline = time.monotonic() + time_budget if time_budget else None
+    results = []
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    futures = {}
+    try:
+        for path in paths:
+            expected = archive_digests.read_digests(path)
+            if expected is None and os.path.abspath(path) in checksums:
+                expected = {"archive_sha256": checksums[os.path.abspath(path)]}
+            futures[pool.submit(verify_archive, path, expected)] = path
+        pending = set(futures)
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append({"path": futures[future], "status": "corrupt", "error": f"{type(e).__name__}: {e}"})
+            if deadline is not None and time.monotonic() >= deadline:
+                # Archives already being read finish; queued ones are skipped
+                for future in pending:
+                    if future.cancel():
+                        results.append({"path": futures[future], "status": "skipped"})
+                pending = {f for f in pending if not f.cancelled()}
+                deadline = None
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    for result in results:
+        if result["status"] in ("ok", "corrupt"):
+            try:
+                archive_digests.mark_verified(result["path"], result["status"])
+            except OSError as e:
+                logging.error(f"Could not record the verification of {result['path']}: {e}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify backup archives against the digests recorded at backup time.")
+    parser.add_argument("--backup-dir", help="Verify every archive in this directory")
+    parser.add_argument("--archive", action="append", default=[], help="Archive to verify (repeatable)")
+    parser.add_argument("--workers", type=int, help="Number of archives verified in parallel (default: one per CPU)")
+    parser.add_argument("--time-budget", type=float, help="Start no new verification after this many seconds; the least recently verified archives go first")
+    parser.add_argument("--catalog", help="Backup catalog used for archives without a digest file (default: <backup-dir>/backup_catalog.db)")
+
+    args = parser.parse_args()
+    if not args.backup_dir and not args.archive:
+        parser.error("Give --backup-dir and/or --archive.")
+
+    # Configure logging for CLI usage
+    logging.basicConfig(
+        filename='verify_backups.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    paths = list(args.archive)
+    checksums = {}
+    if args.backup_dir:
+        paths += [p for p in find_archives(args.backup_dir) if p not in paths]
+        checksums = catalog_checksums(args.backup_dir, args.catalog)
+
+    started = time.perf_counter()
+    results = verify_archives(paths, workers=args.workers, time_budget=args.time_budget, checksums=checksums)
+    counts = {}
+    for result in sorted(results, key=lambda r: r["path"]):
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        line = f"{result['status'].upper():<10} {result['path']}"
+        if result.get("seconds") is not None:
+            line += f" ({result['seconds']:.1f}s)"
+        if result.get("error"):
+            line += f": {result['error']}"
+        print(line)
+        if result["status"] == "corrupt":
+            logging.error(line)
+        else:
+            logging.info(line)
+
+    summary = f"Verified {len(results)} archive(s) in {time.perf_counter() - started:.1f}s: " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items()))
+    print(summary)
+    logging.info(summary)
+    sys.exit(1 if counts.get("corrupt") else 0)